@@ -1,28 +1,39 @@
-import boto3
+import os
 import time
 import logging
 import traceback
+import datetime
 import json
+import codecs
 import csv
+import gzip
+import hashlib
 import io
+import re
+import itertools
+import threading
+import uuid
+import zlib
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.client import Config
+from cross_account import LazyClient, get_client
 
 # Initialize logger
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize AWS clients
-athena_client = boto3.client('athena')
-sns_client = boto3.client('sns')
-s3_client = boto3.client('s3', config=Config(signature_version='s3v4'))
-logs_client = boto3.client('logs')
-identitystore_client = boto3.client('identitystore')
+# Initialize AWS clients (built on first use, CloudWatch Logs and Identity Store go through assumed roles)
+athena_client = LazyClient('athena')
+sns_client = LazyClient('sns')
+s3_client = LazyClient('s3', config=Config(signature_version='s3v4'))
 
 ATHENA_OUTPUT_BUCKET = 'athena-scheduled-reports'
 ATHENA_OUTPUT_PREFIX = 'athena-results/'
 CLOUDWATCH_OUTPUT_PREFIX = 'cloudwatch-results/'
 IDENTITY_STORE_OUTPUT_PREFIX = 'identitystore-results/'
+QUERY_CACHE_PREFIX = 'query-cache/'
+CHECKPOINT_PREFIX = 'checkpoints/'
 
 SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
 IDENTITY_STORE = os.getenv('IDENTITY_STORE')
@@ -32,33 +43,132 @@ ATHENA_DB_NAME = os.getenv('ATHENA_DB_NAME')
 CLOUDWATCH_ACCOUNT = os.getenv('CLOUDWATCH_ACCOUNT') 
 CLOUDWATCH_LOG_GROUP = os.getenv('CLOUDWATCH_LOG_GROUP')
 
+# Array of Athena query IDs to be executed. The function assumes they are in the same account
+ATHENA_QUERY_IDS = [
+    "Query_ID_1",
+    "Query_ID_2",
+    "Query_ID_3"
+]
 
+# Array of CloudWatch queries. They need Title and Query, the Log Group is passed in the function
+CLOUDWATCH_QUERIES = [
+    {"title": "CW_Query Title", "query": "CW_Query"}
+]
 
-def assume_role(account_id, role_name, service_name):
-    sts_client = boto3.client('sts')
-    assumed_role = sts_client.assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
-        RoleSessionName=f"CrossAccountSession-{service_name}"
-    )
+# Array of CloudWatch jobs for other accounts/log groups. They need Account, Log Groups, Title and Query
+CLOUDWATCH_JOBS = [
+    # {"account": "111111111111", "log_groups": ["Log_Group_1", "Log_Group_2"], "title": "CW_Query Title", "query": "CW_Query"}
+]
 
-    credentials = assumed_role['Credentials']
+# Fan-out mode: start every Athena query up front and poll them together
+ATHENA_FANOUT = os.getenv('ATHENA_FANOUT', 'false').lower() == 'true'
+ATHENA_MAX_CONCURRENT_QUERIES = int(os.getenv('ATHENA_MAX_CONCURRENT_QUERIES', '20'))
+# Logs Insights limits the number of concurrent queries per account
+CLOUDWATCH_MAX_CONCURRENT_QUERIES = int(os.getenv('CLOUDWATCH_MAX_CONCURRENT_QUERIES', '10'))
+# Sharding mode: split the query window in sub-ranges, splitting again any shard that hits the result cap
+CLOUDWATCH_SHARDS = int(os.getenv('CLOUDWATCH_SHARDS', '1'))
+CLOUDWATCH_RESULT_LIMIT = int(os.getenv('CLOUDWATCH_RESULT_LIMIT', '10000'))
+CLOUDWATCH_MIN_SHARD_SECONDS = 60
+CLOUDWATCH_SHARD_ATTEMPTS = 2
+CLOUDWATCH_QUERY_DAYS = 7
+# CSV files are streamed to S3 in multipart parts of this size (S3 minimum is 5 MiB)
+CSV_PART_SIZE = int(os.getenv('CSV_PART_SIZE_MB', '8')) * 1024 * 1024
+CSV_GZIP = os.getenv('CSV_GZIP', 'false').lower() == 'true'
+# Result cache: reuse the results of identical queries for the same window (0 disables it)
+QUERY_CACHE_TTL_HOURS = float(os.getenv('QUERY_CACHE_TTL_HOURS', '0'))
 
-    # Return the requested client using the assumed role credentials
-    return boto3.client(
-        service_name,
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken']
-    )
+# Report window injected in the Athena queries placeholders, {{partition_filter}} expands to the partition predicates
+REPORT_WINDOW_DAYS = int(os.getenv('REPORT_WINDOW_DAYS', '7'))
+REPORT_ACCOUNTS = [account.strip() for account in os.getenv('REPORT_ACCOUNTS', '').split(',') if account.strip()]
+REPORT_REGIONS = [region.strip() for region in os.getenv('REPORT_REGIONS', '').split(',') if region.strip()]
+# Partition columns of the CloudTrail table (partition projection defaults)
+ATHENA_DATE_PARTITION = os.getenv('ATHENA_DATE_PARTITION', 'timestamp')
+ATHENA_DATE_FORMAT = os.getenv('ATHENA_DATE_FORMAT', '%Y/%m/%d')
+ATHENA_ACCOUNT_PARTITION = os.getenv('ATHENA_ACCOUNT_PARTITION', 'account')
+ATHENA_REGION_PARTITION = os.getenv('ATHENA_REGION_PARTITION', 'region')
+# Skip the Athena queries that do not filter on the date partition instead of only warning
+ATHENA_REQUIRE_PARTITION_FILTER = os.getenv('ATHENA_REQUIRE_PARTITION_FILTER', 'false').lower() == 'true'
+
+# Incremental inventory: keep a snapshot of the Identity Center users and only report the changes
+IDENTITY_INCREMENTAL = os.getenv('IDENTITY_INCREMENTAL', 'false').lower() == 'true'
+IDENTITY_GROUP_MEMBERSHIPS = os.getenv('IDENTITY_GROUP_MEMBERSHIPS', 'false').lower() == 'true'
+IDENTITY_MAX_WORKERS = int(os.getenv('IDENTITY_MAX_WORKERS', '8'))
+IDENTITY_SNAPSHOT_POINTER = f"{IDENTITY_STORE_OUTPUT_PREFIX}latest-snapshot.json"
+# Identity join: add the Identity Center email to the query results, matching the first of these columns
+IDENTITY_JOIN = os.getenv('IDENTITY_JOIN', 'false').lower() == 'true'
+IDENTITY_JOIN_COLUMNS = [column.strip() for column in os.getenv('IDENTITY_JOIN_COLUMNS', 'userid,useridentity.onbehalfof.userid,principalid').split(',') if column.strip()]
+# Rows enriched between two checks of the time budget
+ENRICH_DEADLINE_CHECK_ROWS = 10000
+
+# Time budget: stop polling this many seconds before the Lambda deadline and checkpoint the pending queries
+DEADLINE_SAFETY_SECONDS = int(os.getenv('DEADLINE_SAFETY_SECONDS', '60'))
+MAX_CONTINUATIONS = int(os.getenv('MAX_CONTINUATIONS', '5'))
+CHECKPOINT_MAX_AGE_HOURS = 12
+POLL_MIN_SECONDS = 1
+POLL_MAX_SECONDS = 15
+
+# Athena Batch* APIs accept at most 50 IDs per call
+ATHENA_BATCH_SIZE = 50
+ATHENA_API_ATTEMPTS = 3
+
+# Epoch seconds when the report has to stop polling, set by lambda_handler from the context
+report_deadline = None
+
+class DeadlineExceeded(Exception):
+    """Raised when the report runs out of its time budget."""
+
+
+def set_report_deadline(context):
+    """Derives the report time budget from the Lambda remaining time."""
+    global report_deadline
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        report_deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_SAFETY_SECONDS
+    else:
+        report_deadline = None
+
+def get_time_left():
+    """Seconds left in the report time budget."""
+    return float('inf') if report_deadline is None else report_deadline - time.time()
+
+def wait_before_poll(attempt):
+    """Sleeps with an exponential backoff, never past the report deadline."""
+    time_left = get_time_left()
+    if time_left <= 0:
+        raise DeadlineExceeded()
+    time.sleep(min(POLL_MIN_SECONDS * 1.5 ** attempt, POLL_MAX_SECONDS, time_left))
+
+def call_with_retries(function, **kwargs):
+    """Calls an AWS API, retrying with a backoff when it fails (e.g. throttling) while there is time left."""
+    for attempt in range(ATHENA_API_ATTEMPTS):
+        try:
+            return function(**kwargs)
+        except Exception as e:
+            if attempt == ATHENA_API_ATTEMPTS - 1 or get_time_left() <= 0:
+                raise
+            logger.warning(f"{getattr(function, '__name__', 'AWS call')} failed, retrying: {str(e)}")
+            wait_before_poll(attempt)
+
+def assume_role(account_id, role_name, service_name):
+    """Returns a client of the service with the role of the account. Credentials and clients are cached
+    across warm invocations and refreshed before the credentials expire."""
+    return get_client(service_name, account_id, role_name, session_name=f"CrossAccountSession-{service_name}")
+
+def get_cloudwatch_window():
+    """Returns the (start, end) window of the CloudWatch queries, in epoch seconds."""
+    end_time = int(time.time())  # Now
+    return end_time - CLOUDWATCH_QUERY_DAYS * 86400, end_time  # 7 days ago
 
-def execute_cloudwatch_query(query_string, logs_client):
+def execute_cloudwatch_query(query_string, logs_client, log_groups=None, start_time=None, end_time=None):
     """Starts a CloudWatch Logs Insights query and returns its query ID."""
+    if start_time is None or end_time is None:
+        start_time, end_time = get_cloudwatch_window()
+
     try:
         response = logs_client.start_query(
-            logGroupName=CLOUDWATCH_LOG_GROUP,
+            logGroupNames=log_groups or [CLOUDWATCH_LOG_GROUP],
             queryString=query_string,
-            startTime=int((time.time() - 7 * 86400) * 1000),  # 7 days ago
-            endTime=int(time.time() * 1000)  # Now
+            startTime=start_time,
+            endTime=end_time
         )
         query_id = response.get("queryId")  # Ensure we return the queryId
         logger.info(f"Started CloudWatch query: {query_id}")
@@ -73,7 +183,7 @@ def execute_userID_commands(identitystore):
     next_token = None
 
     while True:
-        params = {'IdentityStoreId': IDENTITY_STORE}
+        params = {'IdentityStoreId': IDENTITY_STORE, 'MaxResults': 100}
         if next_token:
             params['NextToken'] = next_token
         
@@ -86,6 +196,7 @@ def execute_userID_commands(identitystore):
             )
             users.append({
                 'UserId': user['UserId'],
+                'UserName': user.get('UserName', ''),
                 'Email': email or ''
             })
 
@@ -95,39 +206,439 @@ def execute_userID_commands(identitystore):
     
     return users
     
-def save_dicts_to_s3_csv(dict_list, filename):
-    #Save a list of dicts as a CSV file in S3 and return a presigned URL
-    if not dict_list:
-        logging.info("No results to save.")
-        return "No results available"
-    logging.info(f"Saving {len(dict_list)} rows to CSV: {filename}")
+def get_group_names(identitystore):
+    """Maps GroupId to DisplayName for every group of the Identity Store."""
+    group_names = {}
+    next_token = None
+
+    while True:
+        params = {'IdentityStoreId': IDENTITY_STORE, 'MaxResults': 100}
+        if next_token:
+            params['NextToken'] = next_token
+
+        response = identitystore.list_groups(**params)
+        for group in response['Groups']:
+            group_names[group['GroupId']] = group.get('DisplayName', group['GroupId'])
+
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+
+    return group_names
 
-    field_names = list(dict_list[0].keys())
+def add_group_memberships(identitystore, users):
+    """Adds the sorted group names of every user, fetching the memberships with a bounded pool of workers."""
+    group_names = get_group_names(identitystore)
 
-    csv_buffer = io.StringIO()
-    writer = csv.DictWriter(csv_buffer, fieldnames=field_names)
-    writer.writeheader()
-    writer.writerows(dict_list)
+    def get_user_groups(user):
+        groups = []
+        next_token = None
+        while True:
+            params = {'IdentityStoreId': IDENTITY_STORE, 'MemberId': {'UserId': user['UserId']}, 'MaxResults': 100}
+            if next_token:
+                params['NextToken'] = next_token
+
+            response = identitystore.list_group_memberships_for_member(**params)
+            groups.extend(group_names.get(membership['GroupId'], membership['GroupId']) for membership in response['GroupMemberships'])
+
+            next_token = response.get('NextToken')
+            if not next_token:
+                return sorted(groups)
+
+    with ThreadPoolExecutor(max_workers=IDENTITY_MAX_WORKERS) as executor:
+        for user, groups in zip(users, executor.map(get_user_groups, users)):
+            user['Groups'] = ';'.join(groups)
+
+def get_previous_snapshot_key():
+    """Returns the S3 key of the last inventory snapshot, or None on the first run."""
+    try:
+        pointer = json.loads(s3_client.get_object(Bucket=ATHENA_OUTPUT_BUCKET, Key=IDENTITY_SNAPSHOT_POINTER)['Body'].read())
+        return pointer['snapshot_key']
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+def iter_snapshot(s3_key):
+    """Streams the records of a gzip JSON lines snapshot stored in S3."""
+    if not s3_key:
+        return
+    body = s3_client.get_object(Bucket=ATHENA_OUTPUT_BUCKET, Key=s3_key)['Body']
+    with gzip.GzipFile(fileobj=body) as snapshot:
+        for line in snapshot:
+            yield json.loads(line)
+
+def diff_snapshots(previous, current):
+    """Merges two iterables of user records sorted by UserId, yielding (change, record, previous_record)."""
+    previous = iter(previous)
+    current = iter(current)
+    old = next(previous, None)
+    new = next(current, None)
+
+    while old is not None or new is not None:
+        if new is None or (old is not None and old['UserId'] < new['UserId']):
+            yield 'REMOVED', old, old
+            old = next(previous, None)
+        elif old is None or new['UserId'] < old['UserId']:
+            yield 'ADDED', new, None
+            new = next(current, None)
+        else:
+            # Fields only in one of the snapshots (added by an option or a newer version) are not compared
+            if any(new[field] != old[field] for field in new.keys() & old.keys()):
+                yield 'CHANGED', new, old
+            old = next(previous, None)
+            new = next(current, None)
+
+def run_incremental_inventory(identitystore, users):
+    """Compares the Identity Center users with the last snapshot, saving the changes and a new snapshot."""
+    users = sorted(users, key=lambda user: user['UserId'])
+    if IDENTITY_GROUP_MEMBERSHIPS:
+        add_group_memberships(identitystore, users)
 
     timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-    s3_key = f"{CLOUDWATCH_OUTPUT_PREFIX}{timestamp}_{filename}"
+    previous_key = get_previous_snapshot_key()
+    snapshot_key = f"{IDENTITY_STORE_OUTPUT_PREFIX}snapshots/{timestamp}_users.jsonl.gz"
+    changes_key = get_csv_s3_key('identity-center-users-changes.csv')
+    counts = {'ADDED': 0, 'REMOVED': 0, 'CHANGED': 0}
+
+    field_names = ['Change', 'UserId', 'Email', 'PreviousEmail']
+    if IDENTITY_GROUP_MEMBERSHIPS:
+        field_names += ['Groups', 'PreviousGroups']
+
+    # The previous snapshot is streamed, only the current users are held in memory
+    with S3CsvStreamWriter(ATHENA_OUTPUT_BUCKET, changes_key, field_names) as writer:
+        for change, user, previous_user in diff_snapshots(iter_snapshot(previous_key), users):
+            counts[change] += 1
+            row = {'Change': change, 'UserId': user['UserId'], 'Email': user['Email'], 'PreviousEmail': (previous_user or {}).get('Email', '')}
+            if IDENTITY_GROUP_MEMBERSHIPS:
+                row['Groups'] = user.get('Groups', '')
+                row['PreviousGroups'] = (previous_user or {}).get('Groups', '')
+            writer.write_row(row)
+
+    with S3StreamWriter(ATHENA_OUTPUT_BUCKET, snapshot_key, 'application/x-ndjson', compress=True) as snapshot:
+        for user in users:
+            snapshot.write((json.dumps(user, separators=(',', ':')) + '\n').encode('utf-8'))
 
     s3_client.put_object(
         Bucket=ATHENA_OUTPUT_BUCKET,
-        Key=s3_key,
-        Body=csv_buffer.getvalue(),
-        ContentType='text/csv'
+        Key=IDENTITY_SNAPSHOT_POINTER,
+        Body=json.dumps({'snapshot_key': snapshot_key, 'users': len(users)}),
+        ContentType='application/json'
     )
 
+    summary = f"{counts['ADDED']} added, {counts['REMOVED']} removed, {counts['CHANGED']} changed ({len(users)} users)"
+    logger.info(f"Identity Center inventory changes: {summary}")
+    return {
+        'title': 'Mail - User Correlation (changes since last run)',
+        'query': f"list_users command in Mgmt Account: {summary}",
+        'status': 'SUCCEEDED' if any(counts.values()) else 'NO CHANGES',
+        'result_url': generate_presigned_url(f"s3://{ATHENA_OUTPUT_BUCKET}/{changes_key}"),
+        'snapshot_url': generate_presigned_url(f"s3://{ATHENA_OUTPUT_BUCKET}/{snapshot_key}")
+    }
+
+def build_user_index(users):
+    """Hash index of the Identity Center users: UserId, UserName and primary email (lowercase) -> Email.
+
+    SSO role sessions are named after the UserName (or the email), not the UserId.
+    """
+    user_index = {}
+    for user in users:
+        for key in (user['UserId'], user.get('UserName'), user['Email']):
+            if key:
+                user_index[key.lower()] = user['Email']
+    return user_index
+
+def iter_s3_csv(s3_path):
+    """Streams the rows of a CSV file (plain or gzip) stored in S3."""
+    bucket_name, file_path = s3_path[5:].split('/', 1)
+    body = s3_client.get_object(Bucket=bucket_name, Key=file_path)['Body']
+    if file_path.endswith('.gz'):
+        lines = io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding='utf-8', newline='')
+    else:
+        lines = codecs.getreader('utf-8')(body)
+    yield from csv.DictReader(lines)
+
+def find_user_email(row, user_index):
+    """Looks up the email of the first join column of the row found in the index."""
+    for column in IDENTITY_JOIN_COLUMNS:
+        value = row.get(column)
+        if not value:
+            continue
+        # principalId looks like AROAXXXXXXXX:<session name>, the session name of SSO roles is the UserName or email
+        email = user_index.get(value.lower()) or user_index.get(value.rsplit(':', 1)[-1].lower())
+        if email:
+            return email
+    return ''
+
+def enrich_query_results(queries_status, user_index):
+    """Streams every query result through the user index, saving a copy of the rows with the email added.
+
+    The time budget is checked before each result and while its rows are streamed. Results
+    already handled have an enriched_url (None when there was nothing to enrich), so a
+    continuation only does the rest. Returns False when the deadline stopped the enrichment.
+    """
+    for query_status in queries_status:
+        if not query_status.get('s3_path') or 'enriched_url' in query_status:
+            continue
+        if get_time_left() <= 0:
+            return False
+
+        query_status['enriched_url'] = None
+        try:
+            rows = iter_s3_csv(query_status['s3_path'])
+            first_row = next(rows, None)
+            if first_row is None:
+                continue
+
+            field_names = [name.lower() for name in first_row]
+            email_column = 'identitycenter_email' if 'email' in field_names else 'email'
+            field_names = list(first_row) + [email_column]
+
+            def enriched_rows():
+                for i, row in enumerate(itertools.chain([first_row], rows)):
+                    if i % ENRICH_DEADLINE_CHECK_ROWS == 0 and get_time_left() <= 0:
+                        # The partial upload is aborted, the continuation enriches this result again
+                        raise DeadlineExceeded()
+                    lowered = {key.lower(): value for key, value in row.items()}
+                    row[email_column] = find_user_email(lowered, user_index)
+                    yield row
+
+            # Written next to the result it enriches (Athena or CloudWatch results prefix)
+            filename = f"{query_status['title'].replace(' ', '_')}_enriched.csv"
+            directory = query_status['s3_path'][5:].split('/', 1)[1].rpartition('/')[0]
+            s3_key = get_csv_s3_key(filename, f"{directory}/" if directory else '')
+            query_status['enriched_url'] = stream_rows_to_s3_csv(enriched_rows(), field_names, filename, s3_key=s3_key)
+        except DeadlineExceeded:
+            del query_status['enriched_url']
+            return False
+        except Exception as e:
+            logger.error(f"Error enriching results of {query_status['title']}: {str(e)}", exc_info=True)
+
+    return True
+
+def strip_query_comment(line):
+    """Removes a -- comment from a query line, unless the -- is inside a string literal."""
+    position = line.find('--')
+    while position != -1:
+        if line[:position].count("'") % 2 == 0:
+            return line[:position]
+        position = line.find('--', position + 2)
+    return line
+
+def normalize_query(query_string):
+    """Collapses whitespace and drops comments and the trailing semicolon, keeping literals untouched."""
+    lines = [strip_query_comment(line) for line in query_string.splitlines()]
+    return ' '.join(' '.join(lines).split()).rstrip(';').strip()
+
+def get_cache_window():
+    """Effective time window of the cached results: the report day (UTC)."""
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+def get_query_cache_key(query_string, source):
+    """Fingerprint of a query: normalized text, database/log groups and the effective time window."""
+    fingerprint = json.dumps({
+        'query': normalize_query(query_string),
+        'source': source,
+        'window': get_cache_window()
+    }, sort_keys=True)
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+def get_cached_result(cache_key):
+    """Returns the cached S3 path of a query result, or None if there is no valid entry."""
+    if QUERY_CACHE_TTL_HOURS <= 0:
+        return None
+
+    s3_key = f"{QUERY_CACHE_PREFIX}{cache_key}.json"
+    try:
+        entry = json.loads(s3_client.get_object(Bucket=ATHENA_OUTPUT_BUCKET, Key=s3_key)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        logger.error(f"Error reading query cache entry {s3_key}: {str(e)}")
+        return None
+
+    if entry['expires_at'] < time.time():
+        logger.info(f"Query cache entry {s3_key} expired, evicting it.")
+        s3_client.delete_object(Bucket=ATHENA_OUTPUT_BUCKET, Key=s3_key)
+        return None
+
+    logger.info(f"Query cache hit: {entry['s3_path']}")
+    return entry['s3_path']
+
+def cache_result(cache_key, s3_path):
+    """Stores the S3 path of a query result in the cache, with the configured TTL."""
+    if QUERY_CACHE_TTL_HOURS <= 0 or not cache_key:
+        return
+
+    try:
+        s3_client.put_object(
+            Bucket=ATHENA_OUTPUT_BUCKET,
+            Key=f"{QUERY_CACHE_PREFIX}{cache_key}.json",
+            Body=json.dumps({
+                's3_path': s3_path,
+                'created_at': time.time(),
+                'expires_at': time.time() + QUERY_CACHE_TTL_HOURS * 3600
+            }),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        logger.error(f"Error writing query cache entry: {str(e)}")
+
+def get_cached_status(title, query_string, cache_key):
+    """Returns a query status built from a cache hit, or None on a miss."""
+    s3_path = get_cached_result(cache_key)
+    if not s3_path:
+        return None
+
+    return {
+        'title': title,
+        'query': query_string,
+        'status': 'SUCCEEDED',
+        'result_url': generate_presigned_url(s3_path),
+        's3_path': s3_path,
+        'cached': True
+    }
+
+class S3StreamWriter:
+    """Writes data to S3 as it is produced, uploading multipart parts of a fixed size.
+
+    Only one part is held in memory at a time. Files smaller than a part are sent
+    with a single put_object, so small reports do not pay for the multipart calls.
+    """
+
+    def __init__(self, bucket, key, content_type, compress=False, part_size=CSV_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.compress = compress
+        self.part_size = part_size
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        # wbits=31 produces a gzip container instead of a raw zlib stream
+        self.compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def _extra_args(self):
+        # Compressed files are stored as .gz archives: with Content-Encoding browsers would
+        # decompress them on download and save plain text under the .gz name
+        return {'ContentType': 'application/gzip' if self.compress else self.content_type}
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self._extra_args())['UploadId']
+        part_number = len(self.parts) + 1
+        response = s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += self.compressor.compress(data) if self.compressor else data
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+
+    def close(self):
+        if self.compressor:
+            self.buffer += self.compressor.flush()
+
+        if self.upload_id is None:
+            s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self._extra_args())
+        else:
+            if self.buffer:
+                self._upload_part()
+            s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts}
+            )
+        logging.info(f"File saved to s3://{self.bucket}/{self.key}")
+
+    def abort(self):
+        if self.upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+class S3CsvStreamWriter(S3StreamWriter):
+    """Writes CSV rows to S3 as they are produced, encoding one row at a time."""
+
+    def __init__(self, bucket, key, field_names, compress=CSV_GZIP, part_size=CSV_PART_SIZE):
+        super().__init__(bucket, key, 'text/csv', compress, part_size)
+        self.rows = 0
+        self.line = io.StringIO()
+        self.writer = csv.DictWriter(self.line, fieldnames=field_names)
+        self.writer.writeheader()
+        self._flush_line()
+
+    def _flush_line(self):
+        self.write(self.line.getvalue().encode('utf-8'))
+        self.line.seek(0)
+        self.line.truncate()
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+        self.rows += 1
+        self._flush_line()
+
+    def close(self):
+        super().close()
+        logging.info(f"CSV file with {self.rows} rows saved to s3://{self.bucket}/{self.key}")
+
+def get_csv_s3_key(filename, prefix=CLOUDWATCH_OUTPUT_PREFIX):
+    """Returns the S3 key of a CSV result file, adding .gz when compression is enabled."""
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+    return f"{prefix}{timestamp}_{filename}{'.gz' if CSV_GZIP else ''}"
+
+def stream_rows_to_s3_csv(rows, field_names, filename, cache_key=None, s3_key=None):
+    """Streams an iterable of dict rows to a CSV file in S3 and returns a presigned URL."""
+    s3_key = s3_key or get_csv_s3_key(filename)
+
+    with S3CsvStreamWriter(ATHENA_OUTPUT_BUCKET, s3_key, field_names) as writer:
+        for row in rows:
+            writer.write_row(row)
+
+    cache_result(cache_key, f"s3://{ATHENA_OUTPUT_BUCKET}/{s3_key}")
+
     return s3_client.generate_presigned_url(
         'get_object',
         Params={'Bucket': ATHENA_OUTPUT_BUCKET, 'Key': s3_key},
         ExpiresIn=604800  # 7 days
     )
 
-def wait_for_cloudwatch_query(query_id, logs_client, timeout=60):
-    """Waits for the CloudWatch query to complete and returns results."""
-    start_time = time.time()
+def save_dicts_to_s3_csv(dict_list, filename):
+    #Save a list (or any iterable) of dicts as a CSV file in S3 and return a presigned URL
+    rows = iter(dict_list)
+    first_row = next(rows, None)
+    if first_row is None:
+        logging.info("No results to save.")
+        return "No results available"
+    logging.info(f"Saving rows to CSV: {filename}")
+
+    field_names = list(first_row.keys())
+    return stream_rows_to_s3_csv(itertools.chain([first_row], rows), field_names, filename)
+
+def wait_for_cloudwatch_query(query_id, logs_client, cancelled=None):
+    """Waits for the CloudWatch query to complete and returns results.
+
+    There is no fixed timeout: a slow query raises DeadlineExceeded when the report
+    time budget is over, so it is checkpointed and polled again by the continuation.
+    Any status other than Scheduled/Running/Complete (Failed, Cancelled, Timeout,
+    Unknown...) raises RuntimeError. When the cancelled event is set, the query is
+    stopped and RuntimeError is raised as well.
+    """
+    attempt = 0
 
     while True:
         response = logs_client.get_query_results(queryId=query_id)
@@ -136,17 +647,26 @@ def wait_for_cloudwatch_query(query_id, logs_client, timeout=60):
         if status == "Complete":
             return response.get("results") if response.get("results") else []
 
-        if status in ["Failed", "Cancelled"]:
-            logger.error(f"Query {query_id} failed with status: {status}")
-            return []
+        if status not in ["Scheduled", "Running"]:
+            raise RuntimeError(f"Query {query_id} failed with status: {status}")
+
+        if cancelled is not None and cancelled.is_set():
+            stop_cloudwatch_query(query_id, logs_client)
+            raise RuntimeError(f"Query {query_id} cancelled")
 
-        if time.time() - start_time > timeout:
-            logger.error(f"Query {query_id} timed out after {timeout} seconds.")
-            return []
+        wait_before_poll(attempt)  # Wait before checking again
+        attempt += 1
 
-        time.sleep(2)  # Wait before checking again
+def stop_cloudwatch_query(query_id, logs_client):
+    """Stops a query that is no longer needed, so it does not hold an Insights slot of the account."""
+    try:
+        logs_client.stop_query(queryId=query_id)
+        logger.info(f"Stopped CloudWatch query {query_id}")
+    except Exception as e:
+        # The query may have finished in the meantime
+        logger.warning(f"Could not stop CloudWatch query {query_id}: {str(e)}")
 
-def save_results_to_s3_csv(results, filename):
+def save_results_to_s3_csv(results, filename, cache_key=None, s3_key=None):
     """Saves CloudWatch query results as a CSV in S3 and returns a presigned URL."""
     try:
         if not results:
@@ -154,43 +674,229 @@ def save_results_to_s3_csv(results, filename):
             return "No results available"
 
         # Extract column names from results
-        field_names = [field['field'] for field in results[0]] if results else []
-        
-        # Create an in-memory CSV buffer
-        csv_buffer = io.StringIO()
-        csv_writer = csv.DictWriter(csv_buffer, fieldnames=field_names)
-        csv_writer.writeheader()
+        field_names = [field['field'] for field in results[0]]
+
+        # Rows are converted one by one while they are written
+        rows = ({field['field']: field['value'] for field in row} for row in results)
+        return stream_rows_to_s3_csv(rows, field_names, filename, cache_key, s3_key)
+
+    except Exception as e:
+        logging.error(f"Error saving CSV to S3: {str(e)}", exc_info=True)
+        return "Error generating file"
 
-        # Write data rows
-        for row in results:
-            csv_writer.writerow({field['field']: field['value'] for field in row})
+def get_result_timestamp(row):
+    """Returns the @timestamp of a CloudWatch result row, or an empty string if the query does not return it."""
+    return next((field['value'] for field in row if field['field'] == '@timestamp'), '')
 
-        # Define S3 path
-        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-        s3_key = f"{CLOUDWATCH_OUTPUT_PREFIX}{timestamp}_{filename}"
+def can_shard_cloudwatch_query(query_string):
+    """Only plain row queries can be merged by concatenation.
 
-        # Upload CSV to S3
-        s3_client.put_object(
-            Bucket=ATHENA_OUTPUT_BUCKET,
-            Key=s3_key,
-            Body=csv_buffer.getvalue(),
-            ContentType='text/csv'
-        )
+    Aggregations (stats) give per-shard results, and limit, sort or dedup apply per
+    shard, so the merge would return up to shards x limit rows in the wrong order.
+    """
+    return not re.search(r'(^|\|)\s*(stats|limit|sort|dedup)\b', query_string, re.IGNORECASE)
 
-        logging.info(f"CSV file saved to s3://{ATHENA_OUTPUT_BUCKET}/{s3_key}")
+def query_cloudwatch_shard(query_string, logs_client, log_groups, semaphore, shard, cancelled):
+    """Runs the query over one sub-range, splitting it in two if the results hit the cap.
 
-        # Generate a presigned URL (valid for 24 hours)
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': ATHENA_OUTPUT_BUCKET, 'Key': s3_key},
-            ExpiresIn=604800  # 24 hours
-        )
+    A shard is a dict with its start and end, the query_id once started and the rows once
+    finished. Returns the shards covering the sub-range: the finished ones, and the ones left
+    when the deadline is reached, which keep their query_id so the continuation polls them.
+    A shard that fails is retried once, then the error is raised so the whole job is
+    reported as failed instead of silently missing the rows of that sub-range.
+    """
+    if shard.get('rows') is not None:
+        return [shard]
+
+    start_time, end_time = shard['start'], shard['end']
+    for attempt in range(CLOUDWATCH_SHARD_ATTEMPTS):
+        with semaphore:
+            query_id = shard.get('query_id')
+            if not query_id:
+                if get_time_left() <= 0:
+                    return [shard]
+                if cancelled.is_set():
+                    raise RuntimeError(f"Shard {start_time}-{end_time} cancelled")
+                query_id = execute_cloudwatch_query(query_string, logs_client, log_groups, start_time, end_time)
+            try:
+                if not query_id:
+                    raise RuntimeError(f"Could not start CloudWatch query for shard {start_time}-{end_time}")
+                results = wait_for_cloudwatch_query(query_id, logs_client, cancelled)
+                break
+            except DeadlineExceeded:
+                return [{**shard, 'query_id': query_id}]
+            except RuntimeError as e:
+                shard = {'start': start_time, 'end': end_time}
+                if attempt == CLOUDWATCH_SHARD_ATTEMPTS - 1 or cancelled.is_set():
+                    raise
+                logger.warning(f"Shard {start_time}-{end_time} failed, retrying: {str(e)}")
+
+    if len(results) < CLOUDWATCH_RESULT_LIMIT:
+        return [{'start': start_time, 'end': end_time, 'rows': results}]
 
-        return presigned_url
+    if end_time - start_time <= CLOUDWATCH_MIN_SHARD_SECONDS:
+        logger.warning(f"Shard {start_time}-{end_time} hit the {CLOUDWATCH_RESULT_LIMIT} rows cap and cannot be split further, results are truncated.")
+        return [{'start': start_time, 'end': end_time, 'rows': results}]
 
+    # The slot is released before splitting, so the halves compete for it like any other query
+    middle = start_time + (end_time - start_time) // 2
+    logger.info(f"Shard {start_time}-{end_time} hit the {CLOUDWATCH_RESULT_LIMIT} rows cap, splitting it.")
+    halves = [{'start': start_time, 'end': middle}, {'start': middle, 'end': end_time}]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(query_cloudwatch_shard, query_string, logs_client, log_groups, semaphore, half, cancelled) for half in halves]
+        return [part for future in futures for part in future.result()]
+
+def get_shard_bounds(shards=CLOUDWATCH_SHARDS):
+    """Splits the report window in shards of the same length."""
+    start_time, end_time = get_cloudwatch_window()
+    step = (end_time - start_time) // shards
+    return [
+        {'start': start_time + i * step, 'end': end_time if i == shards - 1 else start_time + (i + 1) * step}
+        for i in range(shards)
+    ]
+
+def run_sharded_cloudwatch_query(query_string, logs_client, log_groups, semaphore, shards):
+    """Runs the query over the shards of the report window, and merges the rows in time order.
+
+    Returns the merged rows, or None and the shards when the deadline is reached first: the
+    finished shards keep their rows and the running ones their query_id, so a continuation
+    only runs what is left. When a shard fails, the other shards are stopped.
+    """
+    cancelled = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [
+            executor.submit(query_cloudwatch_shard, query_string, logs_client, log_groups, semaphore, shard, cancelled)
+            for shard in shards
+        ]
+        try:
+            # A failure is noticed as soon as it happens, not after the shards before it
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            cancelled.set()
+            raise
+        shards = [part for future in futures for part in future.result()]
+
+    if any(shard.get('rows') is None for shard in shards):
+        return None, shards
+
+    # Shards are already in window order, sorting is stable for rows without @timestamp
+    results = [row for shard in shards for row in shard['rows']]
+    results.sort(key=get_result_timestamp)
+    return results, None
+
+def run_cloudwatch_job(job, logs_client, semaphore):
+    """Runs one CloudWatch job, holding a slot of its account's semaphore while the query runs.
+
+    Returns (status, None) when the job is done, or (None, job) when the deadline is
+    reached first. The returned job keeps its query_id if the query was already started,
+    or its shards (finished rows and running query IDs) for a sharded query.
+    """
+    query_title = job['title']
+    query_string = job['query']
+    cache_key = get_query_cache_key(query_string, {'account': job['account'], 'log_groups': sorted(job['log_groups'])})
+
+    try:
+        if get_time_left() <= 0:
+            return None, job
+
+        cached_status = get_cached_status(query_title, query_string, cache_key)
+        if cached_status:
+            return cached_status, None
+
+        if job.get('shards') or (CLOUDWATCH_SHARDS > 1 and can_shard_cloudwatch_query(query_string) and not job.get('query_id')):
+            logger.info(f"Executing CloudWatch query: {query_title} in {job['account']} ({CLOUDWATCH_SHARDS} shards)")
+            results, shards = run_sharded_cloudwatch_query(query_string, logs_client, job['log_groups'], semaphore,
+                                                           job.get('shards') or get_shard_bounds())
+            if shards:
+                return None, {**job, 'shards': shards}
+        else:
+            with semaphore:
+                if get_time_left() <= 0:
+                    return None, job
+                logger.info(f"Executing CloudWatch query: {query_title} in {job['account']}")
+                query_id = job.get('query_id') or execute_cloudwatch_query(query_string, logs_client, job['log_groups'])
+                if not query_id:
+                    logger.error(f"Query execution failed: {query_title}")
+                    return {'title': query_title, 'query': query_string, 'status': 'FAILED', 'result_url': None}, None
+                try:
+                    results = wait_for_cloudwatch_query(query_id, logs_client)
+                except DeadlineExceeded:
+                    return None, {**job, 'query_id': query_id}
+
+        # The slot is released before writing the results, S3 does not count against the Insights limit
+        filename = f"{job['account']}_{query_title.replace(' ', '_')}.csv"
+        s3_key = get_csv_s3_key(filename)
+        if results:
+            presigned_url = save_results_to_s3_csv(results, filename, cache_key, s3_key)
+        else:
+            presigned_url = "No results available"
+
+        return {
+            'title': query_title,
+            'query': query_string,
+            'status': 'SUCCEEDED' if results else 'NO RESULTS',
+            'result_url': presigned_url,
+            's3_path': f"s3://{ATHENA_OUTPUT_BUCKET}/{s3_key}" if results else None
+        }, None
+    except DeadlineExceeded:
+        # Nothing started yet for this job, the continuation runs it
+        return None, job
     except Exception as e:
-        logging.error(f"Error saving CSV to S3: {str(e)}", exc_info=True)
-        return "Error generating file"
+        logger.error(f"Error executing CloudWatch query {query_title}: {str(e)}", exc_info=True)
+        return {'title': query_title, 'query': query_string, 'status': 'FAILED', 'result_url': None}, None
+
+def run_cloudwatch_jobs(jobs, max_concurrent_per_account=CLOUDWATCH_MAX_CONCURRENT_QUERIES):
+    """Runs CloudWatch jobs concurrently across accounts, capping concurrent queries per account.
+
+    Each job is a dict with account, log_groups, title and query. Every account has its
+    own executor sized to the cap, so the jobs of a saturated account queue behind each
+    other without holding back the jobs of the other accounts.
+    Returns the statuses and the jobs left pending when the deadline is reached.
+    """
+    if not jobs:
+        return [], []
+
+    accounts = list(dict.fromkeys(job['account'] for job in jobs))
+    logs_clients = {}
+    semaphores = {}
+    for account in accounts:
+        try:
+            logs_clients[account] = assume_role(account, 'Cloudwatch_Reports', 'logs')
+        except Exception as e:
+            logger.error(f"Could not assume role in CloudWatch account {account}: {str(e)}")
+        semaphores[account] = threading.BoundedSemaphore(max_concurrent_per_account)
+
+    runnable = [job for job in jobs if job['account'] in logs_clients]
+    queries_status = [
+        {'title': job['title'], 'query': job['query'], 'status': 'FAILED', 'result_url': None}
+        for job in jobs if job['account'] not in logs_clients
+    ]
+    pending_jobs = []
+    if not runnable:
+        return queries_status, pending_jobs
+
+    executors = {
+        account: ThreadPoolExecutor(max_workers=min(max_concurrent_per_account, sum(1 for job in runnable if job['account'] == account)))
+        for account in dict.fromkeys(job['account'] for job in runnable)
+    }
+    try:
+        futures = [
+            executors[job['account']].submit(run_cloudwatch_job, job, logs_clients[job['account']], semaphores[job['account']])
+            for job in runnable
+        ]
+        # Keep the report in the same order as the configured jobs
+        for future in futures:
+            query_status, pending_job = future.result()
+            if query_status:
+                queries_status.append(query_status)
+            else:
+                pending_jobs.append(pending_job)
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+    return queries_status, pending_jobs
 
 def execute_query(query, database):
     """Starts an Athena query and handles errors."""
@@ -209,9 +915,9 @@ def execute_query(query, database):
         logger.error("Traceback: " + traceback.format_exc())
         raise
 
-def wait_for_query(query_execution_id, timeout=180):
-    """Waits for the Athena query to complete, with a timeout."""
-    start_time = time.time()
+def wait_for_query(query_execution_id):
+    """Waits for the Athena query to complete, until the report deadline (DeadlineExceeded)."""
+    attempt = 0
 
     while True:
         response = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
@@ -224,10 +930,257 @@ def wait_for_query(query_execution_id, timeout=180):
             logger.error(f"Query {query_execution_id} failed with status: {status}. Reason: {reason}")
             return status
 
-        if time.time() - start_time > timeout:
-            raise TimeoutError(f"Query {query_execution_id} timed out after {timeout} seconds.")
+        wait_before_poll(attempt)  # Wait before checking again
+        attempt += 1
+
+def sql_list(values):
+    """Renders values as a SQL list of string literals."""
+    return ', '.join("'" + value.replace("'", "''") + "'" for value in values)
+
+def get_report_parameters():
+    """Returns the values injected in the Athena query placeholders, for the current report window."""
+    end_date = datetime.datetime.now(datetime.timezone.utc).date()
+    start_date = end_date - datetime.timedelta(days=REPORT_WINDOW_DAYS)
+    start = start_date.strftime(ATHENA_DATE_FORMAT)
+    end = end_date.strftime(ATHENA_DATE_FORMAT)
+
+    predicates = [f"{ATHENA_DATE_PARTITION} BETWEEN '{start}' AND '{end}'"]
+    if REPORT_ACCOUNTS:
+        predicates.append(f"{ATHENA_ACCOUNT_PARTITION} IN ({sql_list(REPORT_ACCOUNTS)})")
+    if REPORT_REGIONS:
+        predicates.append(f"{ATHENA_REGION_PARTITION} IN ({sql_list(REPORT_REGIONS)})")
+
+    return {
+        'start_date': start,
+        'end_date': end,
+        'accounts': sql_list(REPORT_ACCOUNTS),
+        'regions': sql_list(REPORT_REGIONS),
+        'partition_filter': '(' + ' AND '.join(predicates) + ')'
+    }
+
+def has_partition_predicate(where_clause, column):
+    """True when the column is compared directly (=, <, >, BETWEEN, IN...), which Athena can prune on.
+
+    A column only used inside an expression, like CAST(column AS ...) > ..., is not a predicate
+    on the partition and still scans the whole table.
+    """
+    column = rf'"?\b{re.escape(column)}\b"?'
+    operator = r"(?:[<>!]?=|<>|<|>)"
+    # Column on the left (not followed by a closing parenthesis), or on the right of a comparison
+    left = rf'{column}\s*(?:{operator}|\bbetween\b|\bin\b)'
+    # On the right side, "timestamp ''" is a timestamp literal, not the column
+    right = rf"{operator}\s*{column}(?!\s*'')"
+    return bool(re.search(left, where_clause, re.IGNORECASE) or re.search(right, where_clause, re.IGNORECASE))
 
-        time.sleep(2)  # Wait before checking again
+def prepare_athena_query(query_string):
+    """Replaces the {{placeholders}} of a query with the report window values.
+
+    Returns the rendered query and a warning when it does not restrict on the date
+    partition, since Athena would then scan the whole CloudTrail history. Raises
+    ValueError when the query uses a list placeholder that has no values.
+    """
+    for name, value in get_report_parameters().items():
+        placeholder = '{{' + name + '}}'
+        if not value and placeholder in query_string:
+            # IN () is a syntax error, {{partition_filter}} leaves empty lists out instead
+            raise ValueError(f"Query uses {placeholder} but REPORT_{name.upper()} is empty, use {{{{partition_filter}}}} instead")
+        query_string = query_string.replace(placeholder, value)
+
+    # String literals are blanked, so a value like 'timestamp' does not count as a predicate
+    query_code = re.sub(r"'(?:[^']|'')*'", "''", normalize_query(query_string))
+    where_clause = re.search(r'\bwhere\b(.*)', query_code, re.IGNORECASE | re.DOTALL)
+    if where_clause and has_partition_predicate(where_clause.group(1), ATHENA_DATE_PARTITION):
+        return query_string, None
+
+    return query_string, f"Query does not filter on the partition column {ATHENA_DATE_PARTITION}, it scans the whole table"
+
+def get_failed_status(title, query_string, error):
+    """Status of a query that could not be fetched or started, so it still shows up in the report."""
+    return {'title': title, 'query': query_string, 'status': 'FAILED', 'result_url': None, 'warning': error}
+
+def get_rejected_status(title, query_string, warning):
+    """Status of a query that is not executed: it does not use partition pruning, or cannot be rendered."""
+    logger.error(f"Skipping Athena query {title}: {warning}")
+    return {'title': title, 'query': query_string, 'status': 'REJECTED', 'result_url': None, 'warning': warning}
+
+def prepare_named_query(named_query, database):
+    """Renders the query of a named query and looks it up in the cache.
+
+    Returns the query status when it does not need to run (cache hit or rejected), None otherwise.
+    """
+    try:
+        named_query['QueryString'], named_query['Warning'] = prepare_athena_query(named_query['QueryString'])
+    except ValueError as e:
+        return get_rejected_status(named_query['Name'], named_query['QueryString'], str(e))
+    if named_query['Warning'] and ATHENA_REQUIRE_PARTITION_FILTER:
+        return get_rejected_status(named_query['Name'], named_query['QueryString'], named_query['Warning'])
+
+    named_query['CacheKey'] = get_query_cache_key(named_query['QueryString'], database)
+    return get_cached_status(named_query['Name'], named_query['QueryString'], named_query['CacheKey'])
+
+def get_athena_query_status(named_query, execution):
+    """Builds the report status of a finished Athena execution."""
+    status = execution['Status']['State']
+    result_url = None
+    result_location = None
+
+    if status == 'SUCCEEDED':
+        result_location = execution['ResultConfiguration']['OutputLocation']
+        logger.info(f"Athena Query results available at: {result_location}")
+        result_url = generate_presigned_url(result_location)
+        cache_result(named_query['CacheKey'], result_location)
+    else:
+        reason = execution['Status'].get('StateChangeReason', 'Unknown reason')
+        logger.error(f"Query {execution['QueryExecutionId']} failed with status: {status}. Reason: {reason}")
+
+    return {
+        'title': named_query['Name'],
+        'query': named_query['QueryString'],
+        'status': status,
+        'result_url': result_url,
+        's3_path': result_location if status == 'SUCCEEDED' else None,
+        'data_scanned': execution.get('Statistics', {}).get('DataScannedInBytes'),
+        'warning': named_query['Warning']
+    }
+
+def run_athena_queries(query_ids, database, running=None):
+    """Runs the named Athena queries one after the other.
+
+    running holds executions started by a previous invocation, they are only polled.
+    Returns the statuses and what is left when the deadline is reached: the executions
+    still running and the query IDs not started yet.
+    """
+    queries_status = []
+    running = dict(running or {})
+
+    for query_execution_id, named_query in list(running.items()):
+        try:
+            wait_for_query(query_execution_id)
+            execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+            queries_status.append(get_athena_query_status(named_query, execution))
+        except DeadlineExceeded:
+            return queries_status, {'executions': running, 'query_ids': list(query_ids)}
+        except Exception as e:
+            logger.error(f"Error executing Athena query: {str(e)}")
+        del running[query_execution_id]
+
+    for i, query_id in enumerate(query_ids):
+        if get_time_left() <= 0:
+            return queries_status, {'executions': {}, 'query_ids': list(query_ids[i:])}
+
+        query_execution_id = None
+        named_query = None
+        try:
+            named_query = athena_client.get_named_query(NamedQueryId=query_id)['NamedQuery']
+            query_status = prepare_named_query(named_query, database)
+            if query_status:
+                queries_status.append(query_status)
+                continue
+
+            query_execution_id = execute_query(named_query['QueryString'], database)
+            wait_for_query(query_execution_id)
+            execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+            queries_status.append(get_athena_query_status(named_query, execution))
+        except DeadlineExceeded:
+            return queries_status, {'executions': {query_execution_id: named_query}, 'query_ids': list(query_ids[i + 1:])}
+        except Exception as e:
+            logger.error(f"Error executing Athena query: {str(e)}")
+            if named_query:
+                queries_status.append(get_failed_status(named_query['Name'], named_query['QueryString'], str(e)))
+            else:
+                queries_status.append(get_failed_status(query_id, f"Named query {query_id}", str(e)))
+            continue
+
+    return queries_status, {'executions': {}, 'query_ids': []}
+
+def get_named_queries(query_ids):
+    """Fetches the named queries in batches, preserving the requested order.
+
+    Returns the named queries found and the error of every query ID that could not be fetched.
+    """
+    named_queries = {}
+    errors = {}
+
+    for i in range(0, len(query_ids), ATHENA_BATCH_SIZE):
+        batch = query_ids[i:i + ATHENA_BATCH_SIZE]
+        try:
+            response = call_with_retries(athena_client.batch_get_named_query, NamedQueryIds=batch)
+        except Exception as e:
+            logger.error(f"Could not get named queries {batch}: {str(e)}")
+            errors.update((query_id, str(e)) for query_id in batch)
+            continue
+        for named_query in response.get('NamedQueries', []):
+            named_queries[named_query['NamedQueryId']] = named_query
+        for unprocessed in response.get('UnprocessedNamedQueryIds', []):
+            logger.error(f"Could not get named query {unprocessed.get('NamedQueryId')}: {unprocessed.get('ErrorMessage')}")
+            errors[unprocessed.get('NamedQueryId')] = unprocessed.get('ErrorMessage') or 'Unknown error'
+
+    return [named_queries[query_id] for query_id in query_ids if query_id in named_queries], errors
+
+def run_athena_queries_fanout(query_ids, database, running=None, max_concurrent=ATHENA_MAX_CONCURRENT_QUERIES):
+    """Starts all Athena queries (up to max_concurrent at once) and polls them together.
+
+    running holds executions started by a previous invocation, they are only polled.
+    Returns the statuses and what is left when the deadline is reached: the executions
+    still running and the query IDs not started yet.
+    """
+    pending = []
+    running = dict(running or {})  # QueryExecutionId -> named query
+    queries_status = {}
+    order = [named_query['NamedQueryId'] for named_query in running.values()] + list(query_ids)
+
+    named_queries, errors = get_named_queries(query_ids)
+    for query_id, error in errors.items():
+        queries_status[query_id] = get_failed_status(query_id, f"Named query {query_id}", error)
+
+    for named_query in named_queries:
+        query_status = prepare_named_query(named_query, database)
+        if query_status:
+            queries_status[named_query['NamedQueryId']] = query_status
+        else:
+            pending.append(named_query)
+
+    attempt = 0
+    while pending or running:
+        # Fill the free slots, unless the time budget is over
+        while pending and len(running) < max_concurrent and get_time_left() > 0:
+            named_query = pending.pop(0)
+            try:
+                query_execution_id = execute_query(named_query['QueryString'], database)
+                running[query_execution_id] = named_query
+                attempt = 0
+            except Exception as e:
+                logger.error(f"Error executing Athena query {named_query['Name']}: {str(e)}")
+                queries_status[named_query['NamedQueryId']] = get_failed_status(named_query['Name'], named_query['QueryString'], str(e))
+
+        if not running:
+            break
+
+        try:
+            wait_before_poll(attempt)  # Wait before checking again
+        except DeadlineExceeded:
+            break
+        attempt += 1
+
+        execution_ids = list(running)
+        for i in range(0, len(execution_ids), ATHENA_BATCH_SIZE):
+            try:
+                response = call_with_retries(athena_client.batch_get_query_execution, QueryExecutionIds=execution_ids[i:i + ATHENA_BATCH_SIZE])
+            except Exception as e:
+                # The executions stay running and are polled again on the next round
+                logger.error(f"Error polling Athena queries: {str(e)}")
+                continue
+
+            for execution in response.get('QueryExecutions', []):
+                if execution['Status']['State'] not in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+                    continue
+
+                named_query = running.pop(execution['QueryExecutionId'])
+                queries_status[named_query['NamedQueryId']] = get_athena_query_status(named_query, execution)
+
+    # Keep the report in the same order as the configured query IDs
+    ordered_status = [queries_status[query_id] for query_id in order if query_id in queries_status]
+    return ordered_status, {'executions': running, 'query_ids': [named_query['NamedQueryId'] for named_query in pending]}
 
 def generate_presigned_url(s3_path, expiration=604800):
     """Generates a presigned URL for the given S3 file."""
@@ -246,19 +1199,40 @@ def generate_presigned_url(s3_path, expiration=604800):
 
     return None
 
+def format_bytes(size):
+    """Human readable size, for the data scanned by Athena."""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
 def generate_report(queries_status):
     """Generate a detailed report including query, status, and presigned URL."""
     report = "Weekly Report: Athena/CloudWatch Queries + User Inventory (From IAM Identity Center)\n"
+    scanned = [query_status['data_scanned'] for query_status in queries_status if query_status.get('data_scanned') is not None]
+    if scanned:
+        report += f"\nTotal Athena Data Scanned: {format_bytes(sum(scanned))}\n"
     for query_status in queries_status:
         query = query_status['query']
         title = query_status['title']
         status = query_status['status']
+        if query_status.get('cached'):
+            status += ' (cached result)'
         result_url = query_status.get('result_url', 'No results available')
 
         report += f"\nTitle: {title}\n"
         report += f"\nQuery: \n{query}\n"
         report += f"\nExecution Status: {status}\n"
+        if query_status.get('data_scanned') is not None:
+            report += f"\nData Scanned: {format_bytes(query_status['data_scanned'])}\n"
+        if query_status.get('warning'):
+            report += f"\nWarning: {query_status['warning']}\n"
         report += f"\nReport URL: {result_url}\n"  # Provide downloadable URL
+        if query_status.get('enriched_url'):
+            report += f"\nReport URL (with user emails): {query_status['enriched_url']}\n"
+        if query_status.get('snapshot_url'):
+            report += f"\nFull Snapshot URL: {query_status['snapshot_url']}\n"
         report += f"\n"
         report += "-" * 50  # Separator for clarity
         report += f"\n"
@@ -277,107 +1251,182 @@ def send_sns_report(report):
         logger.error(f"Failed to send SNS message: {str(e)}")
         logger.error("Traceback: " + traceback.format_exc())
 
-def lambda_handler(event, context):
-    queries_status = []
+def get_checkpoint_key(run_id):
+    """Every report run has its own checkpoint, so a manual run never picks up another run's state."""
+    return f"{CHECKPOINT_PREFIX}scheduled-report-{run_id}.json"
 
-    # Array of CloudWatch queries. They need Title and Query, the Log Group is passed in the function
-    cloudwatch_queries = [
-        {"title": "CW_Query Title", "query": "CW_Query"}
-    ]
+def load_checkpoint(checkpoint_key):
+    """Returns the state saved by a previous invocation that ran out of time, or None."""
+    if not checkpoint_key or not checkpoint_key.startswith(CHECKPOINT_PREFIX):
+        logger.error(f"Invalid checkpoint key: {checkpoint_key}")
+        return None
 
-    # Array of Athena query IDs to be executed. The function assumes they are in the same account
-    athena_query_ids = [
-        "Query_ID_1",
-        "Query_ID_2",
-        "Query_ID_3"
-    ]
-    database = ATHENA_DB_NAME
-    
-    named_query = ""
-    query_title = ""
-    query_string = ""
+    try:
+        state = json.loads(s3_client.get_object(Bucket=ATHENA_OUTPUT_BUCKET, Key=checkpoint_key)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        logger.error(f"Error reading checkpoint: {str(e)}")
+        return None
 
-    user_ids = ""
+    if time.time() - state['created_at'] > CHECKPOINT_MAX_AGE_HOURS * 3600:
+        logger.warning(f"Ignoring stale checkpoint {checkpoint_key}.")
+        delete_checkpoint(checkpoint_key)
+        return None
 
-   # Execute Athena Queries
-    for query_id in athena_query_ids:
-        try:
-            named_query = athena_client.get_named_query(NamedQueryId=query_id)
-            query_string = named_query['NamedQuery']['QueryString']
-            query_title = named_query['NamedQuery']['Name']
-            
-            query_execution_id = execute_query(query_string, database)
-            status = wait_for_query(query_execution_id)
-            result_url = None
-
-            if status == 'SUCCEEDED':
-                result_location = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']['ResultConfiguration']['OutputLocation']
-                logger.info(f"Athena Query results available at: {result_location}")
-                result_url = generate_presigned_url(result_location)
-            else:
-                logger.error(f"Athena Query failed with status: {status}")
+    logger.info(f"Resuming report from checkpoint (continuation {state['continuations']}).")
+    return state
 
-            queries_status.append({
-                'title': query_title,
-                'query': query_string,
-                'status': status,
-                'result_url': result_url
-            })
-        except Exception as e:
-            logger.error(f"Error executing Athena query: {str(e)}")
-            continue
-          
- 
-    # Assume Role in CloudWatch Logs Account
-    logs_client = assume_role(CLOUDWATCH_ACCOUNT, 'Cloudwatch_Reports', 'logs')
+def save_checkpoint(state):
+    """Saves the completed statuses and the pending work, so the next invocation can resume."""
+    s3_client.put_object(
+        Bucket=ATHENA_OUTPUT_BUCKET,
+        Key=state['checkpoint_key'],
+        Body=json.dumps(state),
+        ContentType='application/json'
+    )
+    logger.info(f"Checkpoint saved to s3://{ATHENA_OUTPUT_BUCKET}/{state['checkpoint_key']}")
 
-    # Execute CloudWatch Queries
-    for query_data in cloudwatch_queries:
-        try:
-            query_title = query_data['title']
-            query_string = query_data['query']
-            logger.info(f"Executing CloudWatch query: {query_title}")
+def delete_checkpoint(checkpoint_key):
+    try:
+        s3_client.delete_object(Bucket=ATHENA_OUTPUT_BUCKET, Key=checkpoint_key)
+    except Exception as e:
+        logger.error(f"Error deleting checkpoint: {str(e)}")
 
-            query_id = execute_cloudwatch_query(query_string, logs_client)
-            if query_id:
-                results = wait_for_cloudwatch_query(query_id, logs_client)
-                logger.info(f"Query Results for {query_title}: {results}")
+def invoke_continuation(context, checkpoint_key):
+    """Invokes this function again (asynchronously) to resume from the checkpoint."""
+    get_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'resume': True, 'checkpoint': checkpoint_key})
+    )
+    logger.info("Continuation invoked.")
 
-                presigned_url = None
-                if results:
-                    presigned_url = save_results_to_s3_csv(results, f"{query_title.replace(' ', '_')}.csv")
-                else:
-                    presigned_url = "No results available"
+def get_running_cloudwatch_queries(job):
+    """Query IDs of a pending CloudWatch job that are still running: its query, or its unfinished shards."""
+    if job.get('query_id'):
+        return [job['query_id']]
+    return [shard['query_id'] for shard in job.get('shards', []) if shard.get('query_id') and shard.get('rows') is None]
 
-                queries_status.append({
-                    'title': query_title,
-                    'query': query_string,
-                    'status': 'SUCCEEDED' if results else 'NO RESULTS',
-                    'result_url': presigned_url
-                })
-                logger.info(f"Query status updated: {queries_status[-1]}")
-            else:
-                logger.error(f"Query execution failed: {query_title}")
+def stop_cloudwatch_jobs(jobs):
+    """Stops the queries of the jobs given up, so they don't keep using the Insights concurrency of their account."""
+    for job in jobs:
+        query_ids = get_running_cloudwatch_queries(job)
+        if not query_ids:
+            continue
+        try:
+            logs_client = assume_role(job['account'], 'Cloudwatch_Reports', 'logs')
         except Exception as e:
-            logger.error(f"Error executing CloudWatch query {query_title}: {str(e)}", exc_info=True)
+            logger.error(f"Could not assume role in CloudWatch account {job['account']} to stop its queries: {str(e)}")
             continue
+        for query_id in query_ids:
+            stop_cloudwatch_query(query_id, logs_client)
+
+def get_unfinished_statuses(state):
+    """Statuses of the work still pending when no continuation is left, so the report lists it."""
+    queries_status = []
+    for query_execution_id, named_query in state['athena_executions'].items():
+        queries_status.append({
+            'title': named_query['Name'],
+            'query': named_query['QueryString'],
+            'status': 'TIMEOUT',
+            'result_url': None,
+            'warning': f"Still running as Athena execution {query_execution_id} when the report was sent"
+        })
+    for query_id in state['athena_query_ids']:
+        queries_status.append({'title': query_id, 'query': f"Named query {query_id}", 'status': 'PENDING', 'result_url': None})
+    for job in state['cloudwatch_jobs']:
+        query_status = {'title': job['title'], 'query': job['query'], 'status': 'PENDING', 'result_url': None}
+        query_ids = get_running_cloudwatch_queries(job)
+        if query_ids:
+            query_status['status'] = 'TIMEOUT'
+            query_status['warning'] = f"Stopped CloudWatch queries {', '.join(query_ids)} still running when the report was sent"
+        queries_status.append(query_status)
+    if state['identity_pending']:
+        queries_status.append({'title': 'Mail - User Correlation', 'query': 'list_users command in Mgmt Account', 'status': 'PENDING', 'result_url': None})
+    return queries_status
+
+def lambda_handler(event, context):
+    cloudwatch_jobs = CLOUDWATCH_JOBS + [
+        {"account": CLOUDWATCH_ACCOUNT, "log_groups": [CLOUDWATCH_LOG_GROUP], **query_data}
+        for query_data in CLOUDWATCH_QUERIES
+    ]
+    athena_query_ids = list(ATHENA_QUERY_IDS)
+    database = ATHENA_DB_NAME
+
+    set_report_deadline(context)
+    # Only continuations resume a checkpoint, any other invocation (schedule, manual run) starts a new report
+    state = None
+    if (event or {}).get('resume'):
+        state = load_checkpoint(event.get('checkpoint'))
+        if state is None:
+            logger.warning("No checkpoint to resume, the report was already sent or is stale.")
+            return {'queries_status': []}
+    if state is None:
+        state = {
+            'checkpoint_key': get_checkpoint_key(getattr(context, 'aws_request_id', None) or uuid.uuid4().hex),
+            'created_at': time.time(),
+            'continuations': 0,
+            'queries_status': [],
+            'athena_executions': {},
+            'athena_query_ids': athena_query_ids,
+            'cloudwatch_jobs': cloudwatch_jobs,
+            'identity_pending': True,
+            'enrich_pending': IDENTITY_JOIN
+        }
+    queries_status = state['queries_status']
+
+   # Execute Athena Queries
+    run_athena = run_athena_queries_fanout if ATHENA_FANOUT else run_athena_queries
+    athena_status, athena_pending = run_athena(state['athena_query_ids'], database, state['athena_executions'])
+    queries_status.extend(athena_status)
+    state['athena_executions'] = athena_pending['executions']
+    state['athena_query_ids'] = athena_pending['query_ids']
+
+    # Execute CloudWatch Queries
+    cloudwatch_status, state['cloudwatch_jobs'] = run_cloudwatch_jobs(state['cloudwatch_jobs'])
+    queries_status.extend(cloudwatch_status)
 
     logger.info(f"Final queries_status: {queries_status}")
 
     # Assume Role in Management Account
-    identity_client = assume_role(MGMT_ACCT, 'Lambda_Reports', 'identitystore')
-    user_ids = execute_userID_commands(identity_client)
-    if user_ids:
-        presigned_url = save_dicts_to_s3_csv(user_ids, filename='identity-center-users.csv')
-        queries_status.append({
-                    'title': 'Mail - User Correlation',
-                    'query': 'list_users command in Mgmt Account',
-                    'status': 'SUCCEEDED' if results else 'NO RESULTS',
-                    'result_url': presigned_url
-                })
-    else:
-        presigned_url = "No results available"    
+    if (state['identity_pending'] or state['enrich_pending']) and get_time_left() > 0:
+        identity_client = assume_role(MGMT_ACCT, 'Lambda_Reports', 'identitystore')
+        user_ids = execute_userID_commands(identity_client)
+        if state['enrich_pending']:
+            user_index = build_user_index(user_ids)
+            # Results left when the deadline is reached, or not available yet, are enriched by the continuation
+            queries_pending = state['athena_executions'] or state['athena_query_ids'] or state['cloudwatch_jobs']
+            state['enrich_pending'] = not enrich_query_results(queries_status, user_index) or bool(queries_pending)
+
+        if state['identity_pending'] and get_time_left() > 0:
+            if IDENTITY_INCREMENTAL:
+                queries_status.append(run_incremental_inventory(identity_client, user_ids))
+            elif user_ids:
+                presigned_url = save_dicts_to_s3_csv(user_ids, filename='identity-center-users.csv')
+                queries_status.append({
+                            'title': 'Mail - User Correlation',
+                            'query': 'list_users command in Mgmt Account',
+                            'status': 'SUCCEEDED' if user_ids else 'NO RESULTS',
+                            'result_url': presigned_url
+                        })
+            state['identity_pending'] = False
+
+    # Out of time: checkpoint the pending work and let the next invocation finish it
+    pending = (state['athena_executions'] or state['athena_query_ids'] or state['cloudwatch_jobs']
+               or state['identity_pending'] or state['enrich_pending'])
+    if pending and state['continuations'] < MAX_CONTINUATIONS:
+        state['continuations'] += 1
+        save_checkpoint(state)
+        invoke_continuation(context, state['checkpoint_key'])
+        return {'queries_status': queries_status, 'checkpoint': state['checkpoint_key']}
 
+    if pending:
+        logger.error(f"Report still incomplete after {MAX_CONTINUATIONS} continuations, sending partial results.")
+        queries_status.extend(get_unfinished_statuses(state))
+        stop_cloudwatch_jobs(state['cloudwatch_jobs'])
+    if state['continuations']:
+        delete_checkpoint(state['checkpoint_key'])
 
     # Generate report and send via SNS
     if queries_status:
@@ -0,0 +1,121 @@
+"""
+Local benchmark of the CSV export to S3: peak RSS against row count.
+
+Compares the previous approach (whole CSV in a StringIO + getvalue + put_object)
+with the streaming multipart writer. S3 is replaced by a stand-in that only counts
+bytes, so no AWS account or network access is needed (boto3 must be installed).
+
+Usage:
+    python benchmark_csv_export.py [--rows 10000 100000 1000000] [--gzip]
+"""
+import argparse
+import csv
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'shared'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+class CountingS3Client:
+    """Stand-in for the S3 client that discards the uploaded bytes."""
+
+    def __init__(self):
+        self.bytes_uploaded = 0
+        self.calls = 0
+
+    def _body(self, body):
+        self.calls += 1
+        self.bytes_uploaded += len(body)
+
+    def put_object(self, Body, **kwargs):
+        self._body(Body)
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls += 1
+        return {'UploadId': 'benchmark'}
+
+    def upload_part(self, Body, PartNumber, **kwargs):
+        self._body(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls += 1
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls += 1
+
+    def generate_presigned_url(self, *args, **kwargs):
+        return 'https://example.com/presigned'
+
+
+def generate_rows(count):
+    for i in range(count):
+        yield {
+            'UserId': f'90676b0d-{i:012d}',
+            'Email': f'user{i}@example.com',
+            'eventName': 'ConsoleLogin',
+            'sourceIPAddress': f'10.0.{i % 256}.{i % 251}'
+        }
+
+
+def legacy_export(s3_client, rows):
+    rows = list(rows)
+    csv_buffer = io.StringIO()
+    writer = csv.DictWriter(csv_buffer, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+    s3_client.put_object(Bucket='benchmark', Key='legacy.csv', Body=csv_buffer.getvalue(), ContentType='text/csv')
+
+
+def run_single(mode, rows, gzip):
+    """Runs one export in this process and prints: rows, peak RSS (MiB), seconds, bytes, S3 calls."""
+    os.environ['CSV_GZIP'] = 'true' if gzip else 'false'
+    import scheduled_reports
+
+    s3_client = CountingS3Client()
+    scheduled_reports.s3_client = s3_client
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == 'legacy':
+        legacy_export(s3_client, generate_rows(rows))
+    else:
+        scheduled_reports.save_dicts_to_s3_csv(generate_rows(rows), 'benchmark.csv')
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in KiB on Linux
+    print(rows, round((peak - baseline) / 1024, 1), round(elapsed, 2), s3_client.bytes_uploaded, s3_client.calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 500000, 1000000])
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--single', choices=['legacy', 'streaming'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single, args.rows[0], args.gzip)
+        return
+
+    print(f"{'mode':<10} {'rows':>9} {'peak RSS (MiB)':>15} {'seconds':>8} {'bytes':>12} {'S3 calls':>9}")
+    for mode in ['legacy', 'streaming']:
+        for rows in args.rows:
+            # Every run gets its own process, ru_maxrss never goes down
+            command = [sys.executable, __file__, '--single', mode, '--rows', str(rows)]
+            if args.gzip:
+                command.append('--gzip')
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout.split()
+            count, peak, elapsed, uploaded, calls = output[-5:]
+            print(f"{mode:<10} {count:>9} {peak:>15} {elapsed:>8} {uploaded:>12} {calls:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""
+Offline benchmark of the scheduled report pipeline (lambda_handler) with simulated AWS latency.
+
+Athena, CloudWatch Logs, S3, SNS, STS, Identity Store and Lambda are replaced by local
+stand-ins that answer after a configurable latency. Queries "run" for a configurable
+duration and return a configurable number of rows. No AWS account or network access is
+needed, only boto3/botocore installed (the stand-ins replace boto3.client).
+
+Reported: wall time, API calls per operation, peak Python memory, and the polling
+overhead (time between a query finishing and the Lambda noticing it).
+
+Usage:
+    python benchmark_report_pipeline.py --athena-queries 20 --cloudwatch-jobs 5 --rows 10000
+    python benchmark_report_pipeline.py --fanout --query-duration 3 --jitter 2
+    python benchmark_report_pipeline.py --fanout --max-wall-seconds 30 --json results.json  # CI regression gate
+"""
+import argparse
+import collections
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions')
+SHARED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'shared')
+
+
+class Simulation:
+    """Shared state of the stand-ins: configuration, API call counters and query timings."""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.queries = {}  # query ID -> {'done_at': float, 'noticed_at': float or None}
+        self.ids = itertools.count(1)
+
+    def call(self, service, operation):
+        with self.lock:
+            self.calls[f"{service}.{operation}"] += 1
+        time.sleep(self.args.latency / 1000)
+
+    def start_query(self, prefix):
+        duration = max(0.0, self.args.query_duration + self.random.uniform(-self.args.jitter, self.args.jitter))
+        with self.lock:
+            query_id = f"{prefix}-{next(self.ids)}"
+            self.queries[query_id] = {'done_at': time.time() + duration, 'noticed_at': None}
+        return query_id
+
+    def is_done(self, query_id):
+        query = self.queries[query_id]
+        if time.time() < query['done_at']:
+            return False
+        with self.lock:
+            if query['noticed_at'] is None:
+                query['noticed_at'] = time.time()
+        return True
+
+    def polling_overhead(self):
+        delays = [q['noticed_at'] - q['done_at'] for q in self.queries.values() if q['noticed_at'] is not None]
+        return (sum(delays) / len(delays), max(delays)) if delays else (0.0, 0.0)
+
+
+def result_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['eventtime', 'eventname', 'userid', 'sourceipaddress'])
+    for i in range(rows):
+        writer.writerow([f'2025-01-01T00:00:{i % 60:02d}Z', 'ConsoleLogin', f'user-{i % 1000}', f'10.0.{i % 256}.1'])
+    return buffer.getvalue().encode('utf-8')
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class FakeClient:
+    """Base stand-in: every method call counts as an API call and waits the simulated latency."""
+
+    service = None
+
+    def __init__(self, simulation):
+        self.sim = simulation
+
+    def __getattribute__(self, name):
+        attribute = object.__getattribute__(self, name)
+        if callable(attribute) and not name.startswith('_') and name not in ('service', 'sim', 'exceptions'):
+            simulation = object.__getattribute__(self, 'sim')
+            service = object.__getattribute__(self, 'service')
+
+            def counted(*args, **kwargs):
+                simulation.call(service, name)
+                return attribute(*args, **kwargs)
+            return counted
+        return attribute
+
+
+class FakeAthena(FakeClient):
+    service = 'athena'
+
+    def _named_query(self, query_id):
+        return {
+            'NamedQueryId': query_id,
+            'Name': f'Benchmark {query_id}',
+            'Database': 'cloudtrail',
+            'QueryString': f"SELECT * FROM cloudtrail_logs WHERE {{{{partition_filter}}}} AND eventname = '{query_id}'"
+        }
+
+    def get_named_query(self, NamedQueryId):
+        return {'NamedQuery': self._named_query(NamedQueryId)}
+
+    def batch_get_named_query(self, NamedQueryIds):
+        return {'NamedQueries': [self._named_query(query_id) for query_id in NamedQueryIds], 'UnprocessedNamedQueryIds': []}
+
+    def start_query_execution(self, **kwargs):
+        return {'QueryExecutionId': self.sim.start_query('athena')}
+
+    def _execution(self, query_execution_id):
+        done = self.sim.is_done(query_execution_id)
+        return {
+            'QueryExecutionId': query_execution_id,
+            'Status': {'State': 'SUCCEEDED' if done else 'RUNNING'},
+            'ResultConfiguration': {'OutputLocation': f's3://athena-scheduled-reports/athena-results/{query_execution_id}.csv'},
+            'Statistics': {'DataScannedInBytes': self.sim.args.rows * 200}
+        }
+
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': self._execution(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        return {'QueryExecutions': [self._execution(query_id) for query_id in QueryExecutionIds], 'UnprocessedQueryExecutionIds': []}
+
+
+class FakeLogs(FakeClient):
+    service = 'logs'
+
+    def start_query(self, **kwargs):
+        return {'queryId': self.sim.start_query('logs')}
+
+    def get_query_results(self, queryId):
+        if not self.sim.is_done(queryId):
+            return {'status': 'Running', 'results': []}
+        rows = min(self.sim.args.rows, 10000)
+        return {
+            'status': 'Complete',
+            'results': [
+                [{'field': '@timestamp', 'value': f'2025-01-01 00:00:{i % 60:02d}.000'}, {'field': '@message', 'value': f'event {i}'}]
+                for i in range(rows)
+            ]
+        }
+
+
+class FakeS3(FakeClient):
+    service = 's3'
+
+    def __init__(self, simulation):
+        super().__init__(simulation)
+        self.objects = {}
+        self.bytes_uploaded = 0
+        self.exceptions = type('Exceptions', (), {'NoSuchKey': NoSuchKey})
+
+    def _store(self, key, body):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.bytes_uploaded += len(body)
+        # Only small objects (cache entries, checkpoints, pointers) are kept
+        self.objects[key] = body if len(body) < 1024 * 1024 else b''
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._store(Key, Body)
+
+    def get_object(self, Bucket, Key):
+        if Key.startswith('athena-results/'):
+            return {'Body': io.BytesIO(result_csv(self.sim.args.rows))}
+        if Key not in self.objects:
+            raise NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'benchmark'}
+
+    def upload_part(self, Body, PartNumber, **kwargs):
+        self.bytes_uploaded += len(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def abort_multipart_upload(self, **kwargs):
+        pass
+
+    def generate_presigned_url(self, *args, **kwargs):
+        return f"https://example.com/{kwargs['Params']['Key']}"
+
+
+class FakeSNS(FakeClient):
+    service = 'sns'
+
+    def publish(self, **kwargs):
+        return {'MessageId': 'benchmark'}
+
+
+class FakeSTS(FakeClient):
+    service = 'sts'
+
+    def assume_role(self, **kwargs):
+        return {'Credentials': {'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret', 'SessionToken': 'token', 'Expiration': None}}
+
+    def get_caller_identity(self):
+        return {'Account': '111111111111'}
+
+
+class FakeIdentityStore(FakeClient):
+    service = 'identitystore'
+
+    def list_users(self, IdentityStoreId, MaxResults=50, NextToken=None):
+        start = int(NextToken or 0)
+        end = min(start + MaxResults, self.sim.args.users)
+        users = [{'UserId': f'user-{i}', 'Emails': [{'Value': f'user{i}@example.com', 'Primary': True}]} for i in range(start, end)]
+        return {'Users': users, 'NextToken': str(end) if end < self.sim.args.users else None}
+
+    def list_groups(self, **kwargs):
+        return {'Groups': [{'GroupId': 'group-1', 'DisplayName': 'Admins'}]}
+
+    def list_group_memberships_for_member(self, **kwargs):
+        return {'GroupMemberships': [{'GroupId': 'group-1'}]}
+
+
+class FakeLambda(FakeClient):
+    service = 'lambda'
+
+    def invoke(self, **kwargs):
+        return {'StatusCode': 202}
+
+
+class FakeContext:
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:111111111111:function:ScheduledReportsFunction'
+
+    def __init__(self, timeout):
+        self.end = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.end - time.time()) * 1000)
+
+
+def install_fakes(simulation):
+    """Replaces boto3.client and boto3 Sessions so every client created by the Lambda is a stand-in."""
+    import boto3
+
+    s3 = FakeS3(simulation)
+    factories = {
+        'athena': FakeAthena, 'logs': FakeLogs, 'sns': FakeSNS, 'sts': FakeSTS,
+        'identitystore': FakeIdentityStore, 'lambda': FakeLambda
+    }
+
+    def client(service_name, *args, **kwargs):
+        if service_name == 's3':
+            return s3
+        return factories[service_name](simulation)
+
+    class Session:
+        region_name = 'us-east-1'
+
+        def __init__(self, **kwargs):
+            pass
+
+        def client(self, service_name, *args, **kwargs):
+            return client(service_name)
+
+    boto3.client = client
+    boto3.session.Session = Session
+    return s3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--athena-queries', type=int, default=10, help='Number of Athena named queries')
+    parser.add_argument('--cloudwatch-jobs', type=int, default=3, help='Number of CloudWatch jobs')
+    parser.add_argument('--cloudwatch-accounts', type=int, default=1, help='Accounts the CloudWatch jobs are spread over')
+    parser.add_argument('--rows', type=int, default=1000, help='Rows returned by each query')
+    parser.add_argument('--users', type=int, default=500, help='Identity Center users')
+    parser.add_argument('--latency', type=float, default=20, help='Latency of every API call, in ms')
+    parser.add_argument('--query-duration', type=float, default=2, help='Mean query duration, in seconds')
+    parser.add_argument('--jitter', type=float, default=1, help='Random +/- variation of the query duration, in seconds')
+    parser.add_argument('--timeout', type=float, default=900, help='Simulated Lambda timeout, in seconds')
+    parser.add_argument('--fanout', action='store_true', help='Enable ATHENA_FANOUT')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='Extra environment variable for the Lambda')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true', help='Keep the Lambda INFO logs')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--max-wall-seconds', type=float, help='Exit with an error if the wall time is above this value')
+    parser.add_argument('--max-api-calls', type=int, help='Exit with an error if the API calls are above this value')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.update({
+        'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:ScheduledReportsTopic',
+        'IDENTITY_STORE': 'd-0000000000',
+        'MGMT_ACCT': '222222222222',
+        'ATHENA_DB_NAME': 'cloudtrail',
+        'CLOUDWATCH_ACCOUNT': '333333333333',
+        'CLOUDWATCH_LOG_GROUP': 'benchmark-log-group',
+        'ATHENA_FANOUT': 'true' if args.fanout else 'false'
+    })
+    for variable in args.env:
+        name, value = variable.split('=', 1)
+        os.environ[name] = value
+
+    simulation = Simulation(args)
+    s3 = install_fakes(simulation)
+
+    sys.path[:0] = [FUNCTIONS_DIR, SHARED_DIR]
+    import scheduled_reports
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    scheduled_reports.ATHENA_QUERY_IDS = [f'query-{i}' for i in range(args.athena_queries)]
+    scheduled_reports.CLOUDWATCH_QUERIES = []
+    scheduled_reports.CLOUDWATCH_JOBS = [
+        {'account': f'{100000000000 + i % args.cloudwatch_accounts}', 'log_groups': ['benchmark-log-group'],
+         'title': f'CW job {i}', 'query': f'fields @timestamp, @message | limit 10000 | filter job = {i}'}
+        for i in range(args.cloudwatch_jobs)
+    ]
+
+    simulation.calls.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    response = scheduled_reports.lambda_handler({}, FakeContext(args.timeout))
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations = [q['done_at'] for q in simulation.queries.values()]
+    mean_overhead, max_overhead = simulation.polling_overhead()
+    poll_calls = sum(count for operation, count in simulation.calls.items()
+                     if operation in ('athena.get_query_execution', 'athena.batch_get_query_execution', 'logs.get_query_results'))
+    results = {
+        'athena_queries': args.athena_queries,
+        'cloudwatch_jobs': args.cloudwatch_jobs,
+        'rows': args.rows,
+        'fanout': args.fanout,
+        'wall_seconds': round(wall, 3),
+        'api_calls': sum(simulation.calls.values()),
+        'poll_calls': poll_calls,
+        'polling_overhead_mean_seconds': round(mean_overhead, 3),
+        'polling_overhead_max_seconds': round(max_overhead, 3),
+        'peak_memory_mib': round(peak / 1024 / 1024, 1),
+        's3_bytes_uploaded': s3.bytes_uploaded,
+        'queries_reported': len(response['queries_status']),
+        'checkpointed': 'checkpoint' in response,
+        'calls': dict(sorted(simulation.calls.items()))
+    }
+
+    print(f"Queries: {args.athena_queries} Athena + {args.cloudwatch_jobs} CloudWatch, {args.rows} rows each, {len(durations)} executions")
+    for name in ['wall_seconds', 'api_calls', 'poll_calls', 'polling_overhead_mean_seconds',
+                 'polling_overhead_max_seconds', 'peak_memory_mib', 's3_bytes_uploaded', 'queries_reported', 'checkpointed']:
+        print(f"  {name:<32} {results[name]}")
+    print("  API calls per operation:")
+    for operation, count in results['calls'].items():
+        print(f"    {operation:<40} {count}")
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    failed = False
+    if args.max_wall_seconds is not None and wall > args.max_wall_seconds:
+        print(f"FAIL: wall time {wall:.2f}s above {args.max_wall_seconds}s")
+        failed = True
+    if args.max_api_calls is not None and results['api_calls'] > args.max_api_calls:
+        print(f"FAIL: {results['api_calls']} API calls above {args.max_api_calls}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
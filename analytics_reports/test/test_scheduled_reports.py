@@ -0,0 +1,181 @@
+"""
+Tests of the CloudWatch jobs of scheduled_reports (sharding, shard retries, checkpoints), on the
+stand-ins of benchmark_report_pipeline. No AWS access is needed, only boto3 installed.
+
+Usage:
+    python -m pytest analytics_reports/test
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+
+import boto3
+import pytest
+
+import benchmark_report_pipeline as benchmark
+
+sys.path[:0] = [benchmark.FUNCTIONS_DIR, benchmark.SHARED_DIR]
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """Returns a function loading scheduled_reports with the stand-ins: (module, simulation, s3)"""
+    def load(env=None, **overrides):
+        args = argparse.Namespace(athena_queries=0, cloudwatch_jobs=1, cloudwatch_accounts=1, rows=10, users=5, latency=0,
+                                  query_duration=0.05, jitter=0, timeout=900, fanout=False, seed=42)
+        for name, value in overrides.items():
+            setattr(args, name, value)
+        for name, value in {'AWS_DEFAULT_REGION': 'us-east-1', 'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:test',
+                            'IDENTITY_STORE': 'd-0000000000', 'MGMT_ACCT': '222222222222', 'ATHENA_DB_NAME': 'cloudtrail',
+                            'CLOUDWATCH_ACCOUNT': '333333333333', 'CLOUDWATCH_LOG_GROUP': 'test-log-group', **(env or {})}.items():
+            monkeypatch.setenv(name, value)
+
+        # install_fakes replaces them for good, they are restored after the test
+        monkeypatch.setattr(boto3, 'client', boto3.client)
+        monkeypatch.setattr(boto3.session, 'Session', boto3.session.Session)
+        simulation = benchmark.Simulation(args)
+        s3 = benchmark.install_fakes(simulation)
+        # Clients cached by a previous test belong to its stand-ins
+        importlib.import_module('cross_account').clear_cache()
+        sys.modules.pop('scheduled_reports', None)
+        scheduled_reports = importlib.import_module('scheduled_reports')
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+        scheduled_reports.ATHENA_QUERY_IDS = []
+        scheduled_reports.CLOUDWATCH_QUERIES = []
+        scheduled_reports.CLOUDWATCH_JOBS = [
+            {'account': '100000000000', 'log_groups': ['test-log-group'], 'title': f'CW job {i}', 'query': f'fields @timestamp | filter job = {i}'}
+            for i in range(args.cloudwatch_jobs)
+        ]
+        scheduled_reports.POLL_MIN_SECONDS = 0.01
+        return scheduled_reports, simulation, s3
+    return load
+
+
+@pytest.fixture
+def shard_starts(monkeypatch):
+    """Records the start time of every CloudWatch query: query ID -> startTime"""
+    starts = {}
+    start_query = benchmark.FakeLogs.start_query
+
+    def recorded(self, **kwargs):
+        response = start_query(self, **kwargs)
+        starts[response['queryId']] = kwargs['startTime']
+        return response
+    monkeypatch.setattr(benchmark.FakeLogs, 'start_query', recorded)
+    return starts
+
+
+@pytest.fixture
+def stopped(monkeypatch):
+    stopped = []
+    monkeypatch.setattr(benchmark.FakeLogs, 'stop_query', lambda self, queryId: stopped.append(queryId) or {'success': True}, raising=False)
+    return stopped
+
+
+def fail_queries(monkeypatch, should_fail):
+    """Completed queries for which should_fail(queryId) is true report Failed instead"""
+    get_query_results = benchmark.FakeLogs.get_query_results
+
+    def results(self, queryId):
+        response = get_query_results(self, queryId)
+        if response['status'] == 'Complete' and should_fail(queryId):
+            return {'status': 'Failed', 'results': []}
+        return response
+    monkeypatch.setattr(benchmark.FakeLogs, 'get_query_results', results)
+
+
+def run_chain(scheduled_reports, s3, monkeypatch, timeout, max_invocations=20):
+    """Runs lambda_handler and its continuations (read from the checkpoint) until the report is sent"""
+    payloads = []
+    monkeypatch.setattr(benchmark.FakeLambda, 'invoke', lambda self, **kwargs: payloads.append(json.loads(kwargs['Payload'])) or {'StatusCode': 202})
+    event = {}
+    for _ in range(max_invocations):
+        response = scheduled_reports.lambda_handler(event, benchmark.FakeContext(timeout))
+        if 'checkpoint' not in response:
+            return response, len(payloads)
+        event = payloads[-1]
+        assert event['checkpoint'] in s3.objects
+    pytest.fail(f"Report not finished after {max_invocations} invocations")
+
+
+def job_statuses(response):
+    """Statuses of the CloudWatch jobs, without the identity inventory"""
+    return [query['status'] for query in response['queries_status'] if query['title'].startswith('CW job')]
+
+
+def test_failed_shard_is_retried(pipeline, shard_starts, monkeypatch):
+    failures = []
+
+    def fail_first_shard_once(query_id):
+        if not failures and shard_starts[query_id] == min(shard_starts.values()):
+            failures.append(query_id)
+            return True
+        return False
+    fail_queries(monkeypatch, fail_first_shard_once)
+    scheduled_reports, simulation, _ = pipeline(env={'CLOUDWATCH_SHARDS': '4'})
+
+    response = scheduled_reports.lambda_handler({}, benchmark.FakeContext(900))
+
+    assert job_statuses(response) == ['SUCCEEDED']
+    assert len(failures) == 1
+    # 4 shards and the retry of the failed one
+    assert simulation.calls['logs.start_query'] == 5
+
+
+def test_shard_failing_every_attempt_fails_the_job(pipeline, shard_starts, stopped, monkeypatch):
+    fail_queries(monkeypatch, lambda query_id: shard_starts[query_id] == min(shard_starts.values()))
+    scheduled_reports, _, _ = pipeline(env={'CLOUDWATCH_SHARDS': '4'})
+
+    response = scheduled_reports.lambda_handler({}, benchmark.FakeContext(900))
+
+    assert job_statuses(response) == ['FAILED']
+    first_start = min(shard_starts.values())
+    assert list(shard_starts.values()).count(first_start) == scheduled_reports.CLOUDWATCH_SHARD_ATTEMPTS
+
+
+@pytest.mark.parametrize('status', ['Timeout', 'Unknown', 'SomethingNew'])
+def test_unfinished_query_status_fails_the_job(pipeline, monkeypatch, status):
+    monkeypatch.setattr(benchmark.FakeLogs, 'get_query_results', lambda self, queryId: {'status': status, 'results': []})
+    scheduled_reports, _, _ = pipeline()
+
+    response = scheduled_reports.lambda_handler({}, benchmark.FakeContext(900))
+
+    assert job_statuses(response) == ['FAILED']
+
+
+def test_sharded_job_resumes_its_shards_from_the_checkpoint(pipeline, monkeypatch):
+    scheduled_reports, simulation, s3 = pipeline(env={'CLOUDWATCH_SHARDS': '4', 'DEADLINE_SAFETY_SECONDS': '0', 'MAX_CONTINUATIONS': '20'},
+                                                 query_duration=0.6)
+
+    response, continuations = run_chain(scheduled_reports, s3, monkeypatch, timeout=0.2)
+
+    assert continuations > 0
+    assert job_statuses(response) == ['SUCCEEDED']
+    # Every shard is started once, the continuations poll the checkpointed query IDs
+    assert simulation.calls['logs.start_query'] == 4
+
+
+def test_running_shards_are_stopped_when_the_continuations_run_out(pipeline, stopped, monkeypatch):
+    scheduled_reports, simulation, s3 = pipeline(env={'CLOUDWATCH_SHARDS': '4', 'DEADLINE_SAFETY_SECONDS': '0', 'MAX_CONTINUATIONS': '1'},
+                                                 query_duration=5)
+
+    response, continuations = run_chain(scheduled_reports, s3, monkeypatch, timeout=0.2)
+
+    assert continuations == 1
+    assert job_statuses(response) == ['TIMEOUT']
+    assert len(set(stopped)) == simulation.calls['logs.start_query'] == 4
+
+
+def test_accounts_run_their_jobs_side_by_side(pipeline):
+    scheduled_reports, _, _ = pipeline(query_duration=0.3)
+    jobs = [{'account': account, 'log_groups': ['test-log-group'], 'title': f'{account} {i}', 'query': f'fields @timestamp | filter job = {i}'}
+            for account in ('111111111111', '222222222222') for i in range(4)]
+
+    statuses, pending = scheduled_reports.run_cloudwatch_jobs(jobs, max_concurrent_per_account=2)
+
+    assert not pending
+    assert [query['status'] for query in statuses] == ['SUCCEEDED'] * len(jobs)
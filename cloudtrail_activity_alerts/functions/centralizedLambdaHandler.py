@@ -1,6 +1,10 @@
 import boto3
 import os
 import logging
+import hashlib
+import time
+from botocore.config import Config
+from collections import OrderedDict
 from datetime import datetime
 import json
 
@@ -13,60 +17,627 @@ DOUBLE_LINE_LENGTH = 47
 
 HEADER_TEXT = 'New CloudTrail Alert\n'
 
+# Repeats of an alert (same event, account, user and source IP) within this window are not sent,
+# they are collapsed into one summary alert. 0: disabled
+DEDUP_WINDOW_SECONDS = int(os.getenv('DEDUP_WINDOW_SECONDS', '0'))
+# Open windows of the shared table cached by each container (least recently used are evicted)
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', '1000'))
+# DynamoDB table shared by every container, required by the window
+DEDUP_TABLE = os.getenv('DEDUP_TABLE')
+
+if DEDUP_WINDOW_SECONDS > 0 and not DEDUP_TABLE:
+    # Counts kept only in memory would be lost with the container, and the summary never sent
+    logger.warning("DEDUP_WINDOW_SECONDS is set without DEDUP_TABLE, repeated alerts are not deduplicated")
+    DEDUP_WINDOW_SECONDS = 0
+
+dynamodb = boto3.client('dynamodb') if DEDUP_TABLE else None
+
+# SNS PublishBatch accepts up to 10 messages and 256 KB per call
+PUBLISH_BATCH_SIZE = 10
+PUBLISH_BATCH_BYTES = 256 * 1024
+
+# Rule set routing the events by severity: JSON file bundled next to the handler, or S3 object.
+# Empty: every event is sent to SNS_TOPIC_ARN
+RULES_FILE = os.getenv('RULES_FILE')
+RULES_S3_BUCKET = os.getenv('RULES_S3_BUCKET')
+RULES_S3_KEY = os.getenv('RULES_S3_KEY')
+# Severity -> SNS topic ARN (JSON). Severities without a topic use SNS_TOPIC_ARN
+SEVERITY_TOPIC_ARNS = json.loads(os.getenv('SEVERITY_TOPIC_ARNS') or '{}')
+
+# From the most to the least severe. 'ignore' drops the event
+SEVERITIES = ('ignore', 'critical', 'high', 'medium', 'low', 'info')
+
+# Compiled rule index, loaded once per container
+rule_index = None
+
+# Request parameters and resources are rendered as compact JSON, truncated to this size (bytes) each
+ALERT_FIELD_BUDGET_BYTES = int(os.getenv('ALERT_FIELD_BUDGET_BYTES', '8192'))
+# Messages are cut to this size, under the 256 KB SNS limit
+ALERT_MAX_MESSAGE_BYTES = int(os.getenv('ALERT_MAX_MESSAGE_BYTES', str(64 * 1024)))
+# SNS subjects are limited to 100 characters
+SUBJECT_MAX_LENGTH = 100
+# Bucket where the full event detail of the truncated alerts is stored, linked in the message. Empty: disabled
+ALERT_DETAIL_BUCKET = os.getenv('ALERT_DETAIL_BUCKET')
+ALERT_DETAIL_PREFIX = os.getenv('ALERT_DETAIL_PREFIX', 'alert-details/')
+# Validity of the presigned links (7 days at most, and never longer than the Lambda role credentials)
+ALERT_LINK_EXPIRATION_SECONDS = int(os.getenv('ALERT_LINK_EXPIRATION_SECONDS', '86400'))
+
+s3 = boto3.client('s3', config=Config(signature_version='s3v4')) if ALERT_DETAIL_BUCKET else None
+
+# Alert key -> open window: {'alert', 'window_start', 'window_end', 'last_seen', 'suppressed'}
+windows = OrderedDict()
+
+
 def handler(event, context):
-    
+
     SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
 
     try:
+        now = time.time()
+
+        # Scheduled flush: summaries of the windows closed with suppressed repeats
+        if event.get('detail-type') == 'Scheduled Event':
+            summaries = flush_windows(now, shared=True)
+            for topic_arn, subject, message in summary_messages(summaries, SNS_TOPIC_ARN):
+                sns.publish(TopicArn=topic_arn, Subject=subject, Message=message)
+            return {
+                'statusCode': 200,
+                'body': json.dumps(f'{len(summaries)} summaries sent')
+            }
+
+        # With EnableAlertQueue, the member rules target CloudTrailAlertQueue and the alerts come in SQS batches
+        if 'Records' in event:
+            return handle_sqs_batch(event['Records'], SNS_TOPIC_ARN, now)
+
         # Extract the CloudTrail event detail
         detail = event.get('detail', {})
+        alert = parse_alert(detail)
 
-        # Extract relevant fields
-        event_name = detail.get('eventName')
-        event_source = detail.get('eventSource')
-        user_identity = detail.get('userIdentity', {})
-        account_id = detail.get('recipientAccountId') or user_identity.get('accountId')
-        user_type = user_identity.get('type')
-        user = user_identity.get('userName') or user_identity.get('principalId')
-        source_ip = detail.get('sourceIPAddress')
-        time = detail.get('eventTime')
-        region = detail.get('awsRegion')
-        request_params = detail.get('requestParameters')
-        resources = detail.get('resources', [])
-
-        # Format email content
-        subject = f"New CloudTrail Alert: {event_name} in {account_id}"
-        message = f"""
-    🔔 CloudTrail Alert Triggered
+        if not route_alert(alert, detail):
+            logger.info(f"Event ignored by the rules: {alert['event_name']} in {alert['account_id']}")
+            return {
+                'statusCode': 200,
+                'body': json.dumps('Event ignored by the rules')
+            }
 
-        📌 Event: {event_name}
-        📌 Source: {event_source}
-        📌 Account ID: {account_id}
-        📌 Region: {region}
-        👤 User Type: {user_type}
-        👤 User: {user}
-        🌍 Source IP: {source_ip}
-        🕒 Time: {time}
+        send, summaries = check_repeats(alert, now)
+        for topic_arn, subject, message in summary_messages(summaries, SNS_TOPIC_ARN):
+            sns.publish(TopicArn=topic_arn, Subject=subject, Message=message)
 
-        🧾 Request Parameters:
-        {json.dumps(request_params, indent=2)}
+        if not send:
+            logger.info(f"Repeated alert suppressed: {alert['event_name']} in {alert['account_id']} by {alert['user']} from {alert['source_ip']}")
+            return {
+                'statusCode': 200,
+                'body': json.dumps('Repeated alert suppressed')
+            }
 
-        📦 Resources:
-        {json.dumps(resources, indent=2)}
-        """
+        subject, message = render_alert(alert)
         # Publish to SNS
-        sns.publish(
-            TopicArn=SNS_TOPIC_ARN,
-            Subject=f"CloudTrail Alert: {event_name} in {account_id}",
-            Message=message
-        )
+        try:
+            sns.publish(
+                TopicArn=topic_for(alert.get('severity'), SNS_TOPIC_ARN),
+                Subject=subject,
+                Message=message
+            )
+        except Exception:
+            # The retry must not be taken for a repeat
+            forget_window(alert)
+            raise
         return {
             'statusCode': 200,
             'body': json.dumps('Alert sent successfully!')
         }
-    
+
     except Exception as e:
         print("Error:", str(e))
         raise
 
 
+def parse_alert(detail):
+    """Relevant fields of a CloudTrail event detail"""
+    user_identity = detail.get('userIdentity', {})
+    return {
+        'event_name': detail.get('eventName'),
+        'event_source': detail.get('eventSource'),
+        'account_id': detail.get('recipientAccountId') or user_identity.get('accountId'),
+        'region': detail.get('awsRegion'),
+        'user_type': user_identity.get('type'),
+        'user': user_identity.get('userName') or user_identity.get('principalId'),
+        'source_ip': detail.get('sourceIPAddress'),
+        'time': detail.get('eventTime'),
+        'request_params': detail.get('requestParameters'),
+        'resources': detail.get('resources', []),
+        'detail': detail
+    }
+
+
+def render_alert(alert):
+    """Returns the email subject and content of an alert, within the size limits. When a field is
+    truncated, the full event detail is stored in S3 and linked in the message"""
+    severity = f"        🚦 Severity: {alert['severity']} (rule: {alert['rule'] or 'default'})\n" if alert.get('severity') else ''
+    request_params, params_truncated = compact_json(alert['request_params'], ALERT_FIELD_BUDGET_BYTES)
+    resources, resources_truncated = compact_json(alert['resources'], ALERT_FIELD_BUDGET_BYTES)
+    full_detail = store_detail(alert) if params_truncated or resources_truncated else ''
+    message = f"""
+    🔔 CloudTrail Alert Triggered
+
+{severity}        📌 Event: {alert['event_name']}
+        📌 Source: {alert['event_source']}
+        📌 Account ID: {alert['account_id']}
+        📌 Region: {alert['region']}
+        👤 User Type: {alert['user_type']}
+        👤 User: {alert['user']}
+        🌍 Source IP: {alert['source_ip']}
+        🕒 Time: {alert['time']}
+{full_detail}
+        🧾 Request Parameters:
+        {request_params}
+
+        📦 Resources:
+        {resources}
+        """
+    subject = f"{severity_prefix(alert)}CloudTrail Alert: {alert['event_name']} in {alert['account_id']}"
+    return truncate(subject, SUBJECT_MAX_LENGTH), truncate(message, ALERT_MAX_MESSAGE_BYTES)
+
+
+def compact_json(value, budget):
+    """Compact JSON of a field (keys sorted, so the same event renders the same), cut to the budget.
+    Returns the text and whether it was truncated"""
+    text = json.dumps(value, separators=(',', ':'), sort_keys=True, default=str)
+    size = len(text.encode())
+    if size <= budget:
+        return text, False
+    return f"{truncate(text, budget)} [truncated, {size} bytes]", True
+
+
+def truncate(text, max_bytes):
+    """Cuts a text to max_bytes of UTF-8, on a character boundary"""
+    data = text.encode()
+    if len(data) <= max_bytes:
+        return text
+    return data[:max_bytes - 3].decode('utf-8', 'ignore') + '...'
+
+
+def store_detail(alert):
+    """Stores the full event detail in S3. Returns the message lines linking it, empty if disabled or failed"""
+    if not ALERT_DETAIL_BUCKET:
+        return '        ⚠️ Truncated fields, the full event is in CloudTrail\n'
+    detail = alert['detail']
+    body = json.dumps(detail, indent=2, default=str).encode()
+    # Same event, same key: retries overwrite the object
+    event_id = detail.get('eventID') or hashlib.sha256(body).hexdigest()
+    key = f"{ALERT_DETAIL_PREFIX}{alert['account_id']}/{str(alert['time'])[:10]}/{event_id}.json"
+    try:
+        s3.put_object(Bucket=ALERT_DETAIL_BUCKET, Key=key, Body=body, ContentType='application/json')
+        url = s3.generate_presigned_url('get_object', Params={'Bucket': ALERT_DETAIL_BUCKET, 'Key': key},
+                                        ExpiresIn=ALERT_LINK_EXPIRATION_SECONDS)
+    except Exception as e:
+        # The alert is sent anyway, truncated
+        logger.warning(f"Failed to store the detail of {event_id}: {e}")
+        return '        ⚠️ Truncated fields, the full event is in CloudTrail\n'
+    return f"        🔗 Full event: {url}\n        (s3://{ALERT_DETAIL_BUCKET}/{key})\n"
+
+
+def severity_prefix(alert):
+    return f"[{alert['severity'].upper()}] " if alert.get('severity') else ''
+
+
+def topic_for(severity, default_topic_arn):
+    return SEVERITY_TOPIC_ARNS.get(severity) or default_topic_arn
+
+
+def get_rule_index():
+    """Loads and compiles the rule set on the first call of the container. None without rule set"""
+    global rule_index
+    if rule_index is None and (RULES_FILE or RULES_S3_BUCKET):
+        try:
+            if RULES_S3_BUCKET:
+                body = boto3.client('s3').get_object(Bucket=RULES_S3_BUCKET, Key=RULES_S3_KEY)['Body'].read()
+            else:
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), RULES_FILE)) as rules_file:
+                    body = rules_file.read()
+            rule_index = compile_rules(json.loads(body))
+            logger.info(f"{rule_index['rules']} rules loaded")
+        except Exception as e:
+            # Every event is sent until the rules can be loaded (next invocation)
+            logger.error(f"Failed to load the rules: {e}")
+    return rule_index
+
+
+def route_alert(alert, detail):
+    """Adds the severity and rule of the event to the alert. Returns False if the rules ignore it"""
+    index = get_rule_index()
+    if index is None:
+        return True
+    alert['severity'], alert['rule'] = match_rules(index, detail)
+    return alert['severity'] != 'ignore'
+
+
+MISSING = object()
+
+
+def as_list(value):
+    if value is None:
+        return [None]
+    return value if isinstance(value, list) else [value]
+
+
+def compile_rules(rule_set):
+    """Compiles the rules into an index by (eventSource, eventName), None standing for any.
+    Each bucket is sorted by severity and then by position in the rule set, so the first match wins"""
+    index = {}
+    rules = rule_set.get('rules', [])
+    for order, rule in enumerate(rules):
+        name = rule.get('name', f'rule-{order}')
+        severity = rule.get('severity', 'info')
+        if severity not in SEVERITIES:
+            raise ValueError(f"Unknown severity {severity} in rule {name}")
+        compiled = (SEVERITIES.index(severity), order, name, severity,
+                    tuple(compile_condition(path, pattern) for path, pattern in rule.get('conditions', {}).items()))
+        for source in as_list(rule.get('eventSource')):
+            for event_name in as_list(rule.get('eventName')):
+                index.setdefault((source, event_name), []).append(compiled)
+
+    default_severity = rule_set.get('default_severity', 'info')
+    if default_severity not in SEVERITIES:
+        raise ValueError(f"Unknown default severity {default_severity}")
+    for bucket in index.values():
+        bucket.sort(key=lambda rule: rule[:2])
+    return {'index': index, 'rules': len(rules), 'default_severity': default_severity}
+
+
+def compile_condition(path, pattern):
+    """Predicate of a dotted path of the event detail (e.g. userIdentity.type), with EventBridge-like patterns:
+    list of values, {"prefix": ...}, {"exists": true/false} or {"anything-but": [...]}.
+    List fields match if any of their elements does"""
+    keys = path.split('.')
+
+    def values_of(detail):
+        for key in keys:
+            if not isinstance(detail, dict) or key not in detail:
+                return MISSING
+            detail = detail[key]
+        values = detail if isinstance(detail, list) else [detail]
+        return [value for value in values if not isinstance(value, (dict, list))]
+
+    if isinstance(pattern, dict):
+        if 'exists' in pattern:
+            exists = bool(pattern['exists'])
+            return lambda detail: (values_of(detail) is not MISSING) == exists
+        if 'prefix' in pattern:
+            prefix = pattern['prefix']
+
+            def has_prefix(detail):
+                values = values_of(detail)
+                return values is not MISSING and any(isinstance(value, str) and value.startswith(prefix) for value in values)
+            return has_prefix
+        if 'anything-but' in pattern:
+            excluded = frozenset(as_list(pattern['anything-but']))
+
+            def anything_but(detail):
+                values = values_of(detail)
+                return values is not MISSING and bool(values) and not any(value in excluded for value in values)
+            return anything_but
+        raise ValueError(f"Unsupported pattern for {path}: {pattern}")
+
+    allowed = frozenset(as_list(pattern))
+
+    def is_allowed(detail):
+        values = values_of(detail)
+        return values is not MISSING and any(value in allowed for value in values)
+    return is_allowed
+
+
+def match_rules(index, detail):
+    """Returns the (severity, rule name) of the most severe rule matching the event, or the default severity"""
+    best = None
+    source, event_name = detail.get('eventSource'), detail.get('eventName')
+    for key in ((source, event_name), (source, None), (None, event_name), (None, None)):
+        for rule in index['index'].get(key, ()):
+            if best and rule[:2] >= best[:2]:
+                # Sorted bucket: no better rule left in it
+                break
+            if all(predicate(detail) for predicate in rule[4]):
+                best = rule
+                break
+    return (best[3], best[2]) if best else (index['default_severity'], None)
+
+
+def handle_sqs_batch(records, topic_arn, now):
+    """Renders the alerts of a batch of SQS records and sends them with PublishBatch.
+    Returns the records to retry (partial batch response)"""
+    entries = []  # (record messageId, alert, topic, subject, message). Summaries have no record
+    suppressed = 0
+    ignored = 0
+    for record in records:
+        try:
+            detail = json.loads(record['body']).get('detail', {})
+            alert = parse_alert(detail)
+        except Exception as e:
+            # No alert can be rendered from this body, so it is dropped rather than reported as
+            # a batch failure that would end in the DLQ after the same error on every retry
+            print(f"Invalid record {record.get('messageId')}: {e}")
+            continue
+
+        if not route_alert(alert, detail):
+            ignored += 1
+            continue
+        send, summaries = check_repeats(alert, now)
+        entries += [(None, None) + summary for summary in summary_messages(summaries, topic_arn)]
+        if send:
+            entries.append((record['messageId'], alert, topic_for(alert.get('severity'), topic_arn)) + render_alert(alert))
+        else:
+            suppressed += 1
+
+    # One PublishBatch per topic
+    failed = []
+    for topic in dict.fromkeys(entry[2] for entry in entries):
+        indexes = [index for index, entry in enumerate(entries) if entry[2] == topic]
+        failed += [indexes[i] for i in publish_batch(topic, [entries[index][3:] for index in indexes])]
+    failed_ids = []
+    for index in failed:
+        message_id, alert = entries[index][:2]
+        if message_id:
+            forget_window(alert)
+            failed_ids.append(message_id)
+
+    logger.info(f"{len(records)} records: {len(entries) - len(failed)} messages sent, {ignored} ignored by the rules, "
+                f"{suppressed} repeats suppressed, {len(failed_ids)} records failed")
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in dict.fromkeys(failed_ids)]}
+
+
+def publish_batch(topic_arn, messages):
+    """Publishes (subject, message) pairs in batches within the PublishBatch limits. Returns the indexes of the failed ones"""
+    batches = []
+    size = 0
+    for index, (subject, message) in enumerate(messages):
+        entry_size = len(subject.encode()) + len(message.encode())
+        if not batches or len(batches[-1]) == PUBLISH_BATCH_SIZE or size + entry_size > PUBLISH_BATCH_BYTES:
+            batches.append([])
+            size = 0
+        batches[-1].append(index)
+        size += entry_size
+
+    failed = []
+    for batch in batches:
+        try:
+            response = sns.publish_batch(
+                TopicArn=topic_arn,
+                PublishBatchRequestEntries=[
+                    {'Id': str(index), 'Subject': messages[index][0], 'Message': messages[index][1]} for index in batch
+                ]
+            )
+        except Exception as e:
+            print(f"Failed to publish {len(batch)} messages: {e}")
+            failed += batch
+            continue
+        for entry in response.get('Failed', []):
+            print(f"Failed to publish message {entry['Id']}: {entry.get('Code')} {entry.get('Message')}")
+            failed.append(int(entry['Id']))
+    return failed
+
+
+def check_repeats(alert, now):
+    """Returns whether the alert must be sent, and the windows to summarize"""
+    if DEDUP_WINDOW_SECONDS <= 0:
+        return True, []
+    send, summaries = deduplicate(alert, now)
+    return send, summaries + flush_windows(now)
+
+
+def summary_messages(summaries, default_topic_arn):
+    """(topic, subject, message) of the summaries, sent to the topic of the alert severity"""
+    return [(topic_for(window['alert'].get('severity'), default_topic_arn),) + render_summary(window) for window in summaries]
+
+
+# Fields identifying the repeats of an alert
+ALERT_KEY_FIELDS = ('event_name', 'account_id', 'user', 'source_ip')
+
+
+def alert_key(alert):
+    return '|'.join(str(alert[field]) for field in ALERT_KEY_FIELDS)
+
+
+def deduplicate(alert, now):
+    """Returns whether the alert must be sent (it opens a new window), and the summaries of the
+    windows closed with suppressed repeats"""
+    key = alert_key(alert)
+    cached = windows.get(key)
+
+    if cached and cached['window_end'] > now:
+        window = add_shared_repeats(key, 1, alert['time'], now)
+        if window:
+            cache_window(key, window)
+            return False, []
+        # The shared window is already closed, a new one is opened below
+
+    opened, old = open_shared_window(key, alert, now)
+    if not opened:
+        # Another container opened the window: this alert is a repeat
+        window = add_shared_repeats(key, 1, alert['time'], now)
+        if window:
+            cache_window(key, window)
+            return False, []
+        # The window closed in the meantime: better a duplicate than a lost alert
+        opened, old = open_shared_window(key, alert, now)
+
+    windows.pop(key, None)
+    first_seen = {field: alert.get(field) for field in ALERT_KEY_FIELDS + ('time', 'severity')}
+    cache_window(key, {'alert': first_seen, 'window_start': now, 'window_end': now + DEDUP_WINDOW_SECONDS, 'last_seen': alert['time'], 'suppressed': 0})
+    return True, [old] if old else []
+
+
+def cache_window(key, window):
+    windows[key] = window
+    windows.move_to_end(key)
+    while len(windows) > DEDUP_CACHE_SIZE:
+        # The count stays in the shared table, the scheduled flush sends the summary
+        windows.popitem(last=False)
+
+
+def forget_window(alert):
+    """Drops the window opened by an alert that could not be sent, so its retry is not suppressed"""
+    if DEDUP_WINDOW_SECONDS <= 0:
+        return
+    key = alert_key(alert)
+    window = windows.pop(key, None)
+    if window:
+        try:
+            dynamodb.delete_item(
+                TableName=DEDUP_TABLE,
+                Key={'AlertKey': {'S': key}},
+                ConditionExpression='WindowStart = :window_start',
+                ExpressionAttributeValues={':window_start': {'N': str(window['window_start'])}}
+            )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to delete the shared window of {key}: {e}")
+
+
+def flush_windows(now, shared=False):
+    """Removes the closed windows from the cache and returns the ones with suppressed repeats.
+    shared: also looks for closed windows of other containers in the shared table"""
+    summaries = []
+    for key in [key for key, window in windows.items() if window['window_end'] <= now]:
+        window = windows.pop(key)
+        if window['suppressed'] > 0:
+            claimed = claim_shared_summary(key, window['window_start'])
+            if claimed:
+                summaries.append(claimed)
+
+    if shared and DEDUP_WINDOW_SECONDS > 0:
+        for item in scan_closed_windows(now):
+            claimed = claim_shared_summary(item['AlertKey']['S'], float(item['WindowStart']['N']))
+            if claimed:
+                summaries.append(claimed)
+    return summaries
+
+
+def from_item(item):
+    """Window of a shared table item"""
+    return {
+        'alert': {
+            'event_name': item['EventName']['S'],
+            'account_id': item['AccountId']['S'],
+            'user': item['User']['S'],
+            'source_ip': item['SourceIp']['S'],
+            'time': item['FirstSeen']['S'],
+            'severity': item.get('Severity', {}).get('S')
+        },
+        'window_start': float(item['WindowStart']['N']),
+        'window_end': float(item['WindowEnd']['N']),
+        'last_seen': item['LastSeen']['S'],
+        'suppressed': int(item['Suppressed']['N'])
+    }
+
+
+def open_shared_window(key, alert, now):
+    """Opens a new window in the shared table unless another container has one open. Returns whether
+    it was opened, and the window it replaced if it has suppressed repeats not summarized yet"""
+    severity = {'Severity': {'S': alert['severity']}} if alert.get('severity') else {}
+    try:
+        response = dynamodb.put_item(
+            TableName=DEDUP_TABLE,
+            Item={
+                **severity,
+                'AlertKey': {'S': key},
+                'EventName': {'S': str(alert['event_name'])},
+                'AccountId': {'S': str(alert['account_id'])},
+                'User': {'S': str(alert['user'])},
+                'SourceIp': {'S': str(alert['source_ip'])},
+                'FirstSeen': {'S': str(alert['time'])},
+                'LastSeen': {'S': str(alert['time'])},
+                'WindowStart': {'N': str(now)},
+                'WindowEnd': {'N': str(now + DEDUP_WINDOW_SECONDS)},
+                'Suppressed': {'N': '0'},
+                # DynamoDB TTL, leaves time for the scheduled flush
+                'ExpiresAt': {'N': str(int(now + 2 * DEDUP_WINDOW_SECONDS + 3600))}
+            },
+            ConditionExpression='attribute_not_exists(AlertKey) OR WindowEnd <= :now',
+            ExpressionAttributeValues={':now': {'N': str(now)}},
+            ReturnValues='ALL_OLD'
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False, None
+    except Exception as e:
+        # The alert is sent, its repeats too until the table can be reached again
+        logger.warning(f"Failed to open the shared window of {key}: {e}")
+        return True, None
+
+    old = response.get('Attributes')
+    if old and int(old['Suppressed']['N']) > 0 and 'Summarized' not in old:
+        return True, from_item(old)
+    return True, None
+
+
+def add_shared_repeats(key, count, last_seen, now):
+    """Counts repeats in the open window of the shared table. Returns the window, or None if it is closed"""
+    try:
+        response = dynamodb.update_item(
+            TableName=DEDUP_TABLE,
+            Key={'AlertKey': {'S': key}},
+            UpdateExpression='ADD Suppressed :count SET LastSeen = :last_seen',
+            ConditionExpression='WindowEnd > :now',
+            ExpressionAttributeValues={':count': {'N': str(count)}, ':last_seen': {'S': str(last_seen)}, ':now': {'N': str(now)}},
+            ReturnValues='ALL_NEW'
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return None
+    except Exception as e:
+        logger.warning(f"Failed to count the repeat of {key} in the shared window: {e}")
+        return None
+    return from_item(response['Attributes'])
+
+
+def claim_shared_summary(key, window_start):
+    """Marks a closed window as summarized, so only one container sends its summary. Returns the window if claimed"""
+    try:
+        response = dynamodb.update_item(
+            TableName=DEDUP_TABLE,
+            Key={'AlertKey': {'S': key}},
+            UpdateExpression='SET Summarized = :true',
+            ConditionExpression='WindowStart = :window_start AND attribute_not_exists(Summarized)',
+            ExpressionAttributeValues={':true': {'BOOL': True}, ':window_start': {'N': str(window_start)}},
+            ReturnValues='ALL_NEW'
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return None
+    except Exception as e:
+        logger.warning(f"Failed to claim the summary of {key}: {e}")
+        return None
+    return from_item(response['Attributes'])
+
+
+def scan_closed_windows(now):
+    """Closed windows of the shared table with suppressed repeats not summarized yet"""
+    items = []
+    try:
+        paginator = dynamodb.get_paginator('scan')
+        for page in paginator.paginate(
+            TableName=DEDUP_TABLE,
+            FilterExpression='WindowEnd <= :now AND Suppressed > :zero AND attribute_not_exists(Summarized)',
+            ExpressionAttributeValues={':now': {'N': str(now)}, ':zero': {'N': '0'}}
+        ):
+            items += page['Items']
+    except Exception as e:
+        logger.warning(f"Failed to scan the shared windows: {e}")
+    return items
+
+
+def render_summary(window):
+    """Returns the email subject and content of the summary of a window"""
+    alert = window['alert']
+    message = f"""
+    🔁 CloudTrail Alert Repeated
+
+        📌 Event: {alert['event_name']}
+        📌 Account ID: {alert['account_id']}
+        👤 User: {alert['user']}
+        🌍 Source IP: {alert['source_ip']}
+        🔢 Events: {window['suppressed'] + 1} ({window['suppressed']} not sent after the first alert)
+        🕒 First seen: {alert['time']}
+        🕒 Last seen: {window['last_seen']}
+        """
+    subject = f"{severity_prefix(alert)}CloudTrail Alert: {alert['event_name']} repeated in {alert['account_id']}"
+    return truncate(subject, SUBJECT_MAX_LENGTH), message
@@ -0,0 +1,138 @@
+"""
+Throughput microbenchmark of the alert rule index (centralizedLambdaHandler.py).
+
+Generates a rule set of the given size (rules on eventSource/eventName with field conditions, plus
+some rules for any event) and a stream of synthetic CloudTrail events, and matches every event:
+  - index: compile_rules + match_rules, as in the Lambda
+  - linear: every rule interpreted for every event, in order
+
+Both must return the same (severity, rule) for every event. No AWS access is needed (boto3 must be
+installed, the SNS client is created when the handler is imported).
+
+Usage:
+    python benchmark_rule_index.py --rules 100 500 2000 --events 50000
+"""
+import argparse
+import importlib.util
+import os
+import random
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+HANDLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'centralizedLambdaHandler.py')
+spec = importlib.util.spec_from_file_location('centralizedLambdaHandler', HANDLER)
+alerts = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(alerts)
+
+USER_TYPES = ['IAMUser', 'AssumedRole', 'Root', 'AWSService', 'IdentityCenterUser']
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'sa-east-1']
+
+
+def generate_rules(count, services, names_per_service, rng):
+    rules = []
+    for i in range(count):
+        rule = {'name': f'rule-{i}', 'severity': rng.choice(alerts.SEVERITIES[1:])}
+        if rng.random() > 0.02:
+            service = rng.randrange(services)
+            rule['eventSource'] = f'service{service}.amazonaws.com'
+            if rng.random() > 0.1:
+                rule['eventName'] = [f'Action{rng.randrange(names_per_service)}' for _ in range(rng.randint(1, 3))]
+        conditions = {}
+        if rng.random() < 0.5:
+            conditions['userIdentity.type'] = rng.sample(USER_TYPES, rng.randint(1, 2))
+        if rng.random() < 0.3:
+            conditions['awsRegion'] = {'anything-but': [rng.choice(REGIONS)]}
+        if rng.random() < 0.2:
+            conditions['userIdentity.arn'] = {'prefix': f'arn:aws:iam::{rng.randrange(10):012d}:'}
+        if rng.random() < 0.1:
+            conditions['errorCode'] = {'exists': True}
+        if conditions:
+            rule['conditions'] = conditions
+        rules.append(rule)
+    return {'default_severity': 'info', 'rules': rules}
+
+
+def generate_events(count, services, names_per_service, rng):
+    events = []
+    for _ in range(count):
+        detail = {
+            'eventSource': f'service{rng.randrange(services)}.amazonaws.com',
+            'eventName': f'Action{rng.randrange(names_per_service)}',
+            'awsRegion': rng.choice(REGIONS),
+            'userIdentity': {'type': rng.choice(USER_TYPES), 'arn': f'arn:aws:iam::{rng.randrange(10):012d}:user/u{rng.randrange(100)}'}
+        }
+        if rng.random() < 0.1:
+            detail['errorCode'] = 'AccessDenied'
+        events.append(detail)
+    return events
+
+
+def linear_match(rule_set, detail):
+    """Reference: interprets every rule for every event"""
+    best = None
+    for order, rule in enumerate(rule_set['rules']):
+        if rule.get('eventSource') is not None and detail.get('eventSource') not in alerts.as_list(rule['eventSource']):
+            continue
+        if rule.get('eventName') is not None and detail.get('eventName') not in alerts.as_list(rule['eventName']):
+            continue
+        if all(linear_condition(path, pattern, detail) for path, pattern in rule.get('conditions', {}).items()):
+            rank = (alerts.SEVERITIES.index(rule['severity']), order)
+            if best is None or rank < best[0]:
+                best = (rank, rule)
+    return (best[1]['severity'], best[1]['name']) if best else (rule_set['default_severity'], None)
+
+
+def linear_condition(path, pattern, detail):
+    value = detail
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return isinstance(pattern, dict) and pattern.get('exists') is False
+        value = value[key]
+    values = [v for v in (value if isinstance(value, list) else [value]) if not isinstance(v, (dict, list))]
+    if isinstance(pattern, dict):
+        if 'exists' in pattern:
+            return bool(pattern['exists'])
+        if 'prefix' in pattern:
+            return any(isinstance(v, str) and v.startswith(pattern['prefix']) for v in values)
+        return bool(values) and not any(v in alerts.as_list(pattern['anything-but']) for v in values)
+    return any(v in alerts.as_list(pattern) for v in values)
+
+
+def measure(function, events):
+    start = time.perf_counter()
+    results = [function(detail) for detail in events]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, nargs='+', default=[100, 500, 2000], help='Rule set sizes')
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--names-per-service', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    events = generate_events(args.events, args.services, args.names_per_service, rng)
+    print(f"{args.events} events, {args.services} services x {args.names_per_service} event names")
+    print(f"  {'rules':>6} {'compile':>10} {'index':>16} {'linear':>16} {'speedup':>8}")
+    for count in args.rules:
+        rule_set = generate_rules(count, args.services, args.names_per_service, rng)
+        start = time.perf_counter()
+        index = alerts.compile_rules(rule_set)
+        compile_time = time.perf_counter() - start
+
+        index_time, index_results = measure(lambda detail: alerts.match_rules(index, detail), events)
+        linear_time, linear_results = measure(lambda detail: linear_match(rule_set, detail), events)
+        mismatches = sum(a != b for a, b in zip(index_results, linear_results))
+        if mismatches:
+            raise SystemExit(f"{mismatches} events matched differently with {count} rules")
+
+        print(f"  {count:>6} {compile_time * 1000:7.1f} ms {args.events / index_time:10.0f} ev/s {args.events / linear_time:10.0f} ev/s "
+              f"{linear_time / index_time:7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Offline replay of CloudTrail log files through the Alert Handler Lambda (centralizedLambdaHandler.py).
+
+Reads the CloudTrail log files (.json.gz or .json) of local files/directories or S3 prefixes, and
+runs every record through the handler as the EventBridge event it would be, with the same rule
+matching and rendering. SNS is replaced by a sink: JSON lines with the topic, subject and message of
+every alert (file, or - for stdout), or nothing (only the counts). Files are spread over a process
+pool. Each file is decompressed and decoded as it is read, one record at a time, and the alerts are
+written to a temporary file per log file that is appended to the sink, so the memory used does not
+depend on the size of the files.
+
+It prints the records, alerts sent and events per second, and the matches of each severity and rule,
+so a new rule set can be checked against real activity before the rollout. Repeat windows are
+disabled (they depend on the time of arrival, not on the event time), and so is the S3 storage of
+the truncated alerts.
+
+Usage:
+    python replay_cloudtrail.py ./AWSLogs --rules ../functions/alert_rules.json
+    python replay_cloudtrail.py s3://my-trail-bucket/AWSLogs/o-xxxxxxxxxx/111111111111/CloudTrail/us-east-1/2025/01/ \\
+        --rules s3://my-bucket/alert_rules.json --sink alerts.jsonl --workers 8
+"""
+import argparse
+import codecs
+import gzip
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+HANDLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'centralizedLambdaHandler.py')
+
+# Worker state: handler module, sink file and counts of the file being replayed
+alerts = None
+worker = {}
+
+
+class SinkSNS:
+    """Stands in for the SNS client of the handler"""
+
+    def publish(self, TopicArn, Subject, Message):
+        worker['sent'] += 1
+        if worker['sink_file']:
+            worker['sink_file'].write(json.dumps({'eventID': worker['event_id'], 'topic': TopicArn, 'subject': Subject, 'message': Message}) + '\n')
+        return {'MessageId': worker['event_id']}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        for entry in PublishBatchRequestEntries:
+            self.publish(TopicArn, entry['Subject'], entry['Message'])
+        return {'Successful': [{'Id': entry['Id']} for entry in PublishBatchRequestEntries], 'Failed': []}
+
+
+def init_worker(rules, sink_dir):
+    """Loads the handler once per process, with the sink instead of SNS and no repeat windows"""
+    global alerts
+    os.environ['DEDUP_WINDOW_SECONDS'] = '0'
+    os.environ.pop('DEDUP_TABLE', None)
+    # Truncated alerts are not stored in S3
+    os.environ.pop('ALERT_DETAIL_BUCKET', None)
+    os.environ.setdefault('SNS_TOPIC_ARN', 'replay')
+    spec = importlib.util.spec_from_file_location('centralizedLambdaHandler', HANDLER)
+    alerts = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(alerts)
+    alerts.sns = SinkSNS()
+    if rules:
+        alerts.rule_index = alerts.compile_rules(json.loads(rules))
+
+    # Counts the severity and rule of every event
+    route_alert = alerts.route_alert
+
+    def counting_route_alert(alert, detail):
+        send = route_alert(alert, detail)
+        worker['matches'][(alert.get('severity'), alert.get('rule'))] += 1
+        return send
+    alerts.route_alert = counting_route_alert
+    worker['sink_dir'] = sink_dir
+
+
+def iter_records(stream, chunk_size=1024 * 1024):
+    """Decodes the Records array of a CloudTrail log file one record at a time, reading the text stream in chunks"""
+    decoder = json.JSONDecoder()
+    text = ''
+    while True:
+        start = text.find('"Records"')
+        if start >= 0 and text.find('[', start) >= 0:
+            break
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        text += chunk
+    position = text.index('[', start) + 1
+
+    while True:
+        while position < len(text) and text[position] in ' \t\r\n,':
+            position += 1
+        if position < len(text) and text[position] == ']':
+            return
+        try:
+            record, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            # The record continues in the next chunk (or the file is truncated)
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                if position == len(text):
+                    return
+                raise
+            text = text[position:] + chunk
+            position = 0
+            continue
+        yield record
+
+
+def to_event(record):
+    """EventBridge event of a CloudTrail record, as delivered by the member account rules"""
+    detail_type = 'AWS Console Sign In via CloudTrail' if record.get('eventType') == 'AwsConsoleSignIn' else 'AWS API Call via CloudTrail'
+    return {
+        'version': '0',
+        'id': record.get('eventID'),
+        'detail-type': detail_type,
+        'source': f"aws.{record.get('eventSource', '').split('.')[0]}",
+        'account': record.get('recipientAccountId'),
+        'time': record.get('eventTime'),
+        'region': record.get('awsRegion'),
+        'resources': [],
+        'detail': record
+    }
+
+
+def open_file(path):
+    """Opens a local file or the body of an S3 object as a binary stream"""
+    if path.startswith('s3://'):
+        bucket, key = path[5:].split('/', 1)
+        if 's3' not in worker:
+            import boto3
+            worker['s3'] = boto3.client('s3')
+        return worker['s3'].get_object(Bucket=bucket, Key=key)['Body']
+    return open(path, 'rb')
+
+
+def replay_file(path):
+    worker.update(sent=0, matches=Counter(), event_id=None, sink_file=None)
+    sink_path = None
+    if worker['sink_dir']:
+        sink_fd, sink_path = tempfile.mkstemp(suffix='.jsonl', dir=worker['sink_dir'])
+        worker['sink_file'] = open(sink_fd, 'w')
+    records = 0
+    errors = 0
+    body = open_file(path)
+    try:
+        stream = gzip.GzipFile(fileobj=body) if path.endswith('.gz') else body
+        for record in iter_records(codecs.getreader('utf-8')(stream)):
+            records += 1
+            worker['event_id'] = record.get('eventID')
+            try:
+                alerts.handler(to_event(record), None)
+            except Exception as e:
+                errors += 1
+                print(f"{path}: record {worker['event_id']} failed: {e}", file=sys.stderr)
+    finally:
+        body.close()
+        if worker['sink_file']:
+            worker['sink_file'].close()
+    return {'records': records, 'sent': worker['sent'], 'errors': errors, 'matches': worker['matches'], 'sink_path': sink_path}
+
+
+def list_files(sources):
+    files = []
+    for source in sources:
+        if source.startswith('s3://'):
+            import boto3
+            bucket, _, prefix = source[5:].partition('/')
+            for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+                files += [f"s3://{bucket}/{item['Key']}" for item in page.get('Contents', [])
+                          if item['Key'].endswith(('.json.gz', '.json'))]
+        elif os.path.isdir(source):
+            for root, _, names in os.walk(source):
+                files += [os.path.join(root, name) for name in sorted(names) if name.endswith(('.json.gz', '.json'))]
+        else:
+            files.append(source)
+    return files
+
+
+def read_rules(path):
+    if path.startswith('s3://'):
+        import boto3
+        bucket, key = path[5:].split('/', 1)
+        return boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    with open(path) as rules_file:
+        return rules_file.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='+', help='CloudTrail log files, directories or s3://bucket/prefix')
+    parser.add_argument('--rules', help='Rule set (local path or s3://bucket/key). Default: RULES_FILE / RULES_S3_BUCKET, as the Lambda')
+    parser.add_argument('--sink', help='File for the alerts as JSON lines, - for stdout. Default: only the counts')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes replaying files in parallel')
+    args = parser.parse_args()
+
+    files = list_files(args.sources)
+    if not files:
+        raise SystemExit('No CloudTrail log files found')
+    rules = read_rules(args.rules) if args.rules else None
+    sink = None
+    if args.sink:
+        sink = sys.stdout if args.sink == '-' else open(args.sink, 'w')
+    log = sys.stderr if args.sink == '-' else sys.stdout
+
+    # Workers write the alerts of each file to a temporary file, appended to the sink when the file is done
+    sink_dir = tempfile.mkdtemp(prefix='replay-') if sink else None
+    totals = Counter()
+    matches = Counter()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(rules, sink_dir)) as executor:
+        futures = {executor.submit(replay_file, path): path for path in files}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                result = future.result()
+            except Exception as e:
+                totals['failed_files'] += 1
+                print(f"{futures[future]}: {e}", file=sys.stderr)
+                continue
+            totals.update(records=result['records'], sent=result['sent'], errors=result['errors'])
+            matches.update(result['matches'])
+            if result['sink_path']:
+                with open(result['sink_path']) as part:
+                    shutil.copyfileobj(part, sink)
+                os.remove(result['sink_path'])
+            if done % 100 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{done}/{len(files)} files, {totals['records']} records, {totals['records'] / elapsed:.0f} events/s", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    if sink and sink is not sys.stdout:
+        sink.close()
+    if sink_dir:
+        # Also removes the partial files of the log files that failed
+        shutil.rmtree(sink_dir, ignore_errors=True)
+
+    print(f"{len(files)} files ({totals['failed_files']} failed), {totals['records']} records in {elapsed:.1f} s: "
+          f"{totals['records'] / elapsed:.0f} events/s with {args.workers} workers", file=log)
+    print(f"{totals['sent']} alerts sent, {totals['errors']} records failed", file=log)
+    print(f"  {'severity':<10} {'rule':<40} {'events':>10}", file=log)
+    for (severity, rule), count in matches.most_common():
+        print(f"  {str(severity):<10} {str(rule or 'default'):<40} {count:>10}", file=log)
+
+
+if __name__ == '__main__':
+    main()
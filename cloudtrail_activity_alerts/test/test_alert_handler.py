@@ -0,0 +1,232 @@
+"""
+Tests of the Alert Handler Lambda (repeat windows, SQS batches) with local stand-ins for SNS and the
+DynamoDB table. No AWS access is needed, only boto3 installed.
+
+Usage:
+    python -m pytest cloudtrail_activity_alerts/test
+"""
+import copy
+import importlib.util
+import json
+import os
+import types
+
+import pytest
+
+HANDLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'centralizedLambdaHandler.py')
+TOPIC_ARN = 'arn:aws:sns:us-east-1:111111111111:alerts'
+WINDOW_SECONDS = 300
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+class FakeTable:
+    """Stand-in for the DynamoDB calls of the shared windows, evaluating their conditions"""
+    exceptions = types.SimpleNamespace(ConditionalCheckFailedException=ConditionalCheckFailed)
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeValues, ReturnValues):
+        now = float(ExpressionAttributeValues[':now']['N'])
+        old = self.items.get(Item['AlertKey']['S'])
+        if old and float(old['WindowEnd']['N']) > now:
+            raise ConditionalCheckFailed()
+        self.items[Item['AlertKey']['S']] = copy.deepcopy(Item)
+        return {'Attributes': old} if old else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues, ReturnValues):
+        item = self.items.get(Key['AlertKey']['S'])
+        values = ExpressionAttributeValues
+        if item is None:
+            raise ConditionalCheckFailed()
+        if UpdateExpression.startswith('ADD'):
+            if float(item['WindowEnd']['N']) <= float(values[':now']['N']):
+                raise ConditionalCheckFailed()
+            item['Suppressed'] = {'N': str(int(item['Suppressed']['N']) + int(values[':count']['N']))}
+            item['LastSeen'] = values[':last_seen']
+        else:
+            if item['WindowStart']['N'] != values[':window_start']['N'] or 'Summarized' in item:
+                raise ConditionalCheckFailed()
+            item['Summarized'] = values[':true']
+        return {'Attributes': copy.deepcopy(item)}
+
+    def delete_item(self, TableName, Key, ConditionExpression, ExpressionAttributeValues):
+        item = self.items.get(Key['AlertKey']['S'])
+        if item is None or item['WindowStart']['N'] != ExpressionAttributeValues[':window_start']['N']:
+            raise ConditionalCheckFailed()
+        del self.items[Key['AlertKey']['S']]
+
+    def get_paginator(self, name):
+        def paginate(TableName, FilterExpression, ExpressionAttributeValues):
+            now = float(ExpressionAttributeValues[':now']['N'])
+            return [{'Items': [copy.deepcopy(item) for item in self.items.values()
+                               if float(item['WindowEnd']['N']) <= now and int(item['Suppressed']['N']) > 0 and 'Summarized' not in item]}]
+        return types.SimpleNamespace(paginate=paginate)
+
+
+class FakeSNS:
+    def __init__(self):
+        self.published = []
+        self.batches = []
+        self.fail_subjects = set()
+
+    def publish(self, TopicArn, Subject, Message):
+        if Subject in self.fail_subjects:
+            raise RuntimeError('InternalError')
+        self.published.append(Subject)
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append(PublishBatchRequestEntries)
+        failed = [entry for entry in PublishBatchRequestEntries if entry['Subject'] in self.fail_subjects]
+        self.published += [entry['Subject'] for entry in PublishBatchRequestEntries if entry not in failed]
+        return {'Failed': [{'Id': entry['Id'], 'Code': 'InternalError'} for entry in failed]}
+
+
+@pytest.fixture
+def table():
+    return FakeTable()
+
+
+@pytest.fixture
+def sns():
+    return FakeSNS()
+
+
+@pytest.fixture
+def clock():
+    return [1_000_000.0]
+
+
+@pytest.fixture
+def handler(monkeypatch, table, sns, clock):
+    """Returns a function loading the handler with the environment given and the stand-ins"""
+    def load(**env):
+        for name, value in {'AWS_DEFAULT_REGION': 'us-east-1', 'SNS_TOPIC_ARN': TOPIC_ARN,
+                            'DEDUP_WINDOW_SECONDS': str(WINDOW_SECONDS), 'DEDUP_TABLE': 'alert-windows', **env}.items():
+            if value is None:
+                monkeypatch.delenv(name, raising=False)
+            else:
+                monkeypatch.setenv(name, value)
+        spec = importlib.util.spec_from_file_location('centralizedLambdaHandler', HANDLER)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.sns = sns
+        module.dynamodb = table
+        module.time = types.SimpleNamespace(time=lambda: clock[0])
+        return module
+    return load
+
+
+def event(event_name='CreateUser', user='alice', event_time='2025-01-01T00:00:00Z'):
+    return {'detail': {'eventName': event_name, 'eventSource': 'iam.amazonaws.com', 'recipientAccountId': '111111111111',
+                       'userIdentity': {'type': 'IAMUser', 'userName': user}, 'sourceIPAddress': '10.0.0.1', 'eventTime': event_time}}
+
+
+def record(message_id, body):
+    return {'messageId': message_id, 'body': body if isinstance(body, str) else json.dumps(body)}
+
+
+SCHEDULED = {'detail-type': 'Scheduled Event'}
+
+
+def test_repeats_are_summarized_by_the_scheduled_flush(handler, sns, clock):
+    alerts = handler()
+    for second in range(5):
+        alerts.handler(event(event_time=f'2025-01-01T00:00:0{second}Z'), None)
+    assert sns.published == ['CloudTrail Alert: CreateUser in 111111111111']
+
+    alerts.handler(SCHEDULED, None)
+    assert len(sns.published) == 1  # The window is still open
+
+    clock[0] += WINDOW_SECONDS
+    alerts.handler(SCHEDULED, None)
+    assert sns.published[1:] == ['CloudTrail Alert: CreateUser repeated in 111111111111']
+
+    alerts.handler(SCHEDULED, None)
+    assert len(sns.published) == 2  # Summarized once
+
+
+def test_evicted_windows_are_still_summarized(handler, sns, clock):
+    alerts = handler(DEDUP_CACHE_SIZE='1')
+    for _ in range(3):
+        alerts.handler(event(user='alice'), None)
+        alerts.handler(event(user='bob'), None)
+    assert len(alerts.windows) == 1
+    assert len(sns.published) == 2
+
+    clock[0] += WINDOW_SECONDS
+    alerts.handler(SCHEDULED, None)
+
+    assert sorted(sns.published[2:]) == ['CloudTrail Alert: CreateUser repeated in 111111111111'] * 2
+
+
+def test_containers_share_the_window(handler, sns, clock):
+    first, second = handler(), handler()
+    first.handler(event(), None)
+    second.handler(event(), None)
+    assert len(sns.published) == 1
+
+    clock[0] += WINDOW_SECONDS
+    second.handler(SCHEDULED, None)
+    first.handler(SCHEDULED, None)
+
+    assert sns.published[1:] == ['CloudTrail Alert: CreateUser repeated in 111111111111']
+
+
+def test_window_without_table_does_not_suppress(handler, sns):
+    alerts = handler(DEDUP_TABLE=None)
+    for _ in range(3):
+        alerts.handler(event(), None)
+
+    assert alerts.DEDUP_WINDOW_SECONDS == 0
+    assert len(sns.published) == 3
+
+
+def test_failed_alert_is_not_taken_for_a_repeat(handler, sns):
+    alerts = handler()
+    sns.fail_subjects = {'CloudTrail Alert: CreateUser in 111111111111'}
+    with pytest.raises(RuntimeError):
+        alerts.handler(event(), None)
+    sns.fail_subjects = set()
+
+    alerts.handler(event(), None)
+
+    assert sns.published == ['CloudTrail Alert: CreateUser in 111111111111']
+
+
+def test_batch_reports_only_the_records_not_sent(handler, sns):
+    alerts = handler(DEDUP_WINDOW_SECONDS='0')
+    sns.fail_subjects = {'CloudTrail Alert: DeleteUser in 111111111111'}
+    records = [record('created', event('CreateUser')), record('deleted', event('DeleteUser')),
+               record('malformed', 'not json'), record('attached', event('AttachUserPolicy'))]
+
+    response = alerts.handler({'Records': records}, None)
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'deleted'}]}
+    assert sorted(sns.published) == ['CloudTrail Alert: AttachUserPolicy in 111111111111', 'CloudTrail Alert: CreateUser in 111111111111']
+
+
+def test_retried_record_is_not_suppressed(handler, sns):
+    alerts = handler()
+    sns.fail_subjects = {'CloudTrail Alert: CreateUser in 111111111111'}
+    assert alerts.handler({'Records': [record('first', event())]}, None) == {'batchItemFailures': [{'itemIdentifier': 'first'}]}
+
+    sns.fail_subjects = set()
+    response = alerts.handler({'Records': [record('first', event())]}, None)
+
+    assert response == {'batchItemFailures': []}
+    assert sns.published == ['CloudTrail Alert: CreateUser in 111111111111']
+
+
+def test_batches_stay_within_the_publish_batch_limits(handler, sns):
+    alerts = handler(DEDUP_WINDOW_SECONDS='0')
+    messages = [(f'subject {i}', 'x' * 60 * 1024) for i in range(25)]
+
+    assert alerts.publish_batch(TOPIC_ARN, messages) == []
+
+    assert all(len(batch) <= alerts.PUBLISH_BATCH_SIZE for batch in sns.batches)
+    assert all(sum(len(entry['Subject']) + len(entry['Message']) for entry in batch) <= alerts.PUBLISH_BATCH_BYTES for batch in sns.batches)
+    assert sorted(int(entry['Id']) for batch in sns.batches for entry in batch) == list(range(25))
@@ -0,0 +1,87 @@
+"""
+Tests of the alert rule index: the compiled index must match what checking every rule in order
+returns (the reference of benchmark_rule_index). No AWS access is needed, only boto3 installed.
+
+Usage:
+    python -m pytest cloudtrail_activity_alerts/test
+"""
+import json
+import os
+import random
+
+import pytest
+
+import benchmark_rule_index as benchmark
+
+alerts = benchmark.alerts
+
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'alert_rules.json')
+
+
+def login(result, mfa='Yes', user_type='IAMUser'):
+    return {'eventSource': 'signin.amazonaws.com', 'eventName': 'ConsoleLogin', 'userIdentity': {'type': user_type},
+            'responseElements': {'ConsoleLogin': result}, 'additionalEventData': {'MFAUsed': mfa}}
+
+
+@pytest.mark.parametrize('count', [1, 50, 500])
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_index_matches_every_rule_checked_in_order(count, seed):
+    rng = random.Random(seed)
+    rule_set = benchmark.generate_rules(count, services=10, names_per_service=8, rng=rng)
+    events = benchmark.generate_events(2000, services=10, names_per_service=8, rng=rng)
+    index = alerts.compile_rules(rule_set)
+
+    for detail in events:
+        assert alerts.match_rules(index, detail) == benchmark.linear_match(rule_set, detail), detail
+
+
+@pytest.mark.parametrize('detail, expected', [
+    ({'eventSource': 'iam.amazonaws.com', 'eventName': 'CreateUser', 'userIdentity': {'type': 'Root'}}, ('critical', 'root-activity')),
+    (login('Failure'), ('high', 'console-login-failure')),
+    (login('Success', mfa='No'), ('high', 'console-login-without-mfa')),
+    (login('Success', mfa='No', user_type='AssumedRole'), ('info', 'console-login')),
+    ({'eventSource': 'cloudtrail.amazonaws.com', 'eventName': 'StopLogging', 'userIdentity': {'type': 'IAMUser'}}, ('critical', 'cloudtrail-tampering')),
+    ({'eventSource': 'iam.amazonaws.com', 'eventName': 'CreateUser',
+      'userIdentity': {'type': 'AssumedRole', 'arn': 'arn:aws:sts::111111111111:assumed-role/Automation/run'}}, ('ignore', 'automation-roles')),
+    ({'eventSource': 'ec2.amazonaws.com', 'eventName': 'RunInstances', 'userIdentity': {'type': 'IAMUser'}}, ('low', None)),
+])
+def test_example_rule_set(detail, expected):
+    with open(RULES_FILE) as rules_file:
+        index = alerts.compile_rules(json.load(rules_file))
+
+    assert alerts.match_rules(index, detail) == expected
+
+
+def test_most_severe_rule_wins_then_the_first_one():
+    index = alerts.compile_rules({'rules': [
+        {'name': 'any-event', 'severity': 'low'},
+        {'name': 'iam', 'severity': 'medium', 'eventSource': 'iam.amazonaws.com'},
+        {'name': 'create-user', 'severity': 'medium', 'eventSource': 'iam.amazonaws.com', 'eventName': 'CreateUser'},
+        {'name': 'denied', 'severity': 'high', 'conditions': {'errorCode': {'exists': True}}}
+    ]})
+
+    assert alerts.match_rules(index, {'eventSource': 'iam.amazonaws.com', 'eventName': 'CreateUser'}) == ('medium', 'iam')
+    assert alerts.match_rules(index, {'eventSource': 'iam.amazonaws.com', 'eventName': 'CreateUser', 'errorCode': 'AccessDenied'}) == ('high', 'denied')
+    assert alerts.match_rules(index, {'eventSource': 's3.amazonaws.com', 'eventName': 'GetObject'}) == ('low', 'any-event')
+
+
+@pytest.mark.parametrize('pattern, detail, matches', [
+    ({'prefix': 'arn:aws:iam::1'}, {'userIdentity': {'arn': 'arn:aws:iam::111111111111:user/a'}}, True),
+    ({'prefix': 'arn:aws:iam::2'}, {'userIdentity': {'arn': 'arn:aws:iam::111111111111:user/a'}}, False),
+    ({'exists': False}, {'userIdentity': {}}, True),
+    ({'exists': False}, {'userIdentity': {'arn': 'arn'}}, False),
+    ({'anything-but': ['x']}, {'userIdentity': {'arn': 'y'}}, True),
+    ({'anything-but': ['x']}, {'userIdentity': {}}, False),
+    (['a', 'b'], {'userIdentity': {'arn': ['c', 'b']}}, True),
+])
+def test_condition_patterns(pattern, detail, matches):
+    index = alerts.compile_rules({'rules': [{'name': 'rule', 'severity': 'high', 'conditions': {'userIdentity.arn': pattern}}]})
+
+    assert (alerts.match_rules(index, detail) == ('high', 'rule')) == matches
+
+
+def test_unknown_severity_is_rejected():
+    with pytest.raises(ValueError):
+        alerts.compile_rules({'rules': [{'name': 'rule', 'severity': 'urgent'}]})
+    with pytest.raises(ValueError):
+        alerts.compile_rules({'default_severity': 'urgent', 'rules': []})
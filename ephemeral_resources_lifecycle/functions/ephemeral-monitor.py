@@ -1,80 +1,368 @@
-import boto3
 import datetime
 import json
-import uuid
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cross_account import LazyClient, get_client, get_session
+
+# Clients are built on first use, a run without expired resources or inventory never needs them
+sns_client = LazyClient("sns")
+dynamodb_client = LazyClient("dynamodb", endpoint_url=os.getenv('DYNAMODB_ENDPOINT_URL') or None)
 
 accounts = os.getenv('ACCOUNT_IDS').split(',')
 sns_topic_arn = os.getenv('SNS_TOPIC_ARN')
 expiration_days = int(os.getenv('EXPIRATION_DAYS'))
+cross_account_role = "EphemeralCrossAccountRole"
+scan_workers = int(os.getenv('SCAN_WORKERS', '10'))
+# Comma separated regions to scan, 'all' for every region enabled in each account. Empty: the Lambda region
+scan_regions = [r.strip() for r in os.getenv('SCAN_REGIONS', '').split(',') if r.strip()]
+# resource: one email per expired resource. account: one digest per account. global: a single digest
+notification_mode = os.getenv('NOTIFICATION_MODE', 'resource').lower()
+# SNS messages are limited to 256 KB
+sns_max_message_bytes = 256 * 1024
+# DynamoDB table written by the tagger. Empty: every run scans all the accounts
+inventory_table = os.getenv('INVENTORY_TABLE')
+# 1 or less: every run is a full scan
+inventory_full_scan_days = max(1, int(os.getenv('INVENTORY_FULL_SCAN_DAYS', '7')))
+finding_generator = "ephemeral-monitor"
+# BatchImportFindings accepts up to 100 findings per call
+findings_batch_size = 100
+# Seconds kept free at the end of each invocation to aggregate the results and hand off the rest of the sweep
+deadline_safety_seconds = int(os.getenv('DEADLINE_SAFETY_SECONDS', '60'))
+max_continuations = int(os.getenv('MAX_CONTINUATIONS', '5'))
+# Async Lambda payloads are limited to 256 KB
+max_cursor_bytes = 250 * 1024
+deadline = None
 
 def handler(event, context):
+    set_deadline(context)
 
-    today = datetime.datetime.utcnow().date()
+    cursor = event.get("cursor")
+    if cursor:
+        # Continuation of a sweep that didn't fit in the previous invocation
+        today = datetime.date.fromisoformat(cursor["today"])
+        cursor["pending"] = unpack_pending(cursor["pending"])
+        print(f"Resuming sweep of {cursor['today']}: {count_pairs(cursor['pending'])} account/region pairs left, continuation {cursor['continuations']}")
+    else:
+        today = datetime.datetime.utcnow().date()
+        cursor = {"today": today.isoformat(), "continuations": 0, "full_scan": True, "pending": None, "digest": [],
+                  "expired": 0, "failed_accounts": [], "failed_regions": [], "not_scanned": 0}
     threshold = today - datetime.timedelta(days=expiration_days)
-    finding = ""
-
-    for account in accounts:
-        role_arn = f"arn:aws:iam::{account}:role/EphemeralCrossAccountRole"
-        creds = boto3.client("sts").assume_role(
-            RoleArn=role_arn,
-            RoleSessionName="MonitorEphemeral"
-        )["Credentials"]
-
-        ec2 = boto3.client("ec2",
-            aws_access_key_id=creds["AccessKeyId"],
-            aws_secret_access_key=creds["SecretAccessKey"],
-            aws_session_token=creds["SessionToken"])
-
-        rds = boto3.client("rds",
-            aws_access_key_id=creds["AccessKeyId"],
-            aws_secret_access_key=creds["SecretAccessKey"],
-            aws_session_token=creds["SessionToken"]
-        )
 
-        sh = boto3.client("securityhub",
-            aws_access_key_id=creds["AccessKeyId"],
-            aws_secret_access_key=creds["SecretAccessKey"],
-            aws_session_token=creds["SessionToken"]
-        )
+    # Accounts and regions are scanned concurrently, each one in its own thread with its own clients
+    # (the default Session is not thread safe). A failing account or region doesn't stop the others.
+    workers = max(1, scan_workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # One assumed role per account, shared by all its regions
+        if cursor["pending"] is not None:
+            pending_accounts = sorted(cursor["pending"])
+            account_sessions = list(executor.map(lambda account: get_account_session(account, resolve_regions=False), pending_accounts))
+            sessions = {account_session["account"]: account_session for account_session in account_sessions}
+            # Only the account/region pairs travel in the cursor (the payload is limited), the due items are read again
+            due_items = None if cursor["full_scan"] else load_due_items(threshold)
+            scans = [(sessions[account], region, None if due_items is None else due_items.get((account, region), []))
+                     for account in pending_accounts if not sessions[account]["error"]
+                     for region in cursor["pending"][account]]
+        else:
+            # With the inventory, only the resources due today are checked. A full scan runs every few days
+            # (or on demand) to add the resources the tagger missed
+            full_scan = not inventory_table or event.get("full_scan") or today.toordinal() % inventory_full_scan_days == 0
+            cursor["full_scan"] = bool(full_scan)
+            due_items = {} if full_scan else load_due_items(threshold)
+            print(f"Full scan: {bool(full_scan)}" + ("" if full_scan else f", {sum(len(items) for items in due_items.values())} resources due"))
+
+            if full_scan:
+                account_sessions = list(executor.map(get_account_session, accounts))
+                scans = [(account_session, region, None) for account_session in account_sessions if not account_session["error"]
+                         for region in account_session["regions"]]
+            else:
+                due_accounts = sorted({account for account, _ in due_items})
+                account_sessions = list(executor.map(lambda account: get_account_session(account, resolve_regions=False), due_accounts))
+                scans = [(account_session, region, items) for account_session in account_sessions if not account_session["error"]
+                         for (account, region), items in due_items.items() if account == account_session["account"]]
+        results = list(executor.map(lambda scan: scan_region(scan[0], scan[1], threshold, scan[2]), scans))
+
+    # Aggregate the results of every account and region. Scans skipped for lack of time stay pending
+    cursor["failed_accounts"] += [account_session["account"] for account_session in account_sessions if account_session["error"]]
+    pending = {}  # account -> regions left
+    region_times = {}
+    for scan, result in zip(scans, results):
+        if result is None:
+            pending.setdefault(scan[0]["account"], []).append(scan[1])
+            continue
+        region_times.setdefault(result["region"], []).append(result["seconds"])
+        if result["error"]:
+            cursor["failed_regions"].append(f"{result['account']}/{result['region']}")
+            continue
+        if inventory_table:
+            try:
+                update_inventory(result["inventory_updates"], result["inventory_deletes"])
+            except Exception as e:
+                print(f"Failed to update the inventory of {result['account']}/{result['region']}: {e}")
+        findings = []
+        for resource in result["expired"]:
+            if notification_mode == "resource":
+                try:
+                    notify(resource["resource_arn"], resource["tags"], resource["resource_type"])
+                except Exception as e:
+                    print(f"Failed to notify {resource['resource_arn']} in {result['account']}/{result['region']}: {e}")
+            else:
+                # Only the tags shown in the digest are kept, the digest travels in the cursor
+                tags = {key: value for key, value in resource["tags"].items() if key in ("Name", "CreatedBy", "CreationDate")}
+                cursor["digest"].append({**resource, "tags": tags, "account_id": result["account_id"], "region": result["region"]})
+            findings.append(build_finding(resource["resource_arn"], resource["resource_type"], result["region"], result["account_id"],
+                                          resource["tags"].get("CreationDate")))
+            cursor["expired"] += 1
+        try:
+            import_findings(result["securityhub"], findings)
+            archive_findings(result["securityhub"], result["region"], result["account_id"], {f["Id"] for f in findings})
+        except Exception as e:
+            print(f"Failed to update Security Hub findings in {result['account']}/{result['region']}: {e}")
+
+    print(f"Scanned {len(scans) - count_pairs(pending)} of {len(scans)} account/region pairs with {workers} workers")
+    for region, times in sorted(region_times.items(), key=lambda item: sum(item[1]), reverse=True):
+        print(f"Region {region}: {len(times)} accounts, {sum(times):.1f}s total, {max(times):.1f}s max")
+
+    # Out of time: hand the remaining accounts and regions to a new invocation
+    if pending and cursor["continuations"] < max_continuations:
+        cursor["pending"] = pending
+        cursor["continuations"] += 1
+        invoke_continuation(context, cursor)
+        return {"continuation": cursor["continuations"], "pending": count_pairs(pending)}
+    if pending:
+        print(f"Sweep still incomplete after {max_continuations} continuations, {count_pairs(pending)} account/region pairs not scanned")
+        cursor["failed_regions"] += [f"{account}/{region}" for account, regions in sorted(pending.items()) for region in regions]
+    if cursor["not_scanned"]:
+        print(f"{cursor['not_scanned']} account/region pairs not scanned, the cursor was over the payload limit")
+
+    if cursor["digest"]:
+        try:
+            send_digest(cursor["digest"], today)
+        except Exception as e:
+            print(f"Failed to send the digest notification: {e}")
+
+    print(f"Sweep finished in {cursor['continuations'] + 1} invocations: {cursor['expired']} expired resources, "
+          f"{len(cursor['failed_accounts'])} failed accounts, {len(cursor['failed_regions'])} failed regions")
+    if cursor["failed_accounts"]:
+        print(f"Failed accounts: {', '.join(cursor['failed_accounts'])}")
+    if cursor["failed_regions"]:
+        print(f"Failed regions: {', '.join(cursor['failed_regions'])}")
+
+    return {"expired": cursor["expired"], "failed_accounts": cursor["failed_accounts"], "failed_regions": cursor["failed_regions"]}
+
+def set_deadline(context):
+    """Derives the time budget of the sweep from the Lambda remaining time"""
+    global deadline
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - deadline_safety_seconds
+    else:
+        deadline = None
+
+def out_of_time():
+    return deadline is not None and time.time() >= deadline
+
+def count_pairs(pending):
+    return sum(len(regions) for regions in pending.values())
+
+def invoke_continuation(context, cursor):
+    """Invokes this function again (asynchronously) with the cursor of the sweep. The sweep goes on in a
+    single chain of continuations, so the digest is sent once, by the last one"""
+    payload = cursor_payload(cursor)
+    if len(payload) > max_cursor_bytes and cursor["digest"]:
+        # Async invocations are limited to 256 KB: send the digest collected so far and continue without it
+        send_digest(cursor["digest"], datetime.date.fromisoformat(cursor["today"]))
+        cursor["digest"] = []
+        payload = cursor_payload(cursor)
+    accounts = sorted(cursor["pending"])
+    while len(payload) > max_cursor_bytes and accounts:
+        # Still too large: the last accounts are left out of this sweep (an account ID takes 16 bytes at least)
+        dropped = accounts[-max(1, (len(payload) - max_cursor_bytes) // 16):]
+        del accounts[-len(dropped):]
+        cursor["not_scanned"] += sum(len(cursor["pending"].pop(account)) for account in dropped)
+        print(f"Cursor over the payload limit, accounts not scanned in this sweep: {', '.join(dropped)}")
+        payload = cursor_payload(cursor)
+    get_client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=payload
+    )
+    print(f"Continuation {cursor['continuations']} invoked with {count_pairs(cursor['pending'])} account/region pairs")
+
+def cursor_payload(cursor):
+    return json.dumps({"cursor": {**cursor, "pending": pack_pending(cursor["pending"])}}).encode("utf-8")
+
+def pack_pending(pending):
+    """Groups the pending accounts by their regions left, most of them share the same list"""
+    packed = {}
+    for account, regions in sorted(pending.items()):
+        packed.setdefault(",".join(regions), []).append(account)
+    return packed
+
+def unpack_pending(packed):
+    return {account: regions.split(",") for regions, accounts in packed.items() for account in accounts}
+
+def get_account_session(account, resolve_regions=True):
+    """Assumes the role of an account and resolves the regions to scan on it"""
+    account_session = {"account": account, "account_id": account, "error": None}
+    try:
+        # Credentials and clients are cached across warm invocations until they are about to expire
+        session = get_session(account, cross_account_role, "MonitorEphemeral")
 
-        account_id = boto3.client('sts',
-            aws_access_key_id=creds["AccessKeyId"],
-            aws_secret_access_key=creds["SecretAccessKey"],
-            aws_session_token=creds["SessionToken"]
-        ).get_caller_identity()["Account"]
+        if not resolve_regions:
+            account_session["regions"] = []
+        elif scan_regions == ["all"]:
+            # Only the regions enabled in the account are returned
+            ec2 = get_client("ec2", account, cross_account_role, session_name="MonitorEphemeral")
+            account_session["regions"] = [r["RegionName"] for r in ec2.describe_regions()["Regions"]]
+        else:
+            account_session["regions"] = scan_regions or [session.region_name]
+    except Exception as e:
+        print(f"Failed to assume role in account {account}: {e}")
+        account_session["error"] = str(e)
+    return account_session
 
-        region = boto3.Session().region_name
+def scan_region(account_session, region, threshold, due_items=None):
+    """Returns the expired ephemeral resources of an account in a region, or the error that stopped the scan.
+    With due_items, only those inventory items are checked instead of the whole region.
+    Returns None if the time budget of this invocation is over"""
+    if out_of_time():
+        return None
+    start = time.time()
+    result = {"account": account_session["account"], "account_id": account_session["account_id"],
+              "region": region, "expired": [], "error": None, "inventory_updates": [], "inventory_deletes": []}
+    try:
+        account = account_session["account"]
+        ec2 = get_client("ec2", account, cross_account_role, region, "MonitorEphemeral")
+        tagging = get_client("resourcegroupstaggingapi", account, cross_account_role, region, "MonitorEphemeral")
+        result["securityhub"] = get_client("securityhub", account, cross_account_role, region, "MonitorEphemeral")
 
-        instances = ec2.describe_instances(Filters=[
+        if due_items is not None:
+            check_due_items(tagging, due_items, threshold, result)
+            result["seconds"] = time.time() - start
+            return result
+
+        # Both queries are filtered server side by the Ephemeral tag, so the number of calls depends on the
+        # ephemeral resources only. Pages are followed until the end (large accounts were truncated before)
+        pages = ec2.get_paginator("describe_instances").paginate(Filters=[
             {"Name": "tag:Ephemeral", "Values": ["True"]}
         ])
 
-        for r in instances["Reservations"]:
-            for inst in r["Instances"]:
-                tags = {t["Key"]: t["Value"] for t in inst.get("Tags", [])}
-                creation_date_str = tags.get("CreationDate", "1970-01-01")
-                creation_date = datetime.datetime.fromisoformat(creation_date_str).date()
-                if creation_date <= threshold:
-                    notify(inst["InstanceId"], tags, "AwsEc2Instance", region, account_id, sh)
-
-        databases = rds.describe_db_instances()["DBInstances"]
-
-        for inst in databases:
-            arn = inst["DBInstanceArn"]
-            tags_resp = rds.list_tags_for_resource(ResourceName=arn)
-            tags = {t["Key"]: t["Value"] for t in tags_resp.get("TagList", [])}
-            
-            if tags.get("Ephemeral") == "True":
+        for page in pages:
+            for r in page["Reservations"]:
+                for inst in r["Instances"]:
+                    tags = {t["Key"]: t["Value"] for t in inst.get("Tags", [])}
+                    # Instances the tagger missed are aged from their launch, and inventoried with that date so
+                    # the daily check and the full scan agree on them
+                    tags.setdefault("CreationDate", inst["LaunchTime"].date().isoformat())
+                    result["inventory_updates"].append(inventory_item(result, inst["InstanceId"], "AwsEc2Instance", tags))
+                    try:
+                        creation_date = datetime.datetime.strptime(tags["CreationDate"], "%Y-%m-%d").date()
+                        if creation_date <= threshold:
+                            result["expired"].append({"resource_arn": inst["InstanceId"], "tags": tags, "resource_type": "AwsEc2Instance"})
+                    except Exception as e:
+                        print(f"Failed to parse CreationDate for EC2 {inst['InstanceId']}: {e}")
+
+        # RDS has no tag filter, the Resource Groups Tagging API returns the ephemeral DB instances with their tags
+        pages = tagging.get_paginator("get_resources").paginate(
+            TagFilters=[{"Key": "Ephemeral", "Values": ["True"]}],
+            ResourceTypeFilters=["rds:db"]
+        )
+
+        for page in pages:
+            for resource in page["ResourceTagMappingList"]:
+                arn = resource["ResourceARN"]
+                tags = {t["Key"]: t["Value"] for t in resource.get("Tags", [])}
+                if "CreationDate" in tags:
+                    result["inventory_updates"].append(inventory_item(result, arn, "AwsRdsDbInstance", tags))
                 try:
                     creation_date = datetime.datetime.strptime(tags["CreationDate"], "%Y-%m-%d").date()
                     if creation_date <= threshold:
-                        notify(arn, tags, "AwsRdsDbInstance", region, account_id, sh)
+                        result["expired"].append({"resource_arn": arn, "tags": tags, "resource_type": "AwsRdsDbInstance"})
                 except Exception as e:
                     print(f"Failed to parse CreationDate for RDS {arn}: {e}")
+    except Exception as e:
+        print(f"Failed to scan account {account_session['account']} in {region}: {e}")
+        result["error"] = str(e)
+    result["seconds"] = time.time() - start
+    return result
+
+def inventory_item(result, resource_id, resource_type, tags):
+    """DynamoDB item of an ephemeral resource, same format the tagger writes"""
+    return {
+        "ResourceKey": {"S": f"{result['account_id']}#{result['region']}#{resource_id}"},
+        "Inventory": {"S": "ephemeral"},
+        "AccountId": {"S": result["account_id"]},
+        "Region": {"S": result["region"]},
+        "ResourceId": {"S": resource_id},
+        "ResourceType": {"S": resource_type},
+        "CreationDate": {"S": tags["CreationDate"]},
+        "CreatedBy": {"S": tags.get("CreatedBy", "Unknown")}
+    }
+
+def load_due_items(threshold):
+    """Returns the inventory items created on or before the threshold, grouped by (account, region)"""
+    due_items = {}
+    pages = dynamodb_client.get_paginator("query").paginate(
+        TableName=inventory_table,
+        IndexName="CreationDateIndex",
+        KeyConditionExpression="Inventory = :inventory AND CreationDate <= :threshold",
+        ExpressionAttributeValues={":inventory": {"S": "ephemeral"}, ":threshold": {"S": threshold.isoformat()}}
+    )
+    for page in pages:
+        for item in page["Items"]:
+            due_items.setdefault((item["AccountId"]["S"], item["Region"]["S"]), []).append(item)
+    return due_items
+
+def check_due_items(tagging, items, threshold, result):
+    """Reads the current tags of the inventory items: deleted or no longer ephemeral resources leave the
+    inventory, a changed CreationDate is updated, and the expired ones are added to the result"""
+    arns = {}
+    for item in items:
+        resource_id = item["ResourceId"]["S"]
+        if item["ResourceType"]["S"] == "AwsEc2Instance":
+            arns[f"arn:aws:ec2:{result['region']}:{result['account_id']}:instance/{resource_id}"] = item
+        else:
+            arns[resource_id] = item
+
+    current_tags = {}
+    arn_list = list(arns)
+    # get_resources accepts up to 100 ARNs per call
+    for i in range(0, len(arn_list), 100):
+        pages = tagging.get_paginator("get_resources").paginate(ResourceARNList=arn_list[i:i + 100])
+        for page in pages:
+            for resource in page["ResourceTagMappingList"]:
+                current_tags[resource["ResourceARN"]] = {t["Key"]: t["Value"] for t in resource.get("Tags", [])}
+
+    for arn, item in arns.items():
+        tags = current_tags.get(arn)
+        if not tags or tags.get("Ephemeral") != "True":
+            result["inventory_deletes"].append(item["ResourceKey"]["S"])
+            continue
+        resource_id, resource_type = item["ResourceId"]["S"], item["ResourceType"]["S"]
+        tags.setdefault("CreationDate", item["CreationDate"]["S"])
+        if tags["CreationDate"] != item["CreationDate"]["S"]:
+            result["inventory_updates"].append(inventory_item(result, resource_id, resource_type, tags))
+        try:
+            creation_date = datetime.datetime.strptime(tags["CreationDate"], "%Y-%m-%d").date()
+            if creation_date <= threshold:
+                result["expired"].append({"resource_arn": resource_id, "tags": tags, "resource_type": resource_type})
+        except Exception as e:
+            print(f"Failed to parse CreationDate for {resource_id}: {e}")
 
-def notify(resource_arn, tags, resource_type, region, account_id, sh):
-    sns = boto3.client("sns")
+def update_inventory(items, deleted_keys):
+    """Writes and deletes inventory items in batches of the BatchWriteItem maximum (25)"""
+    requests = [{"PutRequest": {"Item": item}} for item in items] + \
+               [{"DeleteRequest": {"Key": {"ResourceKey": {"S": key}}}} for key in deleted_keys]
+    for i in range(0, len(requests), 25):
+        pending = {inventory_table: requests[i:i + 25]}
+        while pending:
+            pending = dynamodb_client.batch_write_item(RequestItems=pending).get("UnprocessedItems")
+            if pending:
+                time.sleep(1)
+    if deleted_keys:
+        print(f"Removed {len(deleted_keys)} resources from the inventory")
+
+def notify(resource_arn, tags, resource_type):
     name = tags.get("Name", "N/A")
     creation_date = tags.get("CreationDate", "Unknown")
     
@@ -87,25 +375,80 @@ def notify(resource_arn, tags, resource_type, region, account_id, sh):
         f"Tags:\n{tag_lines}"
     )
     
-    sns.publish(
+    sns_client.publish(
         TopicArn=sns_topic_arn,
         Subject=f"Ephemeral {resource_type} expired",
         Message=message
     )
 
-    finding = {
+def send_digest(resources, today):
+    """Sends the expired resources as a table, one message per account or a single one for all of them"""
+    groups = {}
+    for resource in resources:
+        group = resource["account_id"] if notification_mode == "account" else "all"
+        groups.setdefault(group, []).append(resource)
+
+    for group, group_resources in sorted(groups.items()):
+        rows = [["Account", "Region", "Type", "Resource", "Name", "CreatedBy", "Age (days)"]]
+        for resource in sorted(group_resources, key=lambda r: (r["account_id"], r["region"], r["resource_arn"])):
+            tags = resource["tags"]
+            try:
+                age = str((today - datetime.date.fromisoformat(tags["CreationDate"])).days)
+            except Exception:
+                age = "Unknown"
+            rows.append([resource["account_id"], resource["region"], resource["resource_type"], resource["resource_arn"],
+                         tags.get("Name", "N/A"), tags.get("CreatedBy", "Unknown"), age])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ["  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+
+        target = f"account {group}" if notification_mode == "account" else f"{len({r['account_id'] for r in group_resources})} accounts"
+        header = f"{len(group_resources)} ephemeral resources in {target} exceeded the {expiration_days}-day lifespan\n\n"
+        messages = split_message(header, lines[0], lines[1:])
+        for part, message in enumerate(messages, 1):
+            subject = f"Ephemeral resources expired in {target}"
+            if len(messages) > 1:
+                subject += f" ({part}/{len(messages)})"
+            sns_client.publish(TopicArn=sns_topic_arn, Subject=subject[:100], Message=message)
+        print(f"Digest for {target} sent in {len(messages)} messages")
+
+def split_message(header, table_header, lines):
+    """Splits the table rows in messages under the SNS size limit, repeating the header in every one"""
+    start = header + table_header + "\n"
+    messages = []
+    message, size = start, len(start.encode("utf-8"))
+    for line in lines:
+        line_size = len(line.encode("utf-8")) + 1
+        if size + line_size > sns_max_message_bytes and message != start:
+            messages.append(message)
+            message, size = start, len(start.encode("utf-8"))
+        message += line + "\n"
+        size += line_size
+    messages.append(message)
+    return messages
+
+def build_finding(resource_arn, resource_type, region, account_id, creation_date=None):
+    now = datetime.datetime.utcnow().isoformat() + "Z"
+    # CreatedAt is the day the resource expired, the same on every run, so Security Hub keeps the age of the finding.
+    # Without a valid CreationDate tag there is nothing stable to use and it falls back to now
+    try:
+        expired_at = datetime.date.fromisoformat(creation_date[:10]) + datetime.timedelta(days=expiration_days)
+        created_at = f"{expired_at.isoformat()}T00:00:00Z"
+    except (TypeError, ValueError):
+        created_at = now
+    return {
         "SchemaVersion": "2018-10-08",
-        "Id": str(uuid.uuid4()),
+        # Same Id on every run, so the finding is updated instead of duplicated
+        "Id": f"{finding_generator}/{account_id}/{resource_arn}",
         "ProductArn": f"arn:aws:securityhub:{region}:{account_id}:product/{account_id}/default",
-        "GeneratorId": "ephemeral-monitor",
+        "GeneratorId": finding_generator,
         "AwsAccountId": account_id,
-        "CreatedAt": datetime.datetime.utcnow().isoformat() + "Z",
-        "UpdatedAt": datetime.datetime.utcnow().isoformat() + "Z",
+        "CreatedAt": created_at,
+        "UpdatedAt": now,
         "Title": f"Ephemeral {resource_type} Expired",
         "Description": f"{resource_type} {resource_arn} exceeded {expiration_days}-day lifespan.",
         "Severity": {"Label": "MEDIUM"},
         "Resources": [{
-            "Type": f"Aws{resource_type}",
+            "Type": resource_type,
             "Id": resource_arn,
             "Region": region,
             "Partition": "aws"
@@ -114,5 +457,37 @@ def notify(resource_arn, tags, resource_type, region, account_id, sh):
         "RecordState": "ACTIVE",
         "Compliance": {"Status": "FAILED"}
     }
-    
-    sh.batch_import_findings(Findings=[finding])
+
+def import_findings(sh, findings):
+    """Imports the findings in batches of the API maximum"""
+    for i in range(0, len(findings), findings_batch_size):
+        response = sh.batch_import_findings(Findings=findings[i:i + findings_batch_size])
+        for failed in response.get("FailedFindings", []):
+            print(f"Failed to import finding {failed['Id']}: {failed.get('ErrorCode')} {failed.get('ErrorMessage')}")
+
+def archive_findings(sh, region, account_id, expired_ids):
+    """Archives the active findings of resources that are no longer expired or no longer exist"""
+    pages = sh.get_paginator("get_findings").paginate(Filters={
+        "GeneratorId": [{"Value": finding_generator, "Comparison": "EQUALS"}],
+        "AwsAccountId": [{"Value": account_id, "Comparison": "EQUALS"}],
+        "Region": [{"Value": region, "Comparison": "EQUALS"}],
+        "RecordState": [{"Value": "ACTIVE", "Comparison": "EQUALS"}]
+    })
+
+    now = datetime.datetime.utcnow().isoformat() + "Z"
+    archived = []
+    for page in pages:
+        for finding in page["Findings"]:
+            if finding["Id"] in expired_ids:
+                continue
+            archived.append({
+                **{key: finding[key] for key in ("SchemaVersion", "Id", "ProductArn", "GeneratorId", "AwsAccountId",
+                                                 "CreatedAt", "Title", "Description", "Severity", "Resources", "Types")},
+                "UpdatedAt": now,
+                "RecordState": "ARCHIVED",
+                "Compliance": {"Status": "PASSED"}
+            })
+
+    if archived:
+        print(f"Archiving {len(archived)} findings in {account_id}/{region}")
+        import_findings(sh, archived)
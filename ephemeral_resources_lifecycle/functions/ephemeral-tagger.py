@@ -1,102 +1,184 @@
 import json
-import boto3
 import datetime
 import os
+import time
+from cross_account import LazyClient, get_client, get_session
 
-# Initialize clients
-ec2_client = boto3.client('ec2')
-rds_client = boto3.client('rds')
+# Initialize clients (built on first use). EC2 and RDS clients come from the assumed role of each account
+dynamodb_client = LazyClient('dynamodb', endpoint_url=os.getenv('DYNAMODB_ENDPOINT_URL') or None)
+
+# DynamoDB table where the tagged resources are recorded for the monitor. Empty: disabled
+inventory_table = os.getenv('INVENTORY_TABLE')
+
+cross_account_role = 'EphemeralCrossAccountRole'
+
+# CreateTags accepts up to 1000 resource IDs per call
+create_tags_batch_size = 1000
 
 
 def lambda_handler(event, context):
     # Debug purposes. Prints the whole CloudTrail event
     # print("Received event:", json.dumps(event, indent=2))
 
+    # With EnableTaggerQueue, the creation events of the member accounts arrive through the Tagger queue
+    if 'Records' in event:
+        return handle_sqs_batch(event['Records'])
+
+    resource, response = parse_event(event)
+    if not resource:
+        return response
+
+    print(f"CreatedBy: {resource['created_by']}")
+    print(f"CreationDate: {datetime.date.today().isoformat()}")
+    print(f"Account ID: {resource['account_id']}")
+    print(f"Resource ID: {', '.join(resource['resource_ids'])}")
+
+    tagged = tag_resources(resource['account_id'], resource['region'], resource['resource_type'],
+                           resource['resource_ids'], resource['created_by'], datetime.date.today().isoformat())
+
+    if inventory_table:
+        add_to_inventory(tagged)
+
+    return {'statusCode': 200, 'body': f"Tags added to {resource['resource_type']} resource: {', '.join(resource['resource_ids'])}"}
+
+
+def parse_event(event):
+    """Returns the ephemeral resources created in a CloudTrail event, or the response explaining why there are none"""
     try:
         event_source = event['detail']['eventSource']
         event_name = event['detail']['eventName']
     except KeyError as e:
         print(f"Missing expected key in event: {e}")
-        return {'statusCode': 400, 'body': f'Missing key: {str(e)}'}
+        return None, {'statusCode': 400, 'body': f'Missing key: {str(e)}'}
 
-    resource_id = ''
-    resource_type = ''
-    account_id = ''
-    creds = ''
-
-    # Check if the event is for EC2 or RDS
+    # Check if the event is for EC2 or RDS, and keep the resources with the 'Ephemeral=True' tag
     if event_source == 'ec2.amazonaws.com' and event_name == 'RunInstances':
         try:
-            resource_id = event['detail']['responseElements']['instancesSet']['items'][0]['instanceId']
+            # A single RunInstances call can launch many instances
+            items = event['detail']['responseElements']['instancesSet']['items']
+            resource_ids = [item['instanceId'] for item in items
+                            if is_ephemeral(item.get('tagSet', {}).get('items', []))]
+            all_ids = [item['instanceId'] for item in items]
             resource_type = 'EC2'
-        except (KeyError, IndexError) as e:
+        except (KeyError, TypeError) as e:
             print(f"Error extracting instance ID: {e}")
-            return {'statusCode': 400, 'body': 'Invalid EC2 event format'}
+            return None, {'statusCode': 400, 'body': 'Invalid EC2 event format'}
     elif event_source == 'rds.amazonaws.com' and event_name == 'CreateDBInstance':
         try:
             resource_id = event['detail']['responseElements']['dBInstanceArn']
+            resource_ids = [resource_id] if is_ephemeral(event['detail']['responseElements'].get('tagList', [])) else []
+            all_ids = [resource_id]
             resource_type = 'RDS'
-        except KeyError as e:
+        except (KeyError, TypeError) as e:
             print(f"Error extracting RDS instance ID: {e}")
-            return {'statusCode': 400, 'body': 'Invalid RDS event format'}
-    # If neither EC2 nor RDS, skip
-    if not resource_id:
-        return {'statusCode': 200, 'body': 'No supported resource found'}
+            return None, {'statusCode': 400, 'body': 'Invalid RDS event format'}
+    else:
+        # If neither EC2 nor RDS, skip
+        return None, {'statusCode': 200, 'body': 'No supported resource found'}
+
+    if not resource_ids:
+        return None, {'statusCode': 200, 'body': f"No Ephemeral tag found for {resource_type} resource: {', '.join(all_ids)}"}
 
-    # Initialize clients
-    ec2_client = boto3.client('ec2')
-    rds_client = boto3.client('rds')
+    user_identity = event['detail']['userIdentity']
+    return {
+        'account_id': event['detail']['recipientAccountId'],
+        'region': event['detail'].get('awsRegion', event.get('region')),
+        'resource_type': resource_type,
+        'resource_ids': resource_ids,
+        'created_by': user_identity.get('userName') or user_identity.get('arn').split('/')[-1]
+    }, None
+
+
+def is_ephemeral(tags):
+    return any(tag['key'] == 'Ephemeral' and tag['value'] == 'True' for tag in tags)
+
+
+def tag_resources(account_id, region, resource_type, resource_ids, created_by, creation_date):
+    """Adds the CreatedBy and CreationDate tags. Returns the tagged resources, for the inventory"""
+    tags = [{'Key': 'CreatedBy', 'Value': created_by}, {'Key': 'CreationDate', 'Value': creation_date}]
 
-    # Get tags for the resource
     if resource_type == 'EC2':
-        tags = event['detail']['responseElements']['instancesSet']['items'][0]['tagSet']['items']
+        # Every instance gets the same tags, so they are tagged together
+        ec2_client = get_client('ec2', account_id, cross_account_role, region, 'Tagging-Session')
+        for i in range(0, len(resource_ids), create_tags_batch_size):
+            ec2_client.create_tags(Resources=resource_ids[i:i + create_tags_batch_size], Tags=tags)
     elif resource_type == 'RDS':
-        tags = event['detail']['responseElements']['tagList']
-
-    # Check for 'Ephemeral=True' tag
-    ephemeral_tag = next((tag for tag in tags if tag['key'] == 'Ephemeral' and tag['value'] == 'True'), None)
-
-    if ephemeral_tag:
-        # Generate the new tags
-        user_identity = event['detail']['userIdentity']
-        created_by = user_identity.get('userName') or user_identity.get('arn').split('/')[-1]
-        created_by_tag = {'Key': 'CreatedBy', 'Value': created_by}
-        creation_date_tag = {'Key': 'CreationDate', 'Value': datetime.date.today().isoformat()}
-
-        print(f"CreatedBy: {created_by}")
-        print(f"CreationDate: {datetime.date.today().isoformat()}")
-        print(f"CreatedBy: {created_by}")
-
-        account_id = event['detail']['recipientAccountId']
-
-        print(f"Account ID: {account_id}")
-
-        print(f"Resource ID: {resource_id}")
-        print(f"User: {created_by}")
-
-        sts = boto3.client('sts')            
-        assumed_role = sts.assume_role(
-            RoleArn=f"arn:aws:iam::{account_id}:role/EphemeralCrossAccountRole",
-            RoleSessionName=f"Tagging-Session"
-        )
-        creds = assumed_role['Credentials']
-
-        # Add the tags to the resource
-        if resource_type == 'EC2':
-            ec2_client = boto3.client('ec2',
-                aws_access_key_id=creds['AccessKeyId'],
-                aws_secret_access_key=creds['SecretAccessKey'],
-                aws_session_token=creds['SessionToken']
-            )
-            ec2_client.create_tags(Resources=[resource_id], Tags=[created_by_tag, creation_date_tag])
-        elif resource_type == 'RDS':
-            rds_client = boto3.client('rds',
-                aws_access_key_id=creds['AccessKeyId'],
-                aws_secret_access_key=creds['SecretAccessKey'],
-                aws_session_token=creds['SessionToken']
-            )
-            rds_client.add_tags_to_resource(ResourceName=resource_id, Tags=[created_by_tag, creation_date_tag])
-
-        return {'statusCode': 200, 'body': f'Tags added to {resource_type} resource: {resource_id}'}
-    else:
-        return {'statusCode': 200, 'body': f'No Ephemeral tag found for {resource_type} resource: {resource_id}'}
+        rds_client = get_client('rds', account_id, cross_account_role, region, 'Tagging-Session')
+        for resource_id in resource_ids:
+            rds_client.add_tags_to_resource(ResourceName=resource_id, Tags=tags)
+
+    return [{'account_id': account_id, 'region': region, 'resource_id': resource_id, 'resource_type': resource_type,
+             'creation_date': creation_date, 'created_by': created_by} for resource_id in resource_ids]
+
+
+def handle_sqs_batch(records):
+    """Tags the resources of a batch of SQS records with one assumed role per account and one call per
+    region, resource type and creator. Returns the records to retry (partial batch response)"""
+    creation_date = datetime.date.today().isoformat()
+    accounts = {}
+    for record in records:
+        try:
+            resource, response = parse_event(json.loads(record['body']))
+        except Exception as e:
+            # A body parse_event cannot read would raise on every redelivery: it is logged and
+            # left out of the batch failures instead of holding the queue
+            print(f"Invalid record {record.get('messageId')}: {e}")
+            continue
+        if resource:
+            accounts.setdefault(resource['account_id'], []).append((record['messageId'], resource))
+
+    failed_ids = []
+    tagged = []
+    for account_id, entries in accounts.items():
+        try:
+            # The credentials are cached, so this is the only assume_role of the account in the batch
+            get_session(account_id, cross_account_role, 'Tagging-Session')
+        except Exception as e:
+            print(f"Failed to assume role in account {account_id}: {e}")
+            failed_ids += [message_id for message_id, _ in entries]
+            continue
+
+        groups = {}
+        for message_id, resource in entries:
+            group = groups.setdefault((resource['region'], resource['resource_type'], resource['created_by']), ([], []))
+            group[0].append(message_id)
+            group[1].extend(resource['resource_ids'])
+
+        for (region, resource_type, created_by), (message_ids, resource_ids) in groups.items():
+            try:
+                tagged += tag_resources(account_id, region, resource_type, resource_ids, created_by, creation_date)
+            except Exception as e:
+                print(f"Failed to tag {len(resource_ids)} {resource_type} resources in {account_id}/{region}: {e}")
+                failed_ids += message_ids
+
+    print(f"Tagged {len(tagged)} resources from {len(records)} records in {len(accounts)} accounts, {len(failed_ids)} records failed")
+    if inventory_table and tagged:
+        add_to_inventory(tagged)
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in dict.fromkeys(failed_ids)]}
+
+
+def add_to_inventory(resources):
+    """Records the resources in the inventory table, indexed by CreationDate for the monitor"""
+    requests = [{'PutRequest': {'Item': {
+        'ResourceKey': {'S': f"{resource['account_id']}#{resource['region']}#{resource['resource_id']}"},
+        'Inventory': {'S': 'ephemeral'},
+        'AccountId': {'S': resource['account_id']},
+        'Region': {'S': resource['region']},
+        'ResourceId': {'S': resource['resource_id']},
+        'ResourceType': {'S': 'AwsEc2Instance' if resource['resource_type'] == 'EC2' else 'AwsRdsDbInstance'},
+        'CreationDate': {'S': resource['creation_date']},
+        'CreatedBy': {'S': resource['created_by']}
+    }}} for resource in {(r['account_id'], r['region'], r['resource_id']): r for r in resources}.values()]
+
+    try:
+        # BatchWriteItem accepts up to 25 items per call
+        for i in range(0, len(requests), 25):
+            pending = {inventory_table: requests[i:i + 25]}
+            while pending:
+                pending = dynamodb_client.batch_write_item(RequestItems=pending).get('UnprocessedItems')
+                if pending:
+                    time.sleep(1)
+    except Exception as e:
+        # The resources are already tagged, the next full scan of the monitor will add them
+        print(f"Failed to add {len(requests)} resources to the inventory: {e}")
@@ -0,0 +1,226 @@
+"""
+Tests of the Monitor Lambda (inventory, continuations, digest) with local stand-ins for the AWS
+clients. No AWS access is needed, only boto3 installed.
+
+Usage:
+    python -m pytest ephemeral_resources_lifecycle/test
+"""
+import datetime
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+MONITOR = os.path.join(ROOT, 'ephemeral_resources_lifecycle', 'functions', 'ephemeral-monitor.py')
+sys.path.insert(0, os.path.join(ROOT, 'shared'))
+
+TODAY = datetime.datetime.utcnow().date()
+EXPIRATION_DAYS = 30
+
+
+class Paginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class FakeAWS:
+    """State of the stand-ins: instances per (account, region), inventory table, messages and invocations"""
+
+    def __init__(self):
+        self.instances = {}  # (account, region) -> [instance]
+        self.inventory = {}  # ResourceKey -> item
+        self.published = []
+        self.invocations = []
+        self.inventory_queries = 0
+
+    def add_instance(self, account, region, instance_id, launched_days_ago, creation_date=None):
+        tags = [{'Key': 'Ephemeral', 'Value': 'True'}]
+        if creation_date:
+            tags.append({'Key': 'CreationDate', 'Value': creation_date})
+        launch_time = datetime.datetime.combine(TODAY - datetime.timedelta(days=launched_days_ago), datetime.time(), datetime.timezone.utc)
+        self.instances.setdefault((account, region), []).append({'InstanceId': instance_id, 'LaunchTime': launch_time, 'Tags': tags})
+
+    def client(self, service, account=None, role=None, region=None, session_name=None):
+        return getattr(self, f'_{service}')(account, region)
+
+    def _ec2(self, account, region):
+        pages = lambda **kwargs: [{'Reservations': [{'Instances': self.instances.get((account, region), [])}]}]
+        return types.SimpleNamespace(get_paginator=lambda name: Paginator(pages))
+
+    def _resourcegroupstaggingapi(self, account, region):
+        def pages(ResourceARNList=None, **kwargs):
+            if ResourceARNList is None:
+                return [{'ResourceTagMappingList': []}]  # No RDS instances
+            instances = {f"arn:aws:ec2:{region}:{account}:instance/{instance['InstanceId']}": instance
+                         for instance in self.instances.get((account, region), [])}
+            return [{'ResourceTagMappingList': [{'ResourceARN': arn, 'Tags': instances[arn]['Tags']}
+                                                for arn in ResourceARNList if arn in instances]}]
+        return types.SimpleNamespace(get_paginator=lambda name: Paginator(pages))
+
+    def _securityhub(self, account, region):
+        return types.SimpleNamespace(batch_import_findings=lambda Findings: {},
+                                     get_paginator=lambda name: Paginator(lambda **kwargs: [{'Findings': []}]))
+
+    def _lambda(self, account, region):
+        return types.SimpleNamespace(invoke=lambda **kwargs: self.invocations.append(json.loads(kwargs['Payload'])))
+
+    def publish(self, **kwargs):
+        self.published.append(kwargs)
+
+    def query_inventory(self, **kwargs):
+        self.inventory_queries += 1
+        threshold = kwargs['ExpressionAttributeValues'][':threshold']['S']
+        return [{'Items': [item for item in self.inventory.values() if item['CreationDate']['S'] <= threshold]}]
+
+    def batch_write_item(self, RequestItems):
+        for request in next(iter(RequestItems.values())):
+            if 'PutRequest' in request:
+                item = request['PutRequest']['Item']
+                self.inventory[item['ResourceKey']['S']] = item
+            else:
+                self.inventory.pop(request['DeleteRequest']['Key']['ResourceKey']['S'], None)
+        return {}
+
+
+@pytest.fixture
+def aws():
+    return FakeAWS()
+
+
+@pytest.fixture
+def monitor(monkeypatch, aws):
+    """Returns a function loading the Monitor with the environment given and the stand-ins"""
+    def load(**env):
+        for name, value in {'ACCOUNT_IDS': '111111111111', 'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:test',
+                            'EXPIRATION_DAYS': str(EXPIRATION_DAYS), 'SCAN_REGIONS': 'us-east-1', 'SCAN_WORKERS': '2',
+                            'DEADLINE_SAFETY_SECONDS': '0', 'AWS_DEFAULT_REGION': 'us-east-1', **env}.items():
+            monkeypatch.setenv(name, value)
+        spec = importlib.util.spec_from_file_location('ephemeral_monitor', MONITOR)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.get_client = aws.client
+        module.get_session = lambda *args, **kwargs: types.SimpleNamespace(region_name='us-east-1')
+        module.sns_client = types.SimpleNamespace(publish=aws.publish)
+        module.dynamodb_client = types.SimpleNamespace(get_paginator=lambda name: Paginator(aws.query_inventory),
+                                                       batch_write_item=aws.batch_write_item)
+        return module
+    return load
+
+
+class Context:
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:111111111111:function:ephemeral-monitor'
+
+    def get_remaining_time_in_millis(self):
+        return 900 * 1000
+
+
+def run_sweep(module, aws, scans_per_invocation, event=None, max_invocations=50):
+    """Runs the handler and every continuation it invokes. Returns the last response and the
+    number of continuations invoked by each invocation"""
+    queue = [event or {}]
+    invoked = []
+    response = None
+    while queue:
+        assert len(invoked) < max_invocations
+        # Each invocation runs out of time after this number of account/region scans
+        counter = itertools.count()
+        module.out_of_time = lambda: next(counter) >= scans_per_invocation
+        before = len(aws.invocations)
+        response = module.handler(queue.pop(0), Context())
+        invoked.append(len(aws.invocations) - before)
+        queue += aws.invocations[before:]
+    return response, invoked
+
+
+def digest_rows(aws):
+    return [line for message in aws.published for line in message['Message'].splitlines() if line.startswith('1111')]
+
+
+def test_untagged_instance_is_aged_from_its_launch_time(monitor, aws):
+    aws.add_instance('111111111111', 'us-east-1', 'i-old', launched_days_ago=EXPIRATION_DAYS + 10)
+    aws.add_instance('111111111111', 'us-east-1', 'i-new', launched_days_ago=1)
+    module = monitor(INVENTORY_TABLE='inventory', NOTIFICATION_MODE='global')
+
+    response = module.handler({'full_scan': True}, None)
+
+    assert response['expired'] == 1
+    assert [row.split()[3] for row in digest_rows(aws)] == ['i-old']
+    dates = {item['ResourceId']['S']: item['CreationDate']['S'] for item in aws.inventory.values()}
+    assert dates == {'i-old': (TODAY - datetime.timedelta(days=EXPIRATION_DAYS + 10)).isoformat(),
+                     'i-new': (TODAY - datetime.timedelta(days=1)).isoformat()}
+
+
+def test_inventory_day_finds_what_the_full_scan_found(monitor, aws):
+    aws.add_instance('111111111111', 'us-east-1', 'i-untagged', launched_days_ago=EXPIRATION_DAYS + 10)
+    aws.add_instance('111111111111', 'us-east-1', 'i-tagged', launched_days_ago=1, creation_date='2020-01-01')
+    module = monitor(INVENTORY_TABLE='inventory', NOTIFICATION_MODE='global', INVENTORY_FULL_SCAN_DAYS='100000')
+    full_scan = module.handler({'full_scan': True}, None)
+    full_scan_rows = digest_rows(aws)
+    aws.published.clear()
+
+    inventory_day = module.handler({}, None)
+
+    assert aws.inventory_queries == 1
+    assert inventory_day['expired'] == full_scan['expired'] == 2
+    assert digest_rows(aws) == full_scan_rows
+
+
+def test_zero_full_scan_days_runs_a_full_scan_every_day(monitor, aws):
+    aws.add_instance('111111111111', 'us-east-1', 'i-1', launched_days_ago=EXPIRATION_DAYS + 1)
+    module = monitor(INVENTORY_TABLE='inventory', INVENTORY_FULL_SCAN_DAYS='0', NOTIFICATION_MODE='global')
+
+    response = module.handler({}, None)
+
+    assert response['expired'] == 1
+    assert aws.inventory_queries == 0
+
+
+def test_sweep_continues_in_a_single_chain_and_sends_one_digest(monitor, aws):
+    accounts = [str(111111111111 + i) for i in range(12)]
+    for account in accounts:
+        aws.add_instance(account, 'us-east-1', f'i-{account}', launched_days_ago=EXPIRATION_DAYS + 1)
+    module = monitor(ACCOUNT_IDS=','.join(accounts), NOTIFICATION_MODE='global', MAX_CONTINUATIONS='10')
+
+    response, invoked = run_sweep(module, aws, scans_per_invocation=5)
+
+    assert invoked == [1, 1, 0]
+    assert response['expired'] == len(accounts) and not response['failed_regions']
+    assert len(aws.published) == 1
+    assert len(digest_rows(aws)) == len(accounts)
+
+
+def test_oversized_cursor_leaves_out_the_last_accounts(monitor, aws, capsys):
+    accounts = [str(111111111111 + i) for i in range(12)]
+    for account in accounts:
+        aws.add_instance(account, 'us-east-1', f'i-{account}', launched_days_ago=EXPIRATION_DAYS + 1)
+    module = monitor(ACCOUNT_IDS=','.join(accounts), NOTIFICATION_MODE='resource', MAX_CONTINUATIONS='10')
+    module.max_cursor_bytes = 300
+
+    response, invoked = run_sweep(module, aws, scans_per_invocation=4)
+
+    # Never more than one continuation at a time
+    assert max(invoked) == 1
+    assert response['expired'] == len(aws.published) < len(accounts)
+    assert 'account/region pairs not scanned, the cursor was over the payload limit' in capsys.readouterr().out
+
+
+def test_digest_is_split_under_the_sns_limit(monitor, aws):
+    module = monitor(NOTIFICATION_MODE='global')
+    resources = [{'account_id': '111111111111', 'region': 'us-east-1', 'resource_type': 'AwsEc2Instance',
+                  'resource_arn': f'i-{i:017d}', 'tags': {'Name': 'x' * 100, 'CreatedBy': 'user@example.com', 'CreationDate': '2020-01-01'}}
+                 for i in range(3000)]
+
+    module.send_digest(resources, TODAY)
+
+    assert len(aws.published) > 1
+    assert all(len(message['Message'].encode('utf-8')) <= module.sns_max_message_bytes for message in aws.published)
+    assert all(message['Subject'].endswith(f'({part}/{len(aws.published)})') for part, message in enumerate(aws.published, 1))
+    assert sorted(row.split()[3] for row in digest_rows(aws)) == [resource['resource_arn'] for resource in resources]
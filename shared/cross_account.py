@@ -0,0 +1,115 @@
+"""
+Cross-account credentials and clients shared by the Lambda functions.
+
+Package this file in the Lambda .zip, next to the handler. Assumed-role credentials are cached per
+(account, role) and refreshed a few minutes before they expire, and clients are cached per
+(account, role, service, region). Both caches live at module level, so warm invocations reuse
+them instead of calling STS and building the clients again. LazyClient defers building a client
+until it is used, to keep cold starts short.
+"""
+import boto3
+import datetime
+import os
+import threading
+
+# Credentials are refreshed when they have less than this left
+REFRESH_MARGIN_SECONDS = int(os.getenv('CREDENTIALS_REFRESH_MARGIN_SECONDS', '300'))
+
+# boto3 Sessions are not thread safe: each session and client is built under its own lock, so
+# different accounts can assume their roles in parallel
+_lock = threading.Lock()
+_locks = {}
+_sessions = {}  # (account_id, role_name) -> {'session', 'expiration'}
+_clients = {}   # (account_id, role_name, service, region) -> {'client', 'expiration'}
+_local_session = None
+
+stats = {'assume_role': 0, 'clients': 0}
+
+
+def _key_lock(key):
+    with _lock:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _count(stat):
+    with _lock:
+        stats[stat] += 1
+
+
+def _is_valid(expiration):
+    if expiration is None:
+        return True
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return expiration - now > datetime.timedelta(seconds=REFRESH_MARGIN_SECONDS)
+
+
+def get_session(account_id=None, role_name=None, session_name='CrossAccountSession'):
+    """Returns a boto3 Session with the role of the account, or of the Lambda itself without account_id.
+    The session name is only used when the role is assumed (first call or refresh)"""
+    global _local_session
+    with _key_lock(('session', None, None)):
+        if _local_session is None:
+            _local_session = boto3.session.Session()
+        if account_id is None:
+            return _local_session
+
+    key = (account_id, role_name)
+    with _key_lock(('session',) + key):
+        cached = _sessions.get(key)
+        if cached and _is_valid(cached['expiration']):
+            return cached['session']
+
+        credentials = get_client('sts').assume_role(
+            RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
+            RoleSessionName=session_name
+        )['Credentials']
+        _count('assume_role')
+        session = boto3.session.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        )
+        _sessions[key] = {'session': session, 'expiration': credentials.get('Expiration')}
+        return session
+
+
+def get_client(service, account_id=None, role_name=None, region=None, session_name='CrossAccountSession', **client_kwargs):
+    """Returns a cached client of the service, with the role of the account (or the Lambda role without account_id).
+    client_kwargs (e.g. config) are only used when the client is created"""
+    key = (account_id, role_name, service, region)
+    with _key_lock(('client',) + key):
+        cached = _clients.get(key)
+        if cached and _is_valid(cached['expiration']):
+            return cached['client']
+
+        session = get_session(account_id, role_name, session_name)
+        # Clients of the same session are created one at a time
+        with _key_lock(('session', account_id, role_name)):
+            expiration = _sessions[(account_id, role_name)]['expiration'] if account_id is not None else None
+            client = session.client(service, region_name=region, **client_kwargs)
+        _count('clients')
+        _clients[key] = {'client': client, 'expiration': expiration}
+        return client
+
+
+class LazyClient:
+    """Client built on first use (through get_client), so each path only pays for the clients it uses.
+    Can replace a module level boto3.client(...) without changing the callers"""
+
+    def __init__(self, service, account_id=None, role_name=None, region=None, session_name='CrossAccountSession', **client_kwargs):
+        self._args = (service, account_id, role_name, region, session_name)
+        self._client_kwargs = client_kwargs
+
+    def __getattr__(self, name):
+        return getattr(get_client(*self._args, **self._client_kwargs), name)
+
+
+def clear_cache():
+    """Drops every cached credential and client (e.g. after a role policy change)"""
+    global _local_session
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        _local_session = None
+        for key in stats:
+            stats[key] = 0
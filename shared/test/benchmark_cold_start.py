@@ -0,0 +1,173 @@
+"""
+Cold start measurements of the Lambda functions.
+
+Every run starts a fresh Python process (like a new Lambda container) and measures, per function:
+  - boto3 import time
+  - module import time (module level code, e.g. clients built at import)
+  - first invocation latency, and a second (warm) one for reference
+
+AWS calls go to an unreachable local endpoint with a single attempt, so they fail right away: what
+is measured is the work of the function itself (building clients, loading service models), not the
+network. boto3 must be installed; no AWS access is needed.
+
+--compare-ref runs the same measurements on the function files of another git ref, e.g. to check
+the lazy clients against the previous version:
+    python benchmark_cold_start.py --runs 10
+    python benchmark_cold_start.py --compare-ref HEAD~1
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+SHARED = 'shared/cross_account.py'
+
+FUNCTIONS = {
+    'scheduled_reports': {
+        'path': 'analytics_reports/functions/scheduled_reports.py',
+        'handler': 'lambda_handler',
+        'event': {},
+        'env': {'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:benchmark', 'IDENTITY_STORE': 'd-0000000000',
+                'MGMT_ACCT': '222222222222', 'ATHENA_DB_NAME': 'benchmark', 'CLOUDWATCH_ACCOUNT': '333333333333',
+                'CLOUDWATCH_LOG_GROUP': 'benchmark', 'MAX_CONTINUATIONS': '0'}
+    },
+    'ephemeral-monitor': {
+        'path': 'ephemeral_resources_lifecycle/functions/ephemeral-monitor.py',
+        'handler': 'handler',
+        'event': {},
+        'env': {'ACCOUNT_IDS': '111111111111', 'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:benchmark',
+                'EXPIRATION_DAYS': '30', 'MAX_CONTINUATIONS': '0'}
+    },
+    'ephemeral-tagger': {
+        'path': 'ephemeral_resources_lifecycle/functions/ephemeral-tagger.py',
+        'handler': 'lambda_handler',
+        # Not a creation event: the function returns without calling AWS
+        'event': {'detail': {'eventSource': 'ec2.amazonaws.com', 'eventName': 'DescribeInstances'}},
+        'env': {}
+    },
+    'cloudtrail-alerts': {
+        'path': 'cloudtrail_activity_alerts/functions/centralizedLambdaHandler.py',
+        'handler': 'handler',
+        'event': {'detail': {'eventName': 'ConsoleLogin', 'eventSource': 'signin.amazonaws.com', 'recipientAccountId': '111111111111',
+                             'userIdentity': {'type': 'IAMUser', 'userName': 'benchmark'}, 'eventTime': '2025-01-01T00:00:00Z'}},
+        'env': {'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:111111111111:benchmark'}
+    }
+}
+
+CHILD_ENV = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_ENDPOINT_URL': 'http://127.0.0.1:9',
+    'AWS_MAX_ATTEMPTS': '1',
+    'AWS_RETRY_MODE': 'standard'
+}
+
+
+class FakeContext:
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:111111111111:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def child(name, path):
+    """Runs inside the fresh process: imports and invokes the function, prints the timings as JSON"""
+    function = FUNCTIONS[name]
+    timings = {}
+
+    start = time.perf_counter()
+    import boto3  # noqa: F401
+    timings['boto3_import'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    timings['module_import'] = time.perf_counter() - start
+
+    for invocation in ('first_invocation', 'second_invocation'):
+        start = time.perf_counter()
+        try:
+            getattr(module, function['handler'])(json.loads(json.dumps(function['event'])), FakeContext())
+        except Exception as e:
+            timings['error'] = f"{type(e).__name__}: {e}"
+        timings[invocation] = time.perf_counter() - start
+
+    print(json.dumps(timings))
+
+
+def measure(name, path, shared_dir, runs):
+    env = {**os.environ, **CHILD_ENV, **FUNCTIONS[name]['env'],
+           'PYTHONPATH': os.pathsep.join([shared_dir, os.environ.get('PYTHONPATH', '')])}
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, path],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    result = {key: statistics.median(sample[key] for sample in samples)
+              for key in ('boto3_import', 'module_import', 'first_invocation', 'second_invocation')}
+    result['error'] = samples[-1].get('error')
+    return result
+
+
+def checkout(ref, directory):
+    """Writes the function files (and the shared module, if the ref has it) of a git ref to a directory"""
+    for path in [f['path'] for f in FUNCTIONS.values()] + [SHARED]:
+        try:
+            content = subprocess.run(['git', 'show', f'{ref}:{path}'], cwd=ROOT, capture_output=True, check=True).stdout
+        except subprocess.CalledProcessError:
+            continue
+        target = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as output:
+            output.write(content)
+
+
+def report(label, results):
+    print(f"\n{label}")
+    print(f"  {'function':<20} {'boto3 import':>13} {'module import':>14} {'1st invocation':>15} {'2nd invocation':>15}")
+    for name, result in results.items():
+        print(f"  {name:<20} {result['boto3_import'] * 1000:10.1f} ms {result['module_import'] * 1000:11.1f} ms "
+              f"{result['first_invocation'] * 1000:12.1f} ms {result['second_invocation'] * 1000:12.1f} ms"
+              + (f"   ({result['error']})" if result['error'] else ""))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        return child(sys.argv[2], sys.argv[3])
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes per function (the median is reported)')
+    parser.add_argument('--functions', nargs='+', choices=list(FUNCTIONS), default=list(FUNCTIONS))
+    parser.add_argument('--compare-ref', help='Also measure the function files of this git ref')
+    args = parser.parse_args()
+
+    current = {name: measure(name, os.path.join(ROOT, FUNCTIONS[name]['path']), os.path.join(ROOT, 'shared'), args.runs)
+               for name in args.functions}
+    report('Working tree', current)
+
+    if args.compare_ref:
+        with tempfile.TemporaryDirectory() as directory:
+            checkout(args.compare_ref, directory)
+            # Refs older than the shared module don't import it
+            shared_dir = os.path.join(directory, 'shared') if os.path.exists(os.path.join(directory, SHARED)) else os.path.join(ROOT, 'shared')
+            previous = {name: measure(name, os.path.join(directory, FUNCTIONS[name]['path']), shared_dir, args.runs)
+                        for name in args.functions if os.path.exists(os.path.join(directory, FUNCTIONS[name]['path']))}
+        report(args.compare_ref, previous)
+
+        print("\nCold start (module import + 1st invocation) difference")
+        for name in previous:
+            before = previous[name]['module_import'] + previous[name]['first_invocation']
+            after = current[name]['module_import'] + current[name]['first_invocation']
+            print(f"  {name:<20} {before * 1000:8.1f} ms -> {after * 1000:8.1f} ms ({(after - before) * 1000:+.1f} ms)")
+
+
+if __name__ == '__main__':
+    main()
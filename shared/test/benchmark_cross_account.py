@@ -0,0 +1,123 @@
+"""
+Microbenchmark of the cross-account credential and client cache (cross_account.py).
+
+Simulates several Lambda invocations in the same (warm) container. Each one needs clients for some
+services and regions in every account. It compares:
+  - legacy: assume_role + new clients in every invocation (the previous code in the Lambdas)
+  - cached: cross_account.get_client
+
+STS is replaced by a local stand-in with a configurable latency, so no AWS access is needed. The
+other clients are real boto3 clients (they are built, never called), so their creation cost is measured.
+
+Usage:
+    python benchmark_cross_account.py --accounts 20 --services ec2 rds securityhub --regions us-east-1 eu-west-1
+    python benchmark_cross_account.py --invocations 10 --sts-latency 50
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+import boto3
+import cross_account
+
+
+class FakeSTS:
+    calls = 0
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        FakeSTS.calls += 1
+        time.sleep(self.latency)
+        return {'Credentials': {
+            'AccessKeyId': 'ASIABENCHMARK',
+            'SecretAccessKey': 'benchmark',
+            'SessionToken': 'benchmark',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        }}
+
+
+def install_fake_sts(latency):
+    """Sessions return the STS stand-in and real clients for every other service"""
+    real_session = boto3.session.Session
+
+    class BenchmarkSession(real_session):
+        def client(self, service_name, *args, **kwargs):
+            if service_name == 'sts':
+                return FakeSTS(latency)
+            return super().client(service_name, *args, **kwargs)
+
+    boto3.session.Session = BenchmarkSession
+
+
+def legacy_invocation(accounts, services, regions):
+    """Previous pattern: new STS client, assume_role and clients on every invocation"""
+    for account in accounts:
+        credentials = boto3.session.Session().client('sts').assume_role(
+            RoleArn=f"arn:aws:iam::{account}:role/BenchmarkRole",
+            RoleSessionName='Benchmark'
+        )['Credentials']
+        for region in regions:
+            for service in services:
+                boto3.session.Session().client(
+                    service,
+                    region_name=region,
+                    aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken']
+                )
+
+
+def cached_invocation(accounts, services, regions):
+    for account in accounts:
+        for region in regions:
+            for service in services:
+                cross_account.get_client(service, account, 'BenchmarkRole', region, 'Benchmark')
+
+
+def run(name, invocation, args, accounts):
+    FakeSTS.calls = 0
+    cross_account.clear_cache()
+    times = []
+    for _ in range(args.invocations):
+        start = time.perf_counter()
+        invocation(accounts, args.services, args.regions)
+        times.append(time.perf_counter() - start)
+    warm = times[1:] or times
+    print(f"{name:<8} first: {times[0] * 1000:9.1f} ms   warm mean: {statistics.mean(warm) * 1000:9.1f} ms   "
+          f"warm max: {max(warm) * 1000:9.1f} ms   "
+          f"STS calls: {FakeSTS.calls}")
+    return statistics.mean(warm), FakeSTS.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accounts', type=int, default=10, help='Accounts per invocation')
+    parser.add_argument('--services', nargs='+', default=['ec2', 'rds', 'securityhub'])
+    parser.add_argument('--regions', nargs='+', default=['us-east-1'])
+    parser.add_argument('--invocations', type=int, default=5, help='Invocations in the same warm container')
+    parser.add_argument('--sts-latency', type=float, default=30, help='Simulated assume_role latency, in ms')
+    args = parser.parse_args()
+    args.sts_latency /= 1000
+
+    install_fake_sts(args.sts_latency)
+    accounts = [f'{100000000000 + i}' for i in range(args.accounts)]
+    print(f"{args.accounts} accounts x {len(args.services)} services x {len(args.regions)} regions, "
+          f"{args.invocations} invocations, assume_role latency {args.sts_latency * 1000:.0f} ms")
+
+    legacy_time, legacy_calls = run('legacy', legacy_invocation, args, accounts)
+    cached_time, cached_calls = run('cached', cached_invocation, args, accounts)
+    print(f"Warm invocations {legacy_time / cached_time:.0f}x faster, {legacy_calls - cached_calls} fewer STS calls")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Tests of the credential and client cache of cross_account.py, with a stand-in boto3 Session.
+No AWS access is needed, only boto3 installed.
+
+Usage:
+    python -m pytest shared/test
+"""
+import datetime
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import boto3
+import cross_account
+
+
+class FakeSession:
+    """Records the sessions and clients built. STS returns credentials valid for FakeSession.lifetime"""
+    built = []
+    lifetime = datetime.timedelta(hours=1)
+
+    def __init__(self, **kwargs):
+        self.credentials = kwargs.get('aws_access_key_id')
+        self.region_name = 'us-east-1'
+
+    def client(self, service_name, region_name=None, **kwargs):
+        FakeSession.built.append((self.credentials, service_name, region_name, kwargs))
+        if service_name == 'sts':
+            return types.SimpleNamespace(assume_role=self.assume_role)
+        return types.SimpleNamespace(service=service_name, region=region_name, credentials=self.credentials,
+                                     describe=lambda: service_name)
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        return {'Credentials': {
+            'AccessKeyId': f"{RoleArn.split(':')[4]}-{len(FakeSession.built)}",
+            'SecretAccessKey': 'test',
+            'SessionToken': 'test',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + FakeSession.lifetime
+        }}
+
+
+@pytest.fixture(autouse=True)
+def fake_session(monkeypatch):
+    monkeypatch.setattr(boto3.session, 'Session', FakeSession)
+    FakeSession.built = []
+    FakeSession.lifetime = datetime.timedelta(hours=1)
+    cross_account.clear_cache()
+    yield
+    cross_account.clear_cache()
+
+
+def built_services():
+    return [service for _, service, _, _ in FakeSession.built]
+
+
+def test_lazy_client_is_built_on_first_use():
+    client = cross_account.LazyClient('sns', region='eu-west-1')
+    assert FakeSession.built == []
+
+    assert client.describe() == 'sns'
+    assert client.region == 'eu-west-1'
+    assert built_services() == ['sns']
+
+
+def test_lazy_client_forwards_the_client_arguments():
+    config = object()
+    cross_account.LazyClient('s3', config=config).describe()
+
+    assert FakeSession.built == [(None, 's3', None, {'config': config})]
+
+
+def test_clients_and_credentials_are_reused():
+    first = cross_account.get_client('ec2', '111111111111', 'Role', 'us-east-1')
+    second = cross_account.get_client('ec2', '111111111111', 'Role', 'us-east-1')
+    other_region = cross_account.get_client('ec2', '111111111111', 'Role', 'eu-west-1')
+
+    assert first is second
+    assert other_region is not first
+    assert other_region.credentials == first.credentials
+    assert cross_account.stats == {'assume_role': 1, 'clients': 3}  # STS and the two EC2 clients
+
+
+def test_credentials_close_to_expiration_are_refreshed():
+    FakeSession.lifetime = datetime.timedelta(seconds=cross_account.REFRESH_MARGIN_SECONDS - 1)
+    first = cross_account.get_client('ec2', '111111111111', 'Role', 'us-east-1')
+    second = cross_account.get_client('ec2', '111111111111', 'Role', 'us-east-1')
+
+    assert second is not first
+    assert second.credentials != first.credentials
+    assert cross_account.stats['assume_role'] == 2
+
+
+def test_clear_cache_drops_clients_and_credentials():
+    first = cross_account.get_client('ec2', '111111111111', 'Role', 'us-east-1')
+    cross_account.clear_cache()
+
+    assert cross_account.get_client('ec2', '111111111111', 'Role', 'us-east-1') is not first
+    assert cross_account.stats['assume_role'] == 1